@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import time
+
+from misc import MyException, Checksum
+
+
+
+class CheckJournal(object):
+
+	# --------------------------------------
+	# A note about resuming checks
+	# --------------------------------------
+	# Calculating the checksums is by far the most expensive part of a
+	# check, walking the directories and comparing the nodes with the
+	# database is cheap in comparison. The journal is a database of its
+	# own next to the database of the directory: while checking, the
+	# FilesystemTree records each checksum calculated together with the
+	# size and the timestamps of the file (see registerJournal()). The
+	# journal is committed every few seconds, so a check that is cancelled
+	# or killed loses at most the work of these seconds. A check started
+	# with an existing journal walks all directories again, but it takes
+	# the checksums of all files not changed since they were recorded from
+	# the journal; the comparison with the database is done again, so the
+	# result is consistent even if the database changed in between. After
+	# a complete check the journal is removed. A file is trusted by its
+	# size and timestamps alone, so the journal must not grow old: its
+	# creation time is stored with it and older journals are not offered
+	# for resuming anymore (see isExpired()).
+
+	def __init__(self, dbfile):
+		self.__databaseFile = dbfile
+		# maximum time between two commits of the journal in seconds
+		self.__commitInterval = 5.0
+		# maximum age of a journal that can be resumed in nanoseconds
+		self.__maxAge = 7 * 24 * 3600 * 10**9
+		self.__creationTime = None
+		self.__lastCommitTime = None
+		self.__cursor = None
+		self.__dbcon = None
+
+	def __str__(self):
+		result = '('
+		result += 'CheckJournal: '
+		result += 'file=\'' + self.__databaseFile + '\''
+		result += ', cursor=\'' + self.getCursorString() + '\''
+		return result + ')'
+
+	@staticmethod
+	def exists(dbfile):
+		return os.path.exists(dbfile)
+
+	def open(self):
+		if self.isOpen():
+			return
+		self.__dbcon = sqlite3.connect(self.__databaseFile)
+		self.__dbcon.execute('pragma journal_mode=wal')
+		self.__dbcon.execute('create table if not exists digests (' + \
+			'path text primary key, size integer, ctime integer, ' + \
+			'mtime integer, checksum blob)')
+		self.__dbcon.execute('create table if not exists state (' + \
+			'key text primary key, value)')
+		self.__creationTime = self.__getState('created')
+		if self.__creationTime is None and self.getNumChecksums() == 0:
+			# new journal; journals of older versions have no creation time
+			self.__creationTime = int(time.time() * 10**9)
+			self.__setState('created', self.__creationTime)
+		self.__dbcon.commit()
+		self.__lastCommitTime = time.time()
+		self.__cursor = self.__getState('cursor')
+
+	def isOpen(self):
+		return self.__dbcon is not None
+
+	def close(self):
+		if self.isOpen():
+			self.commit()
+			self.__dbcon.close()
+			self.__dbcon = None
+
+	def remove(self):
+		# the check is complete, its journal is not needed anymore
+		if self.isOpen():
+			self.__dbcon.close()
+			self.__dbcon = None
+		for suffix in [ '', '-wal', '-shm' ]:
+			if os.path.exists(self.__databaseFile + suffix):
+				os.remove(self.__databaseFile + suffix)
+		self.__cursor = None
+		self.__creationTime = None
+
+	def commit(self):
+		self.__checkOpen()
+		self.__setState('cursor', self.__cursor)
+		self.__dbcon.commit()
+		self.__lastCommitTime = time.time()
+
+	def getNumChecksums(self):
+		self.__checkOpen()
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select count(path) from digests')
+		count = cursor.fetchone()[0]
+		cursor.close()
+		return count
+
+	def getCreationTime(self):
+		# time the check was started in nanoseconds, None if unknown
+		return self.__creationTime
+
+	def isExpired(self):
+		# journals of unknown or too old age are not resumed
+		if self.__creationTime is None:
+			return True
+		return int(time.time() * 10**9) - self.__creationTime > self.__maxAge
+
+	def getCursor(self):
+		# path of the file recorded last, None for an empty journal
+		return self.__cursor
+
+	def getCursorString(self):
+		if self.__cursor is None:
+			return ''
+		else:
+			return self.__cursor
+
+	def record(self, path, info):
+		# checksum calculated for the file of the path with the node info
+		self.__checkOpen()
+		self.__dbcon.execute('insert or replace into digests ' + \
+			'(path, size, ctime, mtime, checksum) values (?,?,?,?,?)', \
+			(path, info.size, info.ctime, info.mtime, info.checksum.getBinary()))
+		self.__cursor = path
+		if time.time() - self.__lastCommitTime >= self.__commitInterval:
+			self.commit()
+
+	def lookup(self, path, size, ctime, mtime):
+		# checksum recorded for the file of the path, None if unknown or if
+		# the file has changed since
+		self.__checkOpen()
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select size, ctime, mtime, checksum from digests where path=?', (path,))
+		row = cursor.fetchone()
+		cursor.close()
+		if row is None or not tuple(row[0:3]) == (size, ctime, mtime):
+			return None
+		checksum = Checksum()
+		checksum.setBinary(row[3])
+		return checksum
+
+	def __checkOpen(self):
+		if not self.isOpen():
+			raise MyException('Check journal is not open.', 3)
+
+	def __getState(self, key):
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select value from state where key=?', (key,))
+		row = cursor.fetchone()
+		cursor.close()
+		if row is None:
+			return None
+		return row[0]
+
+	def __setState(self, key, value):
+		self.__dbcon.execute('insert or replace into state (key, value) values (?,?)', \
+			(key, value))
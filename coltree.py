@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import array
+import binascii
+import os
+import struct
+
+from misc import MyException, Checksum
+from node import NodeInfo, Node, NodeStatus, NodeStatistics
+from tree import Tree
+
+
+
+class ColumnTree(Tree):
+
+	# --------------------------------------
+	# A note about the column tree
+	# --------------------------------------
+	# A MemoryTree keeps a Node, a NodeInfo and a MemoryTreeNode for each
+	# entry, which is too much for a diff result with millions of entries.
+	# The column tree keeps its entries in parallel arrays instead and
+	# only creates Node objects on access. Entry 0 is the root directory.
+	# The children of a directory are a doubly linked list sorted by NID;
+	# the list is circular backwards, so the previous sibling of the first
+	# child is the last child and appending in NID order (like diff does)
+	# is cheap. Names are UTF-8 encoded into a single buffer, the database
+	# key, node info and other node info of an entry are packed into a
+	# record in another buffer. Deleting the most recently inserted entry
+	# (like diff does for all Ok nodes) frees its memory, other deleted
+	# entries are just unlinked. Looking up a node by NID does not need an
+	# index for the nodes just inserted, iterated or ascended from, for
+	# others an index of the current directory is built on demand. Each
+	# directory has counters of the statuses of its children and of all
+	# its descendants, see Tree.getStatusCounts(). Entries are referenced
+	# by 32 bit indexes, byte offsets into the buffers are native longs.
+	# Statistics, size sums and filtering by status are computed from the
+	# columns without creating Node objects. Pickling is done by dumping
+	# the columns and buffers as strings, so a diff result of a separate
+	# process is transferred quickly, see diffSubtreeWorker().
+
+	def __init__(self):
+		super(ColumnTree, self).__init__()
+		# flags of an entry
+		self.__isDirectoryFlag = 1
+		self.__hasOtherInfoFlag = 2
+		self.__isDeletedFlag = 4
+		# database key (-1 for None)
+		self.__dbkeyStruct = struct.Struct('<q')
+		# size, ctime, atime, mtime (the smallest value for None, e.g. for
+		# imported checksums), checksum
+		self.__infoStruct = struct.Struct('<qqqq32s')
+		self.__noneValue = -2**63
+		self.clear()
+		self.__isOpen = False
+
+	def __str__(self):
+		result = '('
+		result += 'ColumnTree: '
+		result += 'depth=\'' + str(self.getDepth()) + '\''
+		result += ', path=\'' + self.getPath() + '\''
+		return result + ')'
+
+	def __getstate__(self):
+		# strings pickle much faster than arrays; the tree is at its root
+		# directory after unpickling
+		return ([ column.tostring() for column in self.__getColumns() ], \
+			str(self.__names), str(self.__records), self.__isOpen)
+
+	def __setstate__(self, state):
+		self.__init__()
+		columns, names, records, isOpen = state
+		for column, data in zip(self.__getColumns(), columns):
+			del column[:]
+			column.fromstring(data)
+		self.__names = bytearray(names)
+		self.__records = bytearray(records)
+		self.__isOpen = isOpen
+
+	### implementation of base class methods, please keep order
+
+	def open(self):
+		self.__isOpen = True
+
+	def close(self):
+		self.__isOpen = False
+
+	def isOpen(self):
+		return self.__isOpen
+
+	def clear(self):
+		# columns
+		self.__parents = array.array('i', [ -1 ])
+		self.__firstChildren = array.array('i', [ -1 ])
+		self.__nextSiblings = array.array('i', [ -1 ])
+		self.__prevSiblings = array.array('i', [ -1 ])
+		self.__nameOffsets = array.array('l', [ 0 ])
+		self.__recordOffsets = array.array('l', [ 0 ])
+		self.__statuses = array.array('B', [ NodeStatus.Undefined ])
+		self.__flags = array.array('B', [ self.__isDirectoryFlag ])
+		self.__counterOffsets = array.array('i', [ 0 ])
+		# numbers of children and of all descendants of each status for
+		# all directories
+		self.__counters = array.array('l', [ 0 ] * 2 * NodeStatus.NumStatuses)
+		self.__names = bytearray()
+		self.__records = bytearray(self.__dbkeyStruct.pack(-1))
+		# entry found most recently, see __find()
+		self.__recent = 0
+		# entries of all files sorted by checksum, created on demand
+		self.__sortedChecksums = None
+		self.gotoRoot()
+
+	def getDepth(self):
+		return len(self.__parentStack) - 1
+
+	def getPath(self, node=None):
+		path = reduce(lambda x, y: os.path.join(x, y), \
+			[ name for entry, name, index in self.__parentStack ])
+		if node is None:
+			return path
+		else:
+			return os.path.join(path, node.name)
+
+	def gotoRoot(self):
+		# [ entry, name, index NID -> entry or None ] of current directories
+		self.__parentStack = [ [ 0, '', None ] ]
+
+	def up(self):
+		if self.isRoot():
+			raise MyException('\'up\' on root node is not possible.', 3)
+		entry, name, index = self.__parentStack.pop()
+		self.__recent = entry
+		return name
+
+	def down(self, node):
+		entry = self.__find(node.getNid())
+		if entry is None:
+			raise MyException('No node \'' + node.name + '\' in current dir.', 3)
+		if node.isFile():
+			raise MyException('\'down\' on file \'' + node.name + '\' is not possible.', 3)
+		self.__parentStack.append([ entry, node.name, None ])
+
+	def numChildren(self, node):
+		if node.isFile():
+			return 0
+		entry = self.__find(node.getNid())
+		if entry is None:
+			return 0
+		offset = self.__counterOffsets[entry]
+		return sum(self.__counters[offset:offset+NodeStatus.NumStatuses])
+
+	def insert(self, node):
+		parent = self.__parentStack[-1][0]
+		nid = node.getNid()
+		# position in the list of children: after the last child with a
+		# lower NID, the search starts at the last child
+		first = self.__firstChildren[parent]
+		prev = -1
+		if not first == -1:
+			prev = self.__prevSiblings[first]
+			while not prev == -1:
+				prevnid = self.__getNid(prev)
+				if prevnid == nid:
+					raise MyException('Node \'' + node.name + '\' already exists.', 3)
+				if prevnid < nid:
+					break
+				if prev == first:
+					prev = -1
+				else:
+					prev = self.__prevSiblings[prev]
+		entry = self.__append(node, parent)
+		# link entry
+		if prev == -1:
+			if first == -1:
+				self.__prevSiblings[entry] = entry
+			else:
+				self.__prevSiblings[entry] = self.__prevSiblings[first]
+				self.__prevSiblings[first] = entry
+			self.__nextSiblings[entry] = first
+			self.__firstChildren[parent] = entry
+		else:
+			next = self.__nextSiblings[prev]
+			self.__nextSiblings[prev] = entry
+			self.__nextSiblings[entry] = next
+			self.__prevSiblings[entry] = prev
+			if next == -1:
+				self.__prevSiblings[first] = entry
+			else:
+				self.__prevSiblings[next] = entry
+		index = self.__parentStack[-1][2]
+		if index is not None:
+			index[nid] = entry
+		self.__recent = entry
+		self.__countStatus(node.status, 1)
+		if node.isFile():
+			self.__sortedChecksums = None
+
+	def update(self, node):
+		entry = self.__find(node.getNid())
+		if entry is None:
+			raise MyException('Node does not exist for update.', 3)
+		if not self.__statuses[entry] == node.status:
+			self.__countStatus(self.__statuses[entry], -1)
+			self.__countStatus(node.status, 1)
+		self.__statuses[entry] = node.status
+		record = self.__packRecord(node)
+		start = self.__recordOffsets[entry]
+		end = start + self.__getRecordSize(entry)
+		if node.isFile() and node.otherinfo is not None:
+			self.__flags[entry] |= self.__hasOtherInfoFlag
+		else:
+			self.__flags[entry] &= ~self.__hasOtherInfoFlag
+		if len(record) == end - start or end == len(self.__records):
+			self.__records[start:end] = record
+		else:
+			# record size has changed, the old record is not used anymore
+			self.__recordOffsets[entry] = len(self.__records)
+			self.__records.extend(record)
+		if node.isFile():
+			self.__sortedChecksums = None
+
+	def delete(self, node):
+		if not self.isChildless(node):
+			raise MyException('Deleting the non-empty directory \'' + node.name + '\'.', 1)
+		nid = node.getNid()
+		entry = self.__find(nid)
+		if entry is None:
+			raise MyException('Node does not exist for deletion.', 1)
+		# unlink entry
+		parent = self.__parents[entry]
+		first = self.__firstChildren[parent]
+		next = self.__nextSiblings[entry]
+		prev = self.__prevSiblings[entry]
+		if entry == first:
+			self.__firstChildren[parent] = next
+			if not next == -1:
+				self.__prevSiblings[next] = prev
+		else:
+			self.__nextSiblings[prev] = next
+			if next == -1:
+				self.__prevSiblings[first] = prev
+			else:
+				self.__prevSiblings[next] = prev
+		index = self.__parentStack[-1][2]
+		if index is not None:
+			del index[nid]
+		self.__countStatus(self.__statuses[entry], -1)
+		if entry == len(self.__parents) - 1:
+			self.__truncate(entry)
+		else:
+			self.__flags[entry] |= self.__isDeletedFlag
+		self.__recent = 0
+		if node.isFile():
+			self.__sortedChecksums = None
+
+	def commit(self):
+		pass
+
+	def exists(self, nid):
+		return self.__find(nid) is not None
+
+	def getNodeByNid(self, nid):
+		entry = self.__find(nid)
+		if entry is None:
+			return None
+		return self.__fetch(entry)
+
+	def __iter__(self):
+		parent = self.__parentStack[-1][0]
+		for entry in self.__getChildren(parent):
+			# skip entries deleted while iterating
+			if entry < len(self.__parents) and self.__parents[entry] == parent and \
+				not self.__flags[entry] & self.__isDeletedFlag:
+				self.__recent = entry
+				yield self.__fetch(entry)
+
+	def calculate(self, node):
+		# nothing to do, just signal that the job is done if necessary
+		if node.isDirectory():
+			if self.signalNewFile is not None:
+				self.signalNewFile(self.getPath(node), 0)
+		else:
+			if self.signalNewFile is not None:
+				self.signalNewFile(self.getPath(node), node.info.size)
+			if self.signalBytesDone is not None:
+				self.signalBytesDone(node.info.size)
+
+	def globalChecksumExists(self, checksumString):
+		return len(self.globalGetPathsByChecksum(checksumString)) > 0
+
+	def globalChecksumNumberOfOccurrences(self, checksumString):
+		return len(self.globalGetPathsByChecksum(checksumString))
+
+	def globalGetPathsByChecksum(self, checksumString):
+		# abbreviated checksums yield the paths of all matching checksums
+		return set([ self.__getPathByEntry(entry) \
+			for entry in self.__findChecksums(checksumString) ])
+
+	def globalGetChecksumsByPrefix(self, prefix, limit=None):
+		result = []
+		for entry in self.__findChecksums(prefix):
+			csumstr = unicode(binascii.hexlify(self.__getChecksum(entry)))
+			if len(result) == 0 or not result[-1] == csumstr:
+				if limit is not None and len(result) >= limit:
+					break
+				result.append(csumstr)
+		return result
+
+	def getStatusCounts(self, recursive=False):
+		offset = self.__counterOffsets[self.__parentStack[-1][0]]
+		if recursive:
+			offset += NodeStatus.NumStatuses
+		return self.__counters[offset:offset+NodeStatus.NumStatuses].tolist()
+
+	def getNodeStatistics(self, node=None, recurse=True):
+		# see Tree.getNodeStatistics(), counted from the columns
+		if callable(recurse):
+			return Tree.getNodeStatistics(self, node, recurse)
+		if node is None:
+			pending = self.__getChildren(self.__parentStack[-1][0])
+		else:
+			entry = self.__find(node.getNid())
+			pending = array.array('i', [] if entry is None else [ entry ])
+		dircount = 0
+		filecount = 0
+		filesize = 0
+		while len(pending) > 0:
+			entry = pending.pop()
+			if self.__flags[entry] & self.__isDirectoryFlag:
+				dircount += 1
+				if recurse:
+					pending.extend(self.__getChildren(entry))
+			else:
+				filecount += 1
+				size = self.__infoStruct.unpack_from(self.__records, \
+					self.__recordOffsets[entry] + self.__dbkeyStruct.size)[0]
+				if not size == self.__noneValue:
+					filesize += size
+		stats = NodeStatistics()
+		stats.addCounts(dircount, filecount, filesize)
+		return stats
+
+	def getPathsByStatus(self, statuses):
+		# see Tree.getPathsByStatus(), directories without descendants of
+		# the statuses are skipped using their counters
+		statuses = set(statuses)
+		result = []
+		offsets = self.__counterOffsets
+		stack = [ (self.getPath(), iter(self.__getChildren(self.__parentStack[-1][0]))) ]
+		while len(stack) > 0:
+			parentpath, children = stack[-1]
+			entry = next(children, None)
+			if entry is None:
+				stack.pop()
+				continue
+			path = os.path.join(parentpath, self.__getName(entry))
+			if self.__statuses[entry] in statuses:
+				result.append(path)
+			offset = offsets[entry]
+			if not offset == -1 and any([ self.__counters[offset + \
+				NodeStatus.NumStatuses + status] > 0 for status in statuses ]):
+				stack.append((path, iter(self.__getChildren(entry))))
+		return result
+
+	### the following methods are not implementations of base class methods
+
+	def getMemoryUsage(self):
+		# number of bytes used by columns and buffers
+		result = len(self.__names) + len(self.__records)
+		for column in self.__getColumns():
+			result += len(column) * column.itemsize
+		return result
+
+	def __getColumns(self):
+		return [ self.__parents, self.__firstChildren, self.__nextSiblings, \
+			self.__prevSiblings, self.__nameOffsets, self.__recordOffsets, \
+			self.__statuses, self.__flags, self.__counterOffsets, self.__counters ]
+
+	def __append(self, node, parent):
+		entry = len(self.__parents)
+		self.__parents.append(parent)
+		self.__firstChildren.append(-1)
+		self.__nextSiblings.append(-1)
+		self.__prevSiblings.append(-1)
+		self.__nameOffsets.append(len(self.__names))
+		self.__names.extend(node.name.encode('utf-8'))
+		self.__recordOffsets.append(len(self.__records))
+		self.__records.extend(self.__packRecord(node))
+		self.__statuses.append(node.status)
+		flags = 0
+		if node.isDirectory():
+			flags |= self.__isDirectoryFlag
+			self.__counterOffsets.append(len(self.__counters))
+			self.__counters.extend([ 0 ] * 2 * NodeStatus.NumStatuses)
+		else:
+			if node.otherinfo is not None:
+				flags |= self.__hasOtherInfoFlag
+			self.__counterOffsets.append(-1)
+		self.__flags.append(flags)
+		return entry
+
+	def __truncate(self, entry):
+		# remove the last entry
+		del self.__names[self.__nameOffsets[entry]:]
+		# the record of another entry may have been moved behind it by update()
+		start = self.__recordOffsets[entry]
+		if start + self.__getRecordSize(entry) == len(self.__records):
+			del self.__records[start:]
+		if not self.__counterOffsets[entry] == -1:
+			del self.__counters[self.__counterOffsets[entry]:]
+		for column in [ self.__parents, self.__firstChildren, self.__nextSiblings, \
+			self.__prevSiblings, self.__nameOffsets, self.__recordOffsets, \
+			self.__statuses, self.__flags, self.__counterOffsets ]:
+			column.pop()
+
+	def __countStatus(self, status, delta):
+		# count a child of the current directory, which is a descendant
+		# of all directories up to the root
+		offsets = self.__counterOffsets
+		self.__counters[offsets[self.__parentStack[-1][0]] + status] += delta
+		for entry, name, index in self.__parentStack:
+			self.__counters[offsets[entry] + NodeStatus.NumStatuses + status] += delta
+
+	def __getRecordSize(self, entry):
+		size = self.__dbkeyStruct.size
+		if not self.__flags[entry] & self.__isDirectoryFlag:
+			size += self.__infoStruct.size
+			if self.__flags[entry] & self.__hasOtherInfoFlag:
+				size += self.__infoStruct.size
+		return size
+
+	def __packRecord(self, node):
+		if node.dbkey is None:
+			record = self.__dbkeyStruct.pack(-1)
+		else:
+			record = self.__dbkeyStruct.pack(node.dbkey)
+		if node.isFile():
+			record += self.__packInfo(node.info)
+			if node.otherinfo is not None:
+				record += self.__packInfo(node.otherinfo)
+		return record
+
+	def __packInfo(self, info):
+		values = [ info.size, info.ctime, info.atime, info.mtime ]
+		values = [ self.__noneValue if v is None else v for v in values ]
+		return self.__infoStruct.pack(*(values + [ str(info.checksum.getBinary()) ]))
+
+	def __unpackInfo(self, offset):
+		size, ctime, atime, mtime, checksum = \
+			self.__infoStruct.unpack_from(self.__records, offset)
+		size, ctime, atime, mtime = [ None if v == self.__noneValue else v \
+			for v in [ size, ctime, atime, mtime ] ]
+		info = NodeInfo()
+		info.size = size
+		info.ctime = ctime
+		info.atime = atime
+		info.mtime = mtime
+		info.checksum = Checksum()
+		info.checksum.setBinary(buffer(checksum))
+		return info
+
+	def __getName(self, entry):
+		# names are stored in order of the entries
+		start = self.__nameOffsets[entry]
+		if entry + 1 < len(self.__nameOffsets):
+			end = self.__nameOffsets[entry + 1]
+		else:
+			end = len(self.__names)
+		return self.__names[start:end].decode('utf-8')
+
+	def __getNid(self, entry):
+		return Node.constructNid(self.__getName(entry), \
+			self.__flags[entry] & self.__isDirectoryFlag)
+
+	def __fetch(self, entry):
+		node = Node(self.__getName(entry))
+		node.status = self.__statuses[entry]
+		offset = self.__recordOffsets[entry]
+		dbkey, = self.__dbkeyStruct.unpack_from(self.__records, offset)
+		if not dbkey == -1:
+			node.dbkey = dbkey
+		if not self.__flags[entry] & self.__isDirectoryFlag:
+			offset += self.__dbkeyStruct.size
+			node.info = self.__unpackInfo(offset)
+			if self.__flags[entry] & self.__hasOtherInfoFlag:
+				offset += self.__infoStruct.size
+				node.otherinfo = self.__unpackInfo(offset)
+		return node
+
+	def __getChecksum(self, entry):
+		offset = self.__recordOffsets[entry] + self.__dbkeyStruct.size
+		return self.__infoStruct.unpack_from(self.__records, offset)[4]
+
+	def __getChildren(self, parent):
+		result = array.array('i')
+		entry = self.__firstChildren[parent]
+		while not entry == -1:
+			result.append(entry)
+			entry = self.__nextSiblings[entry]
+		return result
+
+	def __find(self, nid):
+		# entry of a child of the current directory, None if not existing
+		parent = self.__parentStack[-1][0]
+		recent = self.__recent
+		if recent < len(self.__parents) and self.__parents[recent] == parent and \
+			not self.__flags[recent] & self.__isDeletedFlag and \
+			self.__getNid(recent) == nid:
+			return recent
+		index = self.__parentStack[-1][2]
+		if index is None:
+			index = {}
+			for entry in self.__getChildren(parent):
+				index[self.__getNid(entry)] = entry
+			self.__parentStack[-1][2] = index
+		return index.get(nid)
+
+	def __getPathByEntry(self, entry):
+		names = []
+		while not entry == 0:
+			names.append(self.__getName(entry))
+			entry = self.__parents[entry]
+		return reduce(lambda x, y: os.path.join(x, y), reversed(names), '')
+
+	def __findChecksums(self, prefix):
+		# entries of files with checksums starting with prefix, sorted
+		# by checksum
+		if self.__sortedChecksums is None:
+			entries = [ entry for entry in xrange(1, len(self.__parents)) \
+				if not self.__flags[entry] & (self.__isDirectoryFlag | self.__isDeletedFlag) ]
+			entries.sort(key=self.__getChecksum)
+			self.__sortedChecksums = array.array('i', entries)
+		low, high = Checksum.prefixToBinaryRange(prefix)
+		low = str(low)
+		lo = 0
+		hi = len(self.__sortedChecksums)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.__getChecksum(self.__sortedChecksums[mid]) < low:
+				lo = mid + 1
+			else:
+				hi = mid
+		while lo < len(self.__sortedChecksums):
+			entry = self.__sortedChecksums[lo]
+			if high is not None and not self.__getChecksum(entry) < str(high):
+				break
+			yield entry
+			lo += 1
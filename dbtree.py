@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import datetime
+import hashlib
 import os
+import re
 import sqlite3
+import struct
+import time
+import xml.etree.cElementTree as ElementTree
+from xml.sax.saxutils import quoteattr
 
 from misc import MyException, Checksum
 from node import NodeInfo, Node
@@ -10,18 +17,69 @@ from tree import Tree
 
 
 
+class ReaderConnectionPool(object):
+
+	# --------------------------------------
+	# A note about concurrent access
+	# --------------------------------------
+	# Databases are used in write-ahead logging mode: a writer does not
+	# block readers and readers do not block the writer. Each DatabaseTree
+	# opened for writing has its own connection, DatabaseTrees opened
+	# read-only get a connection from this pool. Opening a connection is
+	# cheap, but the page cache of a connection is lost when closing it.
+
+	# idle connections: database file -> list of connections
+	__idleConnections = {}
+	__maxIdleConnectionsPerFile = 4
+
+	@staticmethod
+	def acquire(dbfile):
+		idle = ReaderConnectionPool.__idleConnections.get(dbfile, [])
+		if len(idle) > 0:
+			return idle.pop()
+		# transactions are controlled explicitly, see DatabaseTree.refresh()
+		con = sqlite3.connect(dbfile, isolation_level=None, check_same_thread=False)
+		con.execute('pragma query_only=1')
+		return con
+
+	@staticmethod
+	def release(dbfile, con):
+		# end read transaction to release the snapshot
+		try:
+			con.execute('rollback')
+		except sqlite3.OperationalError:
+			pass
+		idle = ReaderConnectionPool.__idleConnections.setdefault(dbfile, [])
+		if len(idle) < ReaderConnectionPool.__maxIdleConnectionsPerFile:
+			idle.append(con)
+		else:
+			con.close()
+
+	@staticmethod
+	def closeAll(dbfile):
+		for con in ReaderConnectionPool.__idleConnections.pop(dbfile, []):
+			con.close()
+
+
+
 class DatabaseTree(Tree):
 
-	def __init__(self, dbfile, sigfile):
+	def __init__(self, dbfile, sigfile, readonly=False):
 		super(DatabaseTree, self).__init__()
 		self.__databaseFile = dbfile
 		self.__signatureFile = sigfile
+		# read-only trees see a snapshot of the database: the state of
+		# the last commit before opening or refreshing the tree
+		self.__readonly = readonly
 
 		# Buffering of the contents of a directory speeds up some operations
 		# like exists() and getNodeByNid(), slows down some others like up()
-		# and down() due to prefetching at that time. Besides it allows
-		# sorting of entries in the generator
+		# and down() due to prefetching at that time. Directories with more
+		# entries than the maximum buffer size are not buffered, the
+		# generator streams them from the database in NID order instead
 		self.__useBuffer = True
+		self.__maxBufferSize = 10000
+		self.__buffer = None
 
 		# --- SQL strings for database access ---
 		# Always keep in sync with Node and NodeInfo classes!
@@ -32,15 +90,48 @@ class DatabaseTree(Tree):
 			'name text,' + \
 			'isdir boolean,' + \
 			'size integer,' + \
-			'ctime timestamp,' + \
-			'atime timestamp,' + \
-			'mtime timestamp,' + \
-			'checksum blob'
+			'ctime integer,' + \
+			'atime integer,' + \
+			'mtime integer,' + \
+			'checksum blob,' + \
+			'path text,' + \
+			'generation integer'
 		self.__databaseVarNames = [s.split(' ')[0] for s in self.__databaseCreateString.split(',')]
 		self.__databaseInsertVars = ','.join(self.__databaseVarNames[1:])
 		self.__databaseInsertQMarks = (len(self.__databaseVarNames)-2) * '?,' + '?'
 		self.__databaseSelectString = ','.join(self.__databaseVarNames)
+		self.__databaseChildrenIndexString = \
+			'create index childrenindex on nodes (parentkey, isdir desc, name)'
 		self.__databaseUpdateString = '=?,'.join(self.__databaseVarNames[1:]) + '=?'
+		# history of the node table: previous versions of rows with the
+		# generation that replaced or deleted them
+		self.__databaseHistoryCreateString = 'superseded integer,' + \
+			self.__databaseCreateString.replace(' primary key', '')
+
+		# Version of the database layout stored in the database file itself,
+		# increase when changing the layout and add an upgrade step to
+		# __upgrade() for databases created with older versions
+		self.__databaseVersion = 9
+		# Paths stored in the database always use this separator, this way
+		# databases can be shared between different OSes
+		self.__databasePathSep = '/'
+
+		# The database signature is the sum (modulo 2**256) of the digests
+		# of all rows. The sum is kept separately for buckets of consecutive
+		# node keys, so it can be updated with each write and each bucket can
+		# be verified on its own. The signature file contains a digest over
+		# all bucket sums. Checking the signature recalculates the sums of the
+		# buckets checked longest ago from their rows, at least a minimum
+		# number of buckets and at least a fraction of all of them, so each
+		# bucket is checked every few openings; see isSignatureValid().
+		self.__signatureBucketSize = 4096
+		self.__signatureDigestSize = 32
+		self.__signatureCheckMinBuckets = 16
+		self.__signatureCheckFraction = 16
+		# rows of all tables covered by the signature: table -> columns
+		self.__signatureTables = [
+			('nodes', self.__databaseVarNames),
+			('treehashes', [ 'nodekey', 'treehash' ]) ]
 
 		self.__dbcon = None
 		self.open()
@@ -60,41 +151,80 @@ class DatabaseTree(Tree):
 	### implementation of base class methods, please keep order
 
 	def open(self):
+		if self.isOpen():
+			return
+		if self.__readonly:
+			if not os.path.exists(self.__databaseFile):
+				raise MyException('Cannot find database file \'' + self.__databaseFile + '\'.', 2)
+			self.dbOpen()
+			if not self.__getDatabaseVersion() == self.__databaseVersion:
+				self.dbClose()
+				raise MyException('Database has to be upgraded before opening it read-only.', 2)
+			self.__beginSnapshot()
+			return
 		# if neither database file nor signature file exist, make a silent reset
 		if not os.path.exists(self.__databaseFile):
 			self.clear()
-#		checking of signature is now done on higher level
-#		if os.path.exists(self.__signatureFile):
-#			cs = Checksum()
-#			cs.calculateForFile(self.__databaseFile)
-#			if not cs.isValidUsingSavedFile(self.__signatureFile):
-#				raise MyException('The internal database has been corrupted.', 3)
+			return
+		# checking of signature is now done on higher level, see isSignatureValid()
 		self.dbOpen()
+		self.__upgrade()
+		# not before upgrading: switching the journal mode changes the file,
+		# older versions signed the whole file, see __upgrade(); the mode
+		# is persistent, so read-only connections use it as well
+		self.__dbcon.execute('pragma journal_mode=wal')
+		self.__createSignatureTriggers()
+		self.__createHistoryTriggers()
+		self.__createTreeHashTriggers()
+		self.__createVerificationTriggers()
+		# changes made by upgrading the database do not count as modifications
+		self.__numChangesAtOpen = self.__dbcon.total_changes
+		self.__numChangesAtCommit = self.__dbcon.total_changes
 
 	def isOpen(self):
 		return not self.__dbcon is None
 
 	def close(self):
-		if self.isOpen():
+		if self.isOpen() and self.__readonly:
+			self.dbClose()
+		elif self.isOpen():
+			# uncommitted changes are lost anyway, the signature
+			# has to match the contents of the database file
+			self.__dbcon.rollback()
+			if self.__dbcon.total_changes > self.__numChangesAtOpen or \
+				not os.path.exists(self.__signatureFile):
+				self.getSignature().saveToFile(self.__signatureFile)
 			self.dbClose()
-			cs = Checksum()
-			cs.calculateForFile(self.__databaseFile)
-			cs.saveToFile(self.__signatureFile)
 
 	def clear(self):
+		self.__checkWritable()
 		# close database
 		self.dbClose()
-		# delete files if existing
-		if os.path.exists(self.__databaseFile):
-			os.remove(self.__databaseFile)
+		ReaderConnectionPool.closeAll(self.__databaseFile)
+		# delete files if existing, including left-overs of the write-ahead log
+		for suffix in [ '', '-wal', '-shm' ]:
+			if os.path.exists(self.__databaseFile + suffix):
+				os.remove(self.__databaseFile + suffix)
 		if os.path.exists(self.__signatureFile):
 			os.remove(self.__signatureFile)
 		# create database
 		self.dbOpen()
 		self.__dbcon.execute('create table nodes (' + self.__databaseCreateString + ')')
-		self.__dbcon.execute('insert into nodes (name, isdir) values (\'<rootnode>\', 1)')
+		self.__dbcon.execute('insert into nodes (name, isdir, path, generation) ' + \
+			'values (\'<rootnode>\', 1, \'\', 0)')
 		self.__dbcon.execute('create index checksumindex on nodes (checksum)')
-		self.commit()
+		self.__dbcon.execute('create unique index pathindex on nodes (path)')
+		self.__dbcon.execute('create index generationindex on nodes (generation)')
+		self.__dbcon.execute(self.__databaseChildrenIndexString)
+		self.__dbcon.execute('create table signature (bucket integer primary key, digest blob)')
+		self.__createHistoryTables()
+		self.__createTreeHashTable()
+		self.__updateTreeHashes('1')
+		self.__createVerificationTable()
+		self.__createSignatureCheckTable()
+		self.__rebuildSignature()
+		self.__dbcon.execute('pragma user_version={0:d}'.format(self.__databaseVersion))
+		self.__dbcon.commit()
 		self.close()
 		# reopen
 		self.open()
@@ -145,72 +275,108 @@ class DatabaseTree(Tree):
 			return count
 
 	def insert(self, node):
+		self.__checkWritable()
 		if not node.dbkey is None:
 			raise MyException('Node already contains a valid node id, ' + \
 				'so maybe you want to update instead of insert?', 3)
 		cursor = self.__dbcon.cursor()
-		if node.isDirectory():
-			cursor.execute('insert into nodes (' + self.__databaseInsertVars + \
-				') values (' + self.__databaseInsertQMarks + ')', \
-				(self.getCurrentParentId(), node.name, True, None, \
-				None, None, None, None))
-		else:
-			cursor.execute('insert into nodes (' + self.__databaseInsertVars + \
-				') values (' + self.__databaseInsertQMarks + ')', \
-				(self.getCurrentParentId(), node.name, False, node.info.size, \
-				node.info.ctime, node.info.atime, node.info.mtime, \
-				node.info.checksum.getBinary()))
+		try:
+			if node.isDirectory():
+				cursor.execute('insert into nodes (' + self.__databaseInsertVars + \
+					') values (' + self.__databaseInsertQMarks + ')', \
+					(self.getCurrentParentId(), node.name, True, None, \
+					None, None, None, None, self.__getDbPath(node), self.__generation))
+			else:
+				cursor.execute('insert into nodes (' + self.__databaseInsertVars + \
+					') values (' + self.__databaseInsertQMarks + ')', \
+					(self.getCurrentParentId(), node.name, False, node.info.size, \
+					node.info.ctime, node.info.atime, node.info.mtime, \
+					node.info.checksum.getBinary(), self.__getDbPath(node), self.__generation))
+		except sqlite3.IntegrityError:
+			cursor.close()
+			raise MyException('Node \'' + self.__getDbPath(node) + '\' already exists.', 3)
 		node.dbkey = cursor.lastrowid
 		cursor.close()
 		# insert info buffer
-		if self.__useBuffer:
+		if self.__buffer is not None:
 			self.__buffer[node.getNid()] = node
 
 	def update(self, node):
+		self.__checkWritable()
 		if node.dbkey is None:
 			raise MyException('Node does not contain a valid node id, ' + \
 				'so maybe you want to insert instead of update?', 3)
+		path = self.__getDbPath(node)
 		if node.isDirectory():
+			# if the directory moved, move the paths of all its descendants, too
+			cursor = self.__dbcon.cursor()
+			cursor.execute('select path from nodes where nodekey=?', (node.dbkey,))
+			oldpath = cursor.fetchone()[0]
+			cursor.close()
+			if not oldpath == path:
+				self.__moveDescendants(oldpath, path)
 			self.__dbcon.execute('update nodes set ' + self.__databaseUpdateString + \
 				' where nodekey=?', \
 				(self.getCurrentParentId(), node.name, True, None, \
-				None, None, None, None, node.dbkey))
+				None, None, None, None, path, self.__generation, node.dbkey))
 		else:
 			self.__dbcon.execute('update nodes set ' + self.__databaseUpdateString + \
 				' where nodekey=?', \
 				(self.getCurrentParentId(), node.name, False, node.info.size, \
 				node.info.ctime, node.info.atime, node.info.mtime, \
-				node.info.checksum.getBinary(), node.dbkey))
+				node.info.checksum.getBinary(), path, self.__generation, node.dbkey))
 		# update buffer
-		if self.__useBuffer:
+		if self.__buffer is not None:
 			self.__buffer[node.getNid()] = node
 
 	def delete(self, node):
+		self.__checkWritable()
 		if not self.isChildless(node):
 			raise MyException('Deleting the non-empty directory \'' + node.name + '\'.', 1)
 		self.__dbcon.execute('delete from nodes where parentkey=? and name=? and isdir=?', \
 			(self.getCurrentParentId(), node.name, node.isDirectory()))
 		# remove from buffer
-		if self.__useBuffer:
+		if self.__buffer is not None:
 			del self.__buffer[node.getNid()]
 
 	def commit(self):
+		self.__checkWritable()
+		self.__updateTreeHashes('nodekey in (select nodekey from dirtydirectories)')
+		self.__dbcon.execute('delete from dirtydirectories')
+		# each commit containing changes creates a new generation, a commit
+		# of bookkeeping only (see setVerified()) does not
+		isChanged = self.__dbcon.total_changes > self.__numChangesAtCommit
+		if isChanged:
+			self.__dbcon.execute('insert into generations (generation, time) values (?,?)', \
+				(self.__generation, int(time.time() * 10**9)))
+			self.__setGeneration(self.__generation + 1)
 		self.__dbcon.commit()
-		self.__dbcon.execute('vacuum')
+		self.__numChangesAtCommit = self.__dbcon.total_changes
+
+	def compact(self):
+		# the database file does not shrink when rows are deleted, the free
+		# pages are used again instead; rebuilding the file takes about as
+		# long as copying it, so it is an explicit action and not part of
+		# each commit
+		self.commit()
+		try:
+			self.__dbcon.execute('vacuum')
+		except sqlite3.OperationalError:
+			raise MyException('Database is in use, compacting it is not possible now.', 2)
 
 	def exists(self, nid):
-		if self.__useBuffer:
+		if self.__buffer is not None:
 			return nid in self.__buffer
 		else:
 			cursor = self.__dbcon.cursor()
 			cursor.execute('select nodekey from nodes where parentkey=? and name=? and isdir=?', \
 				(self.getCurrentParentId(), Node.nid2Name(nid), Node.nid2IsDirectory(nid)))
-			result = cursor.fetchone() == None
+			result = cursor.fetchone() is not None
 			cursor.close()
 			return result
 
 	def getNodeByNid(self, nid):
-		if self.__useBuffer:
+		if self.__buffer is not None:
 			if self.exists(nid):
 				return self.__buffer[nid]
 			else:
@@ -228,13 +394,16 @@ class DatabaseTree(Tree):
 			return node
 
 	def __iter__(self):
-		if self.__useBuffer:
+		if self.__buffer is not None:
 			for nid in sorted(self.__buffer.keys()):
 				yield self.__buffer[nid]
 		else:
+			# the order of the children index is the NID order: directories
+			# first, then names in order of their code points
 			cursor = self.__dbcon.cursor()
 			cursor.execute('select ' + self.__databaseSelectString + \
-				' from nodes where parentkey=?', (self.getCurrentParentId(),))
+				' from nodes where parentkey=? order by isdir desc, name', \
+				(self.getCurrentParentId(),))
 			for row in cursor:
 				yield self.__fetch(row)
 			cursor.close()
@@ -245,85 +414,1090 @@ class DatabaseTree(Tree):
 			if self.signalNewFile is not None:
 				self.signalNewFile(self.getPath(node), 0)
 		else:
+			# sizes of imported checksums may be unknown
+			size = node.info.size
+			if size is None:
+				size = 0
 			if self.signalNewFile is not None:
-				self.signalNewFile(self.getPath(node), node.info.size)
+				self.signalNewFile(self.getPath(node), size)
 			if self.signalBytesDone is not None:
-				self.signalBytesDone(node.info.size)
+				self.signalBytesDone(size)
 
 	def globalChecksumExists(self, checksumString):
-		return self.globalChecksumNumberOfOccurrences(checksumString) == 0
+		return self.globalChecksumNumberOfOccurrences(checksumString) > 0
 
 	def globalChecksumNumberOfOccurrences(self, checksumString):
+		condition, params = self.__getChecksumCondition(checksumString)
 		cursor = self.__dbcon.cursor()
-		cursor.execute('select count(nodekey) from nodes where checksum=X\'{0:s}\''.format(checksumString))
+		cursor.execute('select count(nodekey) from nodes where ' + condition, params)
 		count = cursor.fetchone()[0]
 		cursor.close()
 		return count
 
 	def globalGetPathsByChecksum(self, checksumString):
+		condition, params = self.__getChecksumCondition(checksumString)
 		result = set()
 		cursor = self.__dbcon.cursor()
-		cursor.execute('select nodekey from nodes where checksum=X\'{0:s}\''.format(checksumString))
+		cursor.execute('select path from nodes where ' + condition, params)
+		for row in cursor:
+			result.add(self.__fromDbPath(row[0]))
+		cursor.close()
+		return result
+
+	def globalGetChecksumsByPrefix(self, prefix, limit=None):
+		condition, params = self.__getChecksumCondition(prefix, True)
+		if limit is not None:
+			condition += ' limit {0:d}'.format(limit)
+		result = []
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select distinct checksum from nodes where ' + condition, params)
 		for row in cursor:
-			result.add(self.IdToPath(row[0]))
+			csum = Checksum()
+			csum.setBinary(row[0])
+			result.append(csum.getString())
+		cursor.close()
+		return result
+
+	def getFactory(self):
+		return (DatabaseTree, (self.__databaseFile, self.__signatureFile, self.__readonly))
+
+	def globalGetPathsByChecksums(self, checksumStrings):
+		# a single indexed query for each chunk of checksums
+		result = {}
+		checksums = [ buffer(csumstr.decode('hex')) for csumstr in checksumStrings ]
+		chunksize = 500
+		cursor = self.__dbcon.cursor()
+		for i in range(0, len(checksums), chunksize):
+			chunk = checksums[i:i+chunksize]
+			cursor.execute('select checksum, path from nodes where checksum in (' + \
+				(len(chunk)-1) * '?,' + '?)', chunk)
+			for row in cursor:
+				result.setdefault(str(row[0]).encode('hex'), set()).add( \
+					self.__fromDbPath(row[1]))
+		cursor.close()
+		return result
+
+	def moveByPath(self, path, newpath, isdir):
+		# moving is a metadata update of the node's row (and the paths of
+		# its descendants), checksums and history are kept; the parent
+		# directory of the new path has to exist
+		self.__checkWritable()
+		node = self.getNodeByPath(path, isdir)
+		if node is None:
+			raise MyException('Cannot move \'' + path + '\', it does not exist.', 3)
+		if self.getNodeByPath(newpath, isdir) is not None:
+			raise MyException('Cannot move \'' + path + '\' to \'' + newpath + \
+				'\', destination already exists.', 1)
+		parentpath, name = os.path.split(newpath)
+		if parentpath == '':
+			parentkey = self.getRootId()
+		else:
+			parent = self.getNodeByPath(parentpath, True)
+			if parent is None:
+				return False
+			parentkey = parent.dbkey
+		if isdir:
+			self.__moveDescendants(self.__toDbPath(path), self.__toDbPath(newpath))
+		self.__dbcon.execute('update nodes set parentkey=?, name=?, path=?, generation=? ' + \
+			'where nodekey=?', (parentkey, name, self.__toDbPath(newpath), \
+			self.__generation, node.dbkey))
+		if self.__useBuffer:
+			self.readCurrentDir()
+		return True
+
+	def applyChanges(self, deleted, updated, inserted):
+		# the rows are addressed by the path index, so the deletions and
+		# updates are a single statement each, executed for all rows in the
+		# same transaction; inserted rows are imported in batches
+		self.__checkWritable()
+		cursor = self.__dbcon.cursor()
+		cursor.executemany('delete from nodes where path=? and isdir=?', \
+			((self.__toDbPath(row[0]), row[1]) for row in self.__signalRows(deleted)))
+		cursor.executemany('update nodes set size=?, ctime=?, atime=?, mtime=?, ' + \
+			'checksum=?, generation=? where path=? and isdir=0', \
+			(tuple(row[2:7]) + (self.__generation, self.__toDbPath(row[0])) \
+			for row in self.__signalRows(updated)))
+		cursor.close()
+		# inserted rows are new nodes: no need to look for existing ones
+		self.__importRows(((self.__toDbPath(row[0]),) + tuple(row[1:]) \
+			for row in self.__signalRows(inserted)), False)
+
+	def getTreeHash(self, node):
+		# hashes of directories are updated when committing, so they are
+		# unknown as long as there are uncommitted changes
+		if not self.__readonly:
+			cursor = self.__dbcon.cursor()
+			cursor.execute('select nodekey from dirtydirectories limit 1')
+			dirty = cursor.fetchone() is not None
+			cursor.close()
+			if dirty:
+				return None
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select treehash from treehashes where nodekey=?', (node.dbkey,))
+		row = cursor.fetchone()
 		cursor.close()
+		if row is None:
+			return None
+		result = Checksum()
+		result.setBinary(row[0])
 		return result
 
 	### the following methods are not implementations of base class methods
 
+	def getSignature(self):
+		# digest over all non-empty bucket sums, this is cheap because
+		# the number of buckets is small compared to the number of nodes
+		zero = self.__signatureDigestSize * '\0'
+		checksum = hashlib.sha256()
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select bucket, digest from signature order by bucket')
+		for row in cursor:
+			if not str(row[1]) == zero:
+				checksum.update(struct.pack('>q', row[0]))
+				checksum.update(row[1])
+		cursor.close()
+		result = Checksum()
+		result.setBinary(buffer(checksum.digest()))
+		return result
+
+	def isSignatureValid(self, full=False):
+		# the signature file only covers the bucket sums stored in the
+		# database: the sums of some buckets (of all buckets if full) are
+		# recalculated from their rows as well
+		if not self.getSignature().isValidUsingSavedFile(self.__signatureFile):
+			return False
+		if full:
+			buckets = self.getSignatureBuckets()
+		else:
+			buckets = self.__getSignatureCheckBuckets()
+		if len(self.verifySignature(buckets)) > 0:
+			return False
+		self.__setSignatureChecked(buckets)
+		return True
+
+	def getSignatureBuckets(self):
+		result = []
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select bucket from signature order by bucket')
+		for row in cursor:
+			result.append(row[0])
+		cursor.close()
+		return result
+
+	def verifySignature(self, buckets=None):
+		# recalculate the sums of the given buckets (default: all buckets)
+		# from the rows and return the list of buckets not matching their
+		# stored sums; use getSignatureBuckets() to verify the database in
+		# parts by passing different subsets of buckets
+		if buckets is None:
+			buckets = self.getSignatureBuckets()
+		result = []
+		cursor = self.__dbcon.cursor()
+		for bucket in buckets:
+			cursor.execute('select digest from signature where bucket=?', (bucket,))
+			row = cursor.fetchone()
+			if row is None:
+				stored = self.__signatureDigestSize * '\0'
+			else:
+				stored = str(row[0])
+			digest = self.__signatureDigestSize * '\0'
+			for table, varnames in self.__signatureTables:
+				cursor.execute('select rowdigest(' + ','.join(varnames) + \
+					') from ' + table + ' where nodekey between ? and ?', \
+					(bucket * self.__signatureBucketSize, \
+					(bucket + 1) * self.__signatureBucketSize - 1))
+				for row in cursor:
+					digest = DatabaseTree.__digestAdd(digest, row[0])
+			if not str(digest) == stored:
+				result.append(bucket)
+		cursor.close()
+		return result
+
+	def __getSignatureCheckBuckets(self):
+		# the buckets checked longest ago, never checked ones first
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select count(bucket) from signature')
+		count = cursor.fetchone()[0]
+		limit = max(self.__signatureCheckMinBuckets, \
+			(count + self.__signatureCheckFraction - 1) // self.__signatureCheckFraction)
+		cursor.execute('select s.bucket from signature s ' + \
+			'left join signaturechecks c on c.bucket=s.bucket ' + \
+			'order by coalesce(c.time, 0), s.bucket limit ?', (limit,))
+		result = [ row[0] for row in cursor ]
+		cursor.close()
+		return result
+
+	def __setSignatureChecked(self, buckets):
+		# bookkeeping only, like setVerified(); uncommitted changes must not
+		# be committed along with it
+		checked = int(time.time() * 10**9)
+		sql = 'insert or replace into signaturechecks (bucket, time) values (?,?)'
+		rows = [ (bucket, checked) for bucket in buckets ]
+		if self.__readonly:
+			# the snapshot cannot be written, a short connection of its own
+			# stores the checks unless another writer holds the database:
+			# then the same buckets are just checked again next time
+			try:
+				dbcon = sqlite3.connect(self.__databaseFile, timeout=0)
+				try:
+					dbcon.executemany(sql, rows)
+					dbcon.commit()
+				finally:
+					dbcon.close()
+			except sqlite3.OperationalError:
+				pass
+			return
+		if self.__dbcon.total_changes > self.__numChangesAtCommit:
+			return
+		numChanges = self.__dbcon.total_changes
+		self.__dbcon.executemany(sql, rows)
+		self.__dbcon.commit()
+		numChanges = self.__dbcon.total_changes - numChanges
+		self.__numChangesAtOpen += numChanges
+		self.__numChangesAtCommit += numChanges
+
+	def getGenerations(self):
+		# list of (generation, time of commit) of all committed generations
+		result = []
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select generation, time from generations order by generation')
+		for row in cursor:
+			result.append((row[0], row[1]))
+		cursor.close()
+		return result
+
+	def getLastGeneration(self):
+		return self.__generation - 1
+
+	def diffGenerations(self, oldgen, newgen=None):
+		# Get list of (path, old node, new node) of all nodes changed between
+		# two generations (default for new generation is the last one),
+		# old node or new node are None for nodes not existing in that
+		# generation. Only the rows written between the two generations are
+		# looked at, so the cost depends on the number of changes only.
+		if newgen is None:
+			newgen = self.getLastGeneration()
+		generations = [ g for g, t in self.getGenerations() ]
+		if not (oldgen in generations and newgen in generations):
+			raise MyException('Unknown generation.', 2)
+		if oldgen > newgen:
+			oldgen, newgen = newgen, oldgen
+		cursor = self.__dbcon.cursor()
+		# rows written or replaced between the generations
+		cursor.execute('select nodekey from nodes where generation>? and generation<=? ' + \
+			'union select nodekey from history where generation>? and generation<=? ' + \
+			'union select nodekey from history where superseded>? and superseded<=?', \
+			(oldgen, newgen, oldgen, newgen, oldgen, newgen))
+		nodekeys = [ row[0] for row in cursor ]
+		cursor.close()
+		oldrows = self.__getRowsAtGeneration(nodekeys, oldgen)
+		newrows = self.__getRowsAtGeneration(nodekeys, newgen)
+		result = []
+		for nodekey in nodekeys:
+			oldrow = oldrows.get(nodekey)
+			newrow = newrows.get(nodekey)
+			# rows written with the same contents did not change
+			if oldrow is not None and newrow is not None and \
+				oldrow[:-1] == newrow[:-1]:
+				continue
+			if newrow is not None:
+				path = newrow[-2]
+			else:
+				path = oldrow[-2]
+			result.append((self.__fromDbPath(path), \
+				None if oldrow is None else self.__fetch(oldrow), \
+				None if newrow is None else self.__fetch(newrow)))
+		return sorted(result, key=lambda x: x[0])
+
+	def deleteGenerationsBefore(self, generation):
+		# forget the history before a generation, the generation itself
+		# and all later ones can still be compared
+		self.__checkWritable()
+		self.__dbcon.execute('delete from history where superseded<=?', (generation,))
+		self.__dbcon.execute('delete from generations where generation<?', (generation,))
+
+	def getVerificationCandidates(self, before, limit):
+		# list of (time of last verification, path, node) of the files whose
+		# last verification is oldest and before the given time, at most
+		# limit files; time 0 means never verified, see setVerified()
+		result = []
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select v.time, ' + \
+			','.join([ 'n.' + s for s in self.__databaseVarNames ]) + \
+			' from verifications v join nodes n on n.nodekey=v.nodekey ' + \
+			'where v.time<? order by v.time, v.nodekey limit ?', (before, limit))
+		for row in cursor:
+			result.append((row[0], self.__fromDbPath(row[-2]), self.__fetch(row[1:])))
+		cursor.close()
+		return result
+
+	def getVerificationSizes(self, before):
+		# (time of last verification, path, size) of all files verified before
+		# the given time in the order of getVerificationCandidates(), without
+		# fetching the nodes, see Scrubber.select()
+		cursor = self.__dbcon.cursor()
+		try:
+			cursor.execute('select v.time, n.path, n.size from verifications v ' + \
+				'join nodes n on n.nodekey=v.nodekey where v.time<? ' + \
+				'order by v.time, v.nodekey', (before,))
+			for row in cursor:
+				yield (row[0], self.__fromDbPath(row[1]), row[2])
+		finally:
+			cursor.close()
+
+	def setVerified(self, paths, verified):
+		# store the time the files of the paths have been found to match
+		# the database; this is bookkeeping only, it neither creates a new
+		# generation nor changes the signature (see commit() and close())
+		self.__checkWritable()
+		numChanges = self.__dbcon.total_changes
+		self.__dbcon.executemany('update verifications set time=? where nodekey=' + \
+			'(select nodekey from nodes where path=? and isdir=0)', \
+			[ (verified, self.__toDbPath(path)) for path in paths ])
+		numChanges = self.__dbcon.total_changes - numChanges
+		self.__numChangesAtOpen += numChanges
+		self.__numChangesAtCommit += numChanges
+
 	def dbOpen(self):
-		self.__dbcon = sqlite3.connect(self.__databaseFile, \
-			# necessary for proper retrival of datetime objects from the database,
-			# otherwise the cursor will return string values with the timestamps
-			detect_types=sqlite3.PARSE_DECLTYPES)
+		self.__rootId = None
+		self.__numChangesAtOpen = 0
+		if self.__readonly:
+			self.__dbcon = ReaderConnectionPool.acquire(self.__databaseFile)
+		else:
+			# timestamps are stored as integers, so there is no need for
+			# parsing declared types when fetching rows; write-ahead logging
+			# is switched on when opening the tree, see open()
+			self.__dbcon = sqlite3.connect(self.__databaseFile)
+		self.__dbcon.create_function('rowdigest', -1, DatabaseTree.__rowDigest)
+		self.__dbcon.create_function('digestadd', 2, DatabaseTree.__digestAdd)
+		self.__dbcon.create_function('digestsub', 2, DatabaseTree.__digestSub)
 
 	def dbClose(self):
 		if self.__dbcon is not None:
-			self.__dbcon.close()
+			if self.__readonly:
+				ReaderConnectionPool.release(self.__databaseFile, self.__dbcon)
+			else:
+				self.__dbcon.close()
 			self.__dbcon = None
+		self.__rootId = None
+
+	def isReadOnly(self):
+		return self.__readonly
+
+	def createReader(self):
+		# read-only tree of the committed state of this database
+		return DatabaseTree(self.__databaseFile, self.__signatureFile, True)
+
+	def refresh(self):
+		# read-only trees: move snapshot to the current state of the database
+		if self.__readonly:
+			self.__dbcon.execute('rollback')
+			self.__beginSnapshot()
+			if self.__useBuffer:
+				self.readCurrentDir()
+
+	def __beginSnapshot(self):
+		# the snapshot is taken with the first read of the transaction;
+		# its last generation is the one of the last commit before
+		self.__dbcon.execute('begin')
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select max(generation) from generations')
+		self.__generation = cursor.fetchone()[0] + 1
+		cursor.close()
+
+	def __checkWritable(self):
+		if self.__readonly:
+			raise MyException('Database has been opened read-only.', 3)
+
+	def __getDatabaseVersion(self):
+		cursor = self.__dbcon.cursor()
+		cursor.execute('pragma user_version')
+		version = cursor.fetchone()[0]
+		cursor.close()
+		return version
 
 	def getCurrentParentId(self):
 		return self.__parentKeyStack[-1]
 
 	def getRootId(self):
+		# the root node never changes while the database is open
+		if self.__rootId is None:
+			cursor = self.__dbcon.cursor()
+			cursor.execute('select nodekey from nodes where parentkey is null')
+			self.__rootId = cursor.fetchone()[0]
+			cursor.close()
+		return self.__rootId
+
+	def getNodeByPath(self, path, isdir=None):
+		# direct access to any node using its path relative to the root
+		# directory, no matter what the current directory of the tree is
+		if isdir is None:
+			condition = ''
+			params = (self.__toDbPath(path),)
+		else:
+			condition = ' and isdir=?'
+			params = (self.__toDbPath(path), isdir)
 		cursor = self.__dbcon.cursor()
-		cursor.execute('select nodekey from nodes where parentkey is null')
-		result = cursor.fetchone()[0]
+		cursor.execute('select ' + self.__databaseSelectString + \
+			' from nodes where path=? and parentkey is not null' + condition, params)
+		row = cursor.fetchone()
+		cursor.close()
+		if row is None:
+			return None
+		return self.__fetch(row)
+
+	def getRowsByPath(self, path, isdir):
+		# rows (path, isdir, size, ctime, atime, mtime, binary checksum) of a
+		# node and all its descendants, see Tree.applyChanges(), sorted by
+		# path: directories before their descendants; the empty path is the
+		# root directory, it has no row itself
+		if path == '':
+			condition = 'parentkey is not null'
+			params = ()
+		elif isdir:
+			prefix = self.__toDbPath(path) + self.__databasePathSep
+			condition = '(path=? and isdir=1) or substr(path, 1, ?)=?'
+			params = (self.__toDbPath(path), len(prefix), prefix)
+		else:
+			condition = 'path=? and isdir=0'
+			params = (self.__toDbPath(path),)
+		result = []
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select path, isdir, size, ctime, atime, mtime, checksum ' + \
+			'from nodes where ' + condition + ' order by path', params)
+		for row in cursor:
+			result.append((self.__fromDbPath(row[0]), bool(row[1])) + tuple(row[2:]))
 		cursor.close()
 		return result
 
-	def IdToPath(self, nodeid):
-		rootid = self.getRootId()
-		currentid = nodeid
-		namelist = []
-		while not currentid == rootid:
-			cursor = self.__dbcon.cursor()
-			cursor.execute('select name,parentkey from nodes where nodekey=?', (currentid,))
+	def exportSha256Sums(self):
+		# lines of all files in the format of sha256sum, sorted by path;
+		# like sha256sum, lines of paths containing backslashes, line feeds
+		# or carriage returns are escaped and start with a backslash
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select checksum, path from nodes where isdir=0 order by path')
+		for row in cursor:
+			path = row[1].encode('utf-8')
+			if '\\' in path or '\n' in path or '\r' in path:
+				path = path.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r')
+				yield '\\' + str(row[0]).encode('hex') + '  ' + path + '\n'
+			else:
+				yield str(row[0]).encode('hex') + '  ' + path + '\n'
+		cursor.close()
+
+	def importSha256Sums(self, lines, fstree=None):
+		# seed the database with the checksums of lines in the format of
+		# sha256sum (text, binary or BSD style) without calculating them;
+		# sizes and timestamps are taken from the files of the filesystem
+		# tree if given and otherwise unknown; call commit() afterwards
+		self.__importRows(self.__parseSha256Sums(lines, fstree))
+
+	def exportXml(self):
+		# lines of an XML document containing all nodes, sorted by path
+		yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+		yield '<treeseal version="1">\n'
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select isdir, path, size, ctime, atime, mtime, checksum ' + \
+			'from nodes where parentkey is not null order by path')
+		for row in cursor:
+			if row[0]:
+				yield '\t<dir path=' + quoteattr(row[1]).encode('utf-8') + '/>\n'
+				continue
+			line = '\t<file path=' + quoteattr(row[1]).encode('utf-8')
+			for name, value in zip([ 'size', 'ctime', 'atime', 'mtime' ], row[2:6]):
+				if value is not None:
+					line += ' {0:s}="{1:d}"'.format(name, value)
+			yield line + ' checksum="' + str(row[6]).encode('hex') + '"/>\n'
+		cursor.close()
+		yield '</treeseal>\n'
+
+	def importXml(self, xmlfile):
+		# seed the database with the nodes of an XML document created by
+		# exportXml(); call commit() afterwards
+		self.__importRows(self.__parseXml(xmlfile))
+
+	def __parseSha256Sums(self, lines, fstree):
+		for line in lines:
+			if isinstance(line, unicode):
+				line = line.encode('utf-8')
+			line = line.rstrip('\r\n')
+			if line == '':
+				continue
+			escaped = line.startswith('\\')
+			if escaped:
+				line = line[1:]
+			match = re.match('^([0-9a-fA-F]+) [ *](.+)$', line)
+			if match is not None:
+				csumstr, path = match.groups()
+			else:
+				match = re.match('^SHA256 ?\\((.+)\\) ?= ?([0-9a-fA-F]+)$', line)
+				if match is None:
+					raise MyException('Invalid line \'' + line + '\' in checksum file.', 2)
+				path, csumstr = match.groups()
+			if not len(csumstr) == 64:
+				raise MyException('Only SHA-256 checksums can be imported, line \'' + line + '\'.', 2)
+			if escaped:
+				path = re.sub('\\\\([\\\\nr])', \
+					lambda m: { 'n' : '\n', 'r' : '\r', '\\' : '\\' }[m.group(1)], path)
+			path = self.__normalizeImportPath(path.decode('utf-8'))
+			info = None
+			if fstree is not None:
+				info = fstree.getNodeInfoByPath(self.__fromDbPath(path))
+			if info is None:
+				info = NodeInfo()
+			yield (path, False, info.size, info.ctime, info.atime, info.mtime, \
+				buffer(csumstr.lower().decode('hex')))
+
+	def __parseXml(self, xmlfile):
+		# the root element is cleared after each node to keep memory constant
+		root = None
+		for event, elem in ElementTree.iterparse(xmlfile, events=('start', 'end')):
+			if root is None:
+				root = elem
+				if not root.tag == 'treeseal':
+					raise MyException('XML file is no treeseal file.', 2)
+			if not event == 'end' or elem is root:
+				continue
+			path = self.__normalizeImportPath(elem.get('path'))
+			if elem.tag == 'dir':
+				yield (path, True, None, None, None, None, None)
+			elif elem.tag == 'file':
+				values = []
+				for name in [ 'size', 'ctime', 'atime', 'mtime' ]:
+					if elem.get(name) is None:
+						values.append(None)
+					else:
+						values.append(int(elem.get(name)))
+				yield tuple([ path, False ] + values + \
+					[ buffer(elem.get('checksum').decode('hex')) ])
+			root.clear()
+
+	def __normalizeImportPath(self, path):
+		if path is None:
+			raise MyException('Imported node without path.', 2)
+		path = unicode(path)
+		while path.startswith('./'):
+			path = path[2:]
+		names = path.split(self.__databasePathSep)
+		if path.startswith(self.__databasePathSep) or '..' in names or '' in names:
+			raise MyException('Invalid path \'' + path + '\' for import.', 2)
+		return path
+
+	def __importRows(self, rows, checkExisting=True):
+		# insert rows (path, isdir, size, ctime, atime, mtime, checksum)
+		# in batches; only the directories are kept in memory, the number
+		# of files does not matter; without checking for existing nodes,
+		# the nodes of the rows must not exist, their directories are
+		# inserted and all files are inserted without further queries
+		self.__checkWritable()
+		batchsize = 10000
+		dirkeys = { u'' : self.getRootId() }
+		batch = []
+		batchpaths = set()
+		cursor = self.__dbcon.cursor()
+		try:
+			for path, isdir, size, ctime, atime, mtime, checksum in rows:
+				if isdir:
+					self.__importDirectory(cursor, dirkeys, path, checkExisting)
+					continue
+				parentpath, sep, name = path.rpartition(self.__databasePathSep)
+				parentkey = self.__importDirectory(cursor, dirkeys, parentpath)
+				if path in batchpaths:
+					raise MyException('Imported file \'' + path + '\' already exists.', 2)
+				if checkExisting:
+					cursor.execute('select nodekey from nodes where path=? and isdir=0', (path,))
+					if cursor.fetchone() is not None:
+						raise MyException('Imported file \'' + path + '\' already exists.', 2)
+				batch.append((parentkey, name, False, size, ctime, atime, mtime, \
+					checksum, path, self.__generation))
+				batchpaths.add(path)
+				if len(batch) >= batchsize:
+					self.__importBatch(cursor, batch)
+					batch = []
+					batchpaths = set()
+			self.__importBatch(cursor, batch)
+		except sqlite3.IntegrityError:
+			# the unique path index rejects nodes that already exist,
+			# e.g. when applying changes that are out of date
+			raise MyException('Imported or changed nodes already exist in the database.', 3)
+		finally:
+			cursor.close()
+		if self.__useBuffer:
+			self.readCurrentDir()
+
+	def __signalRows(self, rows):
+		# each change is signalled like a directory, see Tree.applyChanges()
+		for row in rows:
+			if self.signalNewFile is not None:
+				self.signalNewFile(row[0], 0)
+			yield row
+
+	def __importBatch(self, cursor, batch):
+		cursor.executemany('insert into nodes (' + self.__databaseInsertVars + \
+			') values (' + self.__databaseInsertQMarks + ')', batch)
+
+	def __importDirectory(self, cursor, dirkeys, path, checkExisting=True):
+		# key of a directory, inserting it and its parents if necessary
+		if path in dirkeys:
+			return dirkeys[path]
+		parentpath, sep, name = path.rpartition(self.__databasePathSep)
+		parentkey = self.__importDirectory(cursor, dirkeys, parentpath)
+		row = None
+		if checkExisting:
+			cursor.execute('select nodekey from nodes where path=? and isdir=1', (path,))
 			row = cursor.fetchone()
-			namelist.append(row[0])
-			currentid = row[1]
+		if row is not None:
+			dirkeys[path] = row[0]
+		else:
+			cursor.execute('insert into nodes (' + self.__databaseInsertVars + \
+				') values (' + self.__databaseInsertQMarks + ')', \
+				(parentkey, name, True, None, None, None, None, None, path, self.__generation))
+			dirkeys[path] = cursor.lastrowid
+		return dirkeys[path]
+
+	def __getChecksumCondition(self, checksumString, ordered=False):
+		# abbreviated checksums are looked up as a range of the checksum
+		# index, this way they are as fast as complete checksums
+		low, high = Checksum.prefixToBinaryRange(checksumString)
+		if len(low) == 32:
+			condition = 'checksum=?'
+			params = (low,)
+		elif high is None:
+			condition = 'checksum>=?'
+			params = (low,)
+		else:
+			condition = 'checksum>=? and checksum<?'
+			params = (low, high)
+		if ordered:
+			condition += ' order by checksum'
+		return condition, params
+
+	def __moveDescendants(self, oldpath, path):
+		# replace the path prefix of all descendants of a moved directory
+		oldprefix = oldpath + self.__databasePathSep
+		self.__dbcon.execute('update nodes set path=? || substr(path, ?), generation=? ' + \
+			'where substr(path, 1, ?)=?', \
+			(path + self.__databasePathSep, len(oldprefix) + 1, \
+			self.__generation, len(oldprefix), oldprefix))
+
+	def __getDbPath(self, node):
+		return self.__toDbPath(self.getPath(node))
+
+	def __toDbPath(self, path):
+		return path.replace(os.path.sep, self.__databasePathSep)
+
+	def __fromDbPath(self, path):
+		return path.replace(self.__databasePathSep, os.path.sep)
+
+	def __resolvePaths(self, condition, params):
+		# Resolve the paths of all nodes matching the condition in a single
+		# query: the recursive common table expression walks from each node
+		# up to the root, prepending the parent names on the way. A walk is
+		# complete once it has reached a direct child of the root node.
+		result = {}
+		cursor = self.__dbcon.cursor()
+		cursor.execute('with recursive ancestors(nodekey, parentkey, path) as (' + \
+			'select nodekey, parentkey, name from nodes where ' + condition + \
+			' union all ' + \
+			'select a.nodekey, n.parentkey, n.name || ? || a.path ' + \
+			'from ancestors a join nodes n on n.nodekey=a.parentkey ' + \
+			'where n.parentkey is not null' + \
+			') select nodekey, path from ancestors where parentkey=?', \
+			tuple(params) + (self.__databasePathSep, self.getRootId()))
+		for row in cursor:
+			result[row[0]] = row[1]
+		cursor.close()
+		return result
+
+	def __upgrade(self):
+		version = self.__getDatabaseVersion()
+		if version == self.__databaseVersion:
+			return
+		if version > self.__databaseVersion:
+			raise MyException('Database has been created by a newer version of this program.', 3)
+		# the signature is only renewed after the upgrade if the old one is still valid
+		if not os.path.exists(self.__signatureFile):
+			signatureValid = False
+		elif version < 2:
+			# older versions signed the whole database file
+			cs = Checksum()
+			cs.calculateForFile(self.__databaseFile)
+			signatureValid = cs.isValidUsingSavedFile(self.__signatureFile)
+		elif version < 6:
+			# the rows of these versions do not match the signed tables and
+			# columns anymore, only the bucket sums can be checked
+			signatureValid = self.getSignature().isValidUsingSavedFile(self.__signatureFile)
+		else:
+			# the signature is rebuilt from the rows: all of them must match
+			signatureValid = \
+				self.getSignature().isValidUsingSavedFile(self.__signatureFile) and \
+				len(self.verifySignature()) == 0
+		if version < 1:
+			# materialized path of each node
+			self.__dbcon.execute('alter table nodes add column path text')
+			self.__dbcon.executemany('update nodes set path=? where nodekey=?', \
+				[ (path, nodekey) for nodekey, path in \
+				self.__resolvePaths('parentkey is not null', ()).iteritems() ])
+			self.__dbcon.execute('update nodes set path=\'\' where parentkey is null')
+			self.__dbcon.execute('create index pathindex on nodes (path)')
+		if version < 2:
+			# incrementally maintained signature
+			self.__dbcon.execute('create table signature (bucket integer primary key, digest blob)')
+		if version < 3:
+			# timestamps as integer nanoseconds instead of datetime strings in local time
+			cursor = self.__dbcon.cursor()
+			cursor.execute('select nodekey, ctime, atime, mtime from nodes where isdir=0')
+			rows = cursor.fetchall()
 			cursor.close()
-		return reduce(lambda x, y: os.path.join(x, y), reversed(namelist))
+			self.__dbcon.executemany('update nodes set ctime=?, atime=?, mtime=? where nodekey=?', \
+				[ (DatabaseTree.__datetimeStringToTimestamp(row[1]), \
+				DatabaseTree.__datetimeStringToTimestamp(row[2]), \
+				DatabaseTree.__datetimeStringToTimestamp(row[3]), row[0]) for row in rows ])
+		if version < 4:
+			# generations and history of rows
+			self.__dbcon.execute('alter table nodes add column generation integer')
+			self.__dbcon.execute('update nodes set generation=0')
+			self.__dbcon.execute('create index generationindex on nodes (generation)')
+			self.__createHistoryTables()
+		if version < 5:
+			# children of a directory in NID order
+			self.__dbcon.execute(self.__databaseChildrenIndexString)
+		if version < 6:
+			# hashes of directories
+			self.__createTreeHashTable()
+			self.__updateTreeHashes('1')
+		if version < 7:
+			# times of the last verification of files, see scrub.py
+			self.__createVerificationTable()
+		if version < 8:
+			# times of the last check of signature buckets, see isSignatureValid()
+			self.__createSignatureCheckTable()
+		if version < 9:
+			# paths are unique, inserting an existing node fails
+			self.__dbcon.execute('drop index if exists pathindex')
+			try:
+				self.__dbcon.execute('create unique index pathindex on nodes (path)')
+			except sqlite3.IntegrityError:
+				raise MyException('Database contains several nodes with the same path.', 3)
+		# row contents may have changed: recalculate signature
+		self.__rebuildSignature()
+		self.__dbcon.execute('pragma user_version={0:d}'.format(self.__databaseVersion))
+		self.__dbcon.commit()
+		if signatureValid:
+			self.getSignature().saveToFile(self.__signatureFile)
+
+	def __getRowsAtGeneration(self, nodekeys, generation):
+		# the versions of a row are valid in disjoint intervals of generations:
+		# [generation, superseded) for history rows, [generation, ...) for node rows
+		result = {}
+		cursor = self.__dbcon.cursor()
+		chunksize = 500
+		for i in range(0, len(nodekeys), chunksize):
+			chunk = nodekeys[i:i+chunksize]
+			keys = '(' + (len(chunk)-1) * '?,' + '?)'
+			cursor.execute('select ' + self.__databaseSelectString + \
+				' from nodes where generation<=? and parentkey is not null and nodekey in ' + keys, \
+				[ generation ] + chunk)
+			for row in cursor:
+				result[row[0]] = row
+			cursor.execute('select ' + self.__databaseSelectString + \
+				' from history where generation<=? and superseded>? ' + \
+				'and parentkey is not null and nodekey in ' + keys, \
+				[ generation, generation ] + chunk)
+			for row in cursor:
+				result[row[0]] = row
+		cursor.close()
+		return result
+
+	def __createHistoryTables(self):
+		self.__dbcon.execute('create table history (' + \
+			self.__databaseHistoryCreateString + ')')
+		self.__dbcon.execute('create index historysupersededindex on history (superseded)')
+		self.__dbcon.execute('create index historygenerationindex on history (generation)')
+		self.__dbcon.execute('create index historynodekeyindex on history (nodekey)')
+		self.__dbcon.execute('create table generations (generation integer primary key, time integer)')
+		self.__dbcon.execute('insert into generations (generation, time) values (0, ?)', \
+			(int(time.time() * 10**9),))
+
+	def __createHistoryTriggers(self):
+		# the generation being written is kept in a temporary table, so
+		# the triggers can access it
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select max(generation) from generations')
+		generation = cursor.fetchone()[0] + 1
+		cursor.close()
+		self.__dbcon.execute('create temp table currentgeneration (generation integer)')
+		self.__dbcon.execute('insert into currentgeneration (generation) values (?)', (generation,))
+		self.__generation = generation
+		# copy-on-write: keep the old version of a row in the history when
+		# updating or deleting it, except the row was written in this generation
+		current = '(select generation from currentgeneration)'
+		oldvalues = ','.join([ 'old.' + s for s in self.__databaseVarNames ])
+		copyold = ' when old.generation<' + current + ' begin ' + \
+			'insert into history (superseded,' + self.__databaseSelectString + \
+			') values (' + current + ',' + oldvalues + '); end'
+		self.__dbcon.execute('create temp trigger historyupdate after update on nodes' + copyold)
+		self.__dbcon.execute('create temp trigger historydelete after delete on nodes' + copyold)
+
+	def __setGeneration(self, generation):
+		self.__dbcon.execute('update currentgeneration set generation=?', (generation,))
+		self.__generation = generation
+
+	def __rebuildSignature(self):
+		sums = {}
+		cursor = self.__dbcon.cursor()
+		for table, varnames in self.__signatureTables:
+			cursor.execute('select nodekey, rowdigest(' + ','.join(varnames) + \
+				') from ' + table)
+			for row in cursor:
+				bucket = row[0] // self.__signatureBucketSize
+				if bucket in sums:
+					sums[bucket] = DatabaseTree.__digestAdd(sums[bucket], row[1])
+				else:
+					sums[bucket] = row[1]
+		cursor.close()
+		self.__dbcon.execute('delete from signature')
+		self.__dbcon.executemany('insert into signature (bucket, digest) values (?,?)', \
+			sums.iteritems())
+
+	def __createSignatureTriggers(self):
+		# temporary triggers only exist for this connection, they keep the
+		# signature up to date for every modification made by this program
+		bucket = '{0:s}.nodekey/{1:d}'
+		for table, varnames in self.__signatureTables:
+			newdigest = 'rowdigest(' + ','.join([ 'new.' + s for s in varnames ]) + ')'
+			olddigest = 'rowdigest(' + ','.join([ 'old.' + s for s in varnames ]) + ')'
+			addnew = 'insert or ignore into signature (bucket, digest) values (' + \
+				bucket + ', zeroblob({2:d}));' + \
+				'update signature set digest=digestadd(digest, ' + newdigest + \
+				') where bucket=' + bucket + ';'
+			subold = 'update signature set digest=digestsub(digest, ' + olddigest + \
+				') where bucket=' + bucket + ';'
+			self.__dbcon.execute('create temp trigger ' + table + 'signatureinsert ' + \
+				'after insert on ' + table + ' begin ' + \
+				addnew.format('new', self.__signatureBucketSize, self.__signatureDigestSize) + ' end')
+			self.__dbcon.execute('create temp trigger ' + table + 'signatureupdate ' + \
+				'after update on ' + table + ' begin ' + \
+				subold.format('old', self.__signatureBucketSize) + \
+				addnew.format('new', self.__signatureBucketSize, self.__signatureDigestSize) + ' end')
+			self.__dbcon.execute('create temp trigger ' + table + 'signaturedelete ' + \
+				'after delete on ' + table + ' begin ' + \
+				subold.format('old', self.__signatureBucketSize) + ' end')
+
+	# --------------------------------------
+	# A note about tree hashes
+	# --------------------------------------
+	# Each directory has a hash over the names, types and checksums of its
+	# children, the checksums of subdirectories being their tree hashes
+	# (a Merkle tree). Equal tree hashes of two directories mean equal
+	# subtrees, so comparing two databases does not have to descend into
+	# them, see Tree.diff(). Triggers collect the directories whose
+	# children changed, commit() recalculates their hashes bottom-up.
+
+	def __createTreeHashTable(self):
+		self.__dbcon.execute('create table treehashes (nodekey integer primary key, treehash blob)')
+
+	def __createTreeHashTriggers(self):
+		self.__dbcon.execute('create temp table dirtydirectories (nodekey integer primary key)')
+		mark = 'insert or ignore into dirtydirectories (nodekey) ' + \
+			'select {0:s} where {0:s} is not null;'
+		# new directories need a hash, even if they stay empty
+		self.__dbcon.execute('create temp trigger treehashinsert after insert on nodes begin ' + \
+			mark.format('new.parentkey') + \
+			'insert or ignore into dirtydirectories (nodekey) ' + \
+			'select new.nodekey where new.isdir; end')
+		self.__dbcon.execute('create temp trigger treehashupdate after update on nodes begin ' + \
+			mark.format('old.parentkey') + mark.format('new.parentkey') + ' end')
+		self.__dbcon.execute('create temp trigger treehashdelete after delete on nodes begin ' + \
+			mark.format('old.parentkey') + \
+			'delete from treehashes where nodekey=old.nodekey; end')
+
+	def __updateTreeHashes(self, condition):
+		# recalculate the hashes of all directories matching the condition,
+		# the deepest directories first; if the hash of a directory changed,
+		# its parent is recalculated, too
+		levels = {}
+		cursor = self.__dbcon.cursor()
+		cursor.execute('select nodekey, path from nodes where isdir=1 and ' + condition)
+		for row in cursor:
+			levels.setdefault(self.__getDbDepth(row[1]), set()).add(row[0])
+		depth = max(levels.keys() + [ -1 ])
+		while depth >= 0:
+			for nodekey in levels.get(depth, []):
+				cursor.execute('select n.name, n.isdir, n.checksum, t.treehash ' + \
+					'from nodes n left join treehashes t on t.nodekey=n.nodekey ' + \
+					'where n.parentkey=? order by n.isdir desc, n.name', (nodekey,))
+				treehash = DatabaseTree.__treeHash(cursor)
+				cursor.execute('select treehash from treehashes where nodekey=?', (nodekey,))
+				row = cursor.fetchone()
+				if row is None:
+					cursor.execute('insert into treehashes (nodekey, treehash) values (?,?)', \
+						(nodekey, treehash))
+				elif str(row[0]) == str(treehash):
+					continue
+				else:
+					cursor.execute('update treehashes set treehash=? where nodekey=?', \
+						(treehash, nodekey))
+				cursor.execute('select parentkey from nodes where nodekey=?', (nodekey,))
+				parentkey = cursor.fetchone()[0]
+				if parentkey is not None:
+					levels.setdefault(depth - 1, set()).add(parentkey)
+			depth -= 1
+		cursor.close()
+
+	def __createVerificationTable(self):
+		# not covered by the signature: verifying files does not change
+		# what the database says about them
+		self.__dbcon.execute('create table verifications (nodekey integer primary key, time integer)')
+		self.__dbcon.execute('create index verificationtimeindex on verifications (time)')
+		self.__dbcon.execute('insert into verifications (nodekey, time) ' + \
+			'select nodekey, 0 from nodes where isdir=0')
+
+	def __createVerificationTriggers(self):
+		# new files have never been verified, even if their checksums have
+		# just been calculated: they may have been imported as well
+		self.__dbcon.execute('create temp trigger verificationinsert after insert on nodes ' + \
+			'when not new.isdir begin ' + \
+			'insert or replace into verifications (nodekey, time) values (new.nodekey, 0); end')
+		self.__dbcon.execute('create temp trigger verificationdelete after delete on nodes begin ' + \
+			'delete from verifications where nodekey=old.nodekey; end')
+
+	def __createSignatureCheckTable(self):
+		self.__dbcon.execute('create table signaturechecks (bucket integer primary key, time integer)')
+
+	def __getDbDepth(self, path):
+		if path == '':
+			return 0
+		else:
+			return path.count(self.__databasePathSep) + 1
+
+	@staticmethod
+	def __treeHash(rows):
+		# rows (name, isdir, checksum, tree hash) of the children in NID order
+		checksum = hashlib.sha256()
+		for name, isdir, csum, treehash in rows:
+			data = name.encode('utf-8')
+			if isdir:
+				if treehash is None:
+					raise MyException('Tree inconsistency; that should never happen.', 3)
+				checksum.update('d' + struct.pack('>q', len(data)) + data + str(treehash))
+			else:
+				checksum.update('f' + struct.pack('>q', len(data)) + data + str(csum))
+		return buffer(checksum.digest())
+
+	@staticmethod
+	def __datetimeStringToTimestamp(value):
+		if value is None:
+			return None
+		if '.' in value:
+			dt = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+		else:
+			dt = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+		return int(time.mktime(dt.timetuple())) * 10**9 + dt.microsecond * 1000
+
+	@staticmethod
+	def __rowDigest(*values):
+		# unambiguous serialization of the values of a row: type tag,
+		# length and contents of each value
+		checksum = hashlib.sha256()
+		for value in values:
+			if value is None:
+				checksum.update('n')
+				continue
+			elif isinstance(value, (int, long)):
+				tag = 'i'
+				data = str(value)
+			elif isinstance(value, float):
+				tag = 'f'
+				data = repr(value)
+			elif isinstance(value, unicode):
+				tag = 's'
+				data = value.encode('utf-8')
+			else:
+				tag = 'b'
+				data = str(value)
+			checksum.update(tag + struct.pack('>q', len(data)) + data)
+		return buffer(checksum.digest())
+
+	@staticmethod
+	def __digestAdd(a, b):
+		return DatabaseTree.__digestFromInt( \
+			DatabaseTree.__digestToInt(a) + DatabaseTree.__digestToInt(b))
+
+	@staticmethod
+	def __digestSub(a, b):
+		return DatabaseTree.__digestFromInt( \
+			DatabaseTree.__digestToInt(a) - DatabaseTree.__digestToInt(b))
+
+	@staticmethod
+	def __digestToInt(digest):
+		return long(str(digest).encode('hex'), 16)
+
+	@staticmethod
+	def __digestFromInt(value):
+		return buffer(('{0:064x}'.format(value % 2**256)).decode('hex'))
 
 	def readCurrentDir(self):
-		self.__buffer = {}
+		self.__buffer = None
 		cursor = self.__dbcon.cursor()
 		cursor.execute('select ' + self.__databaseSelectString + \
-			' from nodes where parentkey=?', (self.getCurrentParentId(),))
-		for row in cursor:
-			node = self.__fetch(row)
-			self.__buffer[node.getNid()] = node
+			' from nodes where parentkey=? limit ?', \
+			(self.getCurrentParentId(), self.__maxBufferSize + 1))
+		rows = cursor.fetchall()
 		cursor.close()
+		# large directories are not buffered
+		if len(rows) <= self.__maxBufferSize:
+			self.__buffer = {}
+			for row in rows:
+				node = self.__fetch(row)
+				self.__buffer[node.getNid()] = node
 
 	def __fetch(self, row):
 		node = Node(row[2])
 		node.dbkey = row[0]
 		if not row[3]:
-			node.info = NodeInfo()
-			node.info.size = row[4]
-			node.info.ctime = row[5]
-			node.info.atime = row[6]
-			node.info.mtime = row[7]
-			node.info.checksum = Checksum()
-			node.info.checksum.setBinary(row[8])
+			node.info = LazyNodeInfo(row)
 		return node
+
+
+
+class LazyNodeInfo(NodeInfo):
+
+	__slots__ = ('__row',)
+
+	def __init__(self, row):
+		# Do not call the base class constructor: decoding of the database
+		# row is postponed until the first access to the node information,
+		# many nodes fetched from the database are never looked at in detail;
+		# the row is set bypassing __setattr__(), which decodes it
+		object.__setattr__(self, '_LazyNodeInfo__row', row)
+
+	def __getstate__(self):
+		# database rows contain buffers that cannot be pickled: decode first
+		self.size
+		return NodeInfo.__getstate__(self)
+
+	def __setstate__(self, state):
+		object.__setattr__(self, '_LazyNodeInfo__row', None)
+		NodeInfo.__setstate__(self, state)
+
+	def __getattr__(self, name):
+		# only called for empty slots: decode row and retry
+		if self.__row is None:
+			raise AttributeError(name)
+		self.__decode()
+		return getattr(self, name)
+
+	def __setattr__(self, name, value):
+		# decode row before the first assignment of a field, decoding it
+		# on a later read would overwrite the assigned value
+		if self.__row is not None:
+			self.__decode()
+		object.__setattr__(self, name, value)
+
+	def __decode(self):
+		row = self.__row
+		object.__setattr__(self, '_LazyNodeInfo__row', None)
+		checksum = Checksum()
+		checksum.setBinary(row[8])
+		NodeInfo.__setstate__(self, (row[4], row[5], row[6], row[7], checksum))
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import heapq
+import marshal
+import os
+import tempfile
+
+from fstree import FilesystemTree
+from misc import MyException, Checksum
+
+
+
+class DuplicateGroup(object):
+
+	def __init__(self, size, checksum, paths):
+		self.size = size
+		# checksum string of the contents
+		self.checksum = checksum
+		# paths relative to the root directory, sorted
+		self.paths = paths
+
+	def __str__(self):
+		return '{0:d} files of {1:d} bytes, {2:d} bytes wasted'.format( \
+			len(self.paths), self.size, self.getWastedBytes())
+
+	def getWastedBytes(self):
+		# all copies but one could be removed
+		return self.size * (len(self.paths) - 1)
+
+
+
+class DuplicateFinder(object):
+
+	# --------------------------------------
+	# A note about finding duplicates
+	# --------------------------------------
+	# Reading files is expensive, so it is done in stages: files of a
+	# size no other file has cannot have duplicates and are never read.
+	# For the remaining files the first bytes are hashed (the prehash),
+	# only files whose size and prehash collide with another file are
+	# read completely. If the directory is under checksum control, the
+	# checksums of the database are used for files that did not change
+	# since (same size and modification time), they are not read at all
+	# unless another file of the same size has to be compared with them.
+	# The sizes of all files are sorted externally in runs of limited
+	# size, so the memory needed only depends on the largest group of
+	# files of the same size.
+	# Progress is signalled like a check does (see Tree.registerHandlers()):
+	# directories while walking, each file once with its size as soon as
+	# it is done with, either not read at all, prehashed or hashed.
+
+	def __init__(self, rootdir, includes=[], excludes=[], dbtree=None):
+		self.__rootDir = rootdir
+		self.__tree = FilesystemTree(rootdir, includes, excludes)
+		self.__tree.open()
+		# database of the root directory, only needed for its checksums
+		self.__dbtree = dbtree
+		# number of bytes for the prehash
+		self.__prehashSize = 2**16
+		# maximum number of files per sorted run
+		self.__maxBufferSize = 100000
+		# empty files are not considered to be duplicates
+		self.__minSize = 1
+		self.__bytesRead = 0
+		self.signalNewFile = None
+		self.signalBytesDone = None
+		# bytes of the file being hashed signalled so far
+		self.__currentBytesAll = 0
+		self.__currentBytesDone = 0
+
+	def registerHandlers(self, signalNewFile, signalBytesDone):
+		self.signalNewFile = signalNewFile
+		self.signalBytesDone = signalBytesDone
+
+	def unRegisterHandlers(self):
+		self.signalNewFile = None
+		self.signalBytesDone = None
+
+	def getNodeStatistics(self):
+		# totals of the progress signalled, see the note above
+		self.__tree.gotoRoot()
+		return self.__tree.getNodeStatistics()
+
+	def find(self):
+		# generator of DuplicateGroups, in order of increasing file size
+		self.__bytesRead = 0
+		runs = self.__writeSortedRuns()
+		try:
+			merged = heapq.merge(*[ DuplicateFinder.__readSortedRun(run) for run in runs ])
+			for size, paths in DuplicateFinder.__groupBySize(merged):
+				if size < self.__minSize or len(paths) < 2:
+					for path in paths:
+						self.__signalFileDone(path, size)
+					continue
+				for group in self.__findBySize(size, paths):
+					yield group
+		finally:
+			for run in runs:
+				run.close()
+
+	def getBytesRead(self):
+		return self.__bytesRead
+
+	def __walk(self):
+		# (size, path) of all files below the current directory
+		for path, node, event in self.__tree.walk():
+			if node.isDirectory():
+				if self.signalNewFile is not None:
+					self.signalNewFile(path, 0)
+			else:
+				yield node.info.size, path
+
+	def __writeSortedRuns(self):
+		runs = []
+		entries = []
+		self.__tree.gotoRoot()
+		for entry in self.__walk():
+			entries.append(entry)
+			if len(entries) == self.__maxBufferSize:
+				runs.append(DuplicateFinder.__writeSortedRun(entries))
+				entries = []
+		if len(entries) > 0:
+			runs.append(DuplicateFinder.__writeSortedRun(entries))
+		return runs
+
+	@staticmethod
+	def __writeSortedRun(entries):
+		# marshal instead of lines: names may contain line breaks
+		run = tempfile.TemporaryFile()
+		for entry in sorted(entries):
+			marshal.dump(entry, run)
+		run.seek(0)
+		return run
+
+	@staticmethod
+	def __readSortedRun(run):
+		while True:
+			try:
+				yield marshal.load(run)
+			except EOFError:
+				return
+
+	@staticmethod
+	def __groupBySize(entries):
+		# (size, paths) of all sizes, files of a size no other file has
+		# cannot have duplicates
+		size = None
+		paths = []
+		for entrysize, path in entries:
+			if not entrysize == size:
+				if len(paths) > 0:
+					yield size, paths
+				size = entrysize
+				paths = []
+			paths.append(path)
+		if len(paths) > 0:
+			yield size, paths
+
+	def __findBySize(self, size, paths):
+		known = {}
+		if self.__dbtree is not None:
+			for path in paths:
+				csumstr = self.__getStoredChecksum(path)
+				if csumstr is not None:
+					known[path] = csumstr
+		# each file is signalled once, as soon as it is done with
+		prehashes = {}
+		if len(known) == len(paths):
+			candidates = [ paths ]
+		else:
+			byprehash = {}
+			for path in paths:
+				prehashes[path] = self.__prehash(path)
+				byprehash.setdefault(prehashes[path], []).append(path)
+				if size <= self.__prehashSize:
+					self.__signalFileDone(path, size)
+			candidates = []
+			for group in byprehash.itervalues():
+				if len(group) > 1:
+					candidates.append(group)
+				elif size > self.__prehashSize:
+					self.__signalFileDone(group[0], size)
+		bychecksum = {}
+		for group in candidates:
+			for path in group:
+				if path in known:
+					csumstr = known[path]
+					# small files prehashed have been signalled already
+					if path not in prehashes or size > self.__prehashSize:
+						self.__signalFileDone(path, size)
+				elif size <= self.__prehashSize:
+					# the prehash already covered the whole file
+					csumstr = prehashes[path]
+				else:
+					csumstr = self.__hash(path, size)
+				bychecksum.setdefault(csumstr, []).append(path)
+		for csumstr in sorted(bychecksum.keys()):
+			if len(bychecksum[csumstr]) > 1:
+				yield DuplicateGroup(size, csumstr, sorted(bychecksum[csumstr]))
+
+	def __getStoredChecksum(self, path):
+		# checksum of the database if the file has not been changed since
+		node = self.__dbtree.getNodeByPath(path, False)
+		if node is None:
+			return None
+		info = self.__tree.getNodeInfoByPath(path)
+		if info is None or not info.size == node.info.size or \
+			not info.mtime == node.info.mtime:
+			return None
+		return node.info.checksum.getString()
+
+	def __prehash(self, path):
+		# hash of the first bytes; files small enough are hashed completely,
+		# their prehash is their checksum
+		fullpath = os.path.join(self.__rootDir, path)
+		try:
+			f = open(fullpath, 'rb')
+			data = f.read(self.__prehashSize)
+			f.close()
+		except IOError:
+			raise MyException('Unable to read file \'' + fullpath + '\'.', 2)
+		self.__bytesRead += len(data)
+		return hashlib.sha256(data).hexdigest()
+
+	def __hash(self, path, size):
+		# the file may have changed since walking, the progress signalled
+		# stays at the size seen then
+		if self.signalNewFile is not None:
+			self.signalNewFile(path, size)
+		self.__currentBytesAll = size
+		self.__currentBytesDone = 0
+		checksum = Checksum()
+		checksum.calculateForFile(os.path.join(self.__rootDir, path), self.__countBytes)
+		self.__signalBytesDone(self.__currentBytesAll - self.__currentBytesDone)
+		return checksum.getString()
+
+	def __countBytes(self, numBytes):
+		self.__bytesRead += numBytes
+		self.__signalBytesDone(min(numBytes, self.__currentBytesAll - self.__currentBytesDone))
+
+	def __signalBytesDone(self, numBytes):
+		self.__currentBytesDone += numBytes
+		if self.signalBytesDone is not None:
+			self.signalBytesDone(numBytes)
+
+	def __signalFileDone(self, path, size):
+		# a file not read (any further)
+		if self.signalNewFile is not None:
+			self.signalNewFile(path, size)
+		if self.signalBytesDone is not None:
+			self.signalBytesDone(size)
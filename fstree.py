@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import datetime
+import collections
+import heapq
+import marshal
 import os
 import shutil
+import tempfile
 
 from misc import MyException, Checksum
 from node import NodeInfo, Node
+from pipeline import HashJob
 from tree import Tree
 from filefilter import FileFilter
 
@@ -17,10 +21,27 @@ class FilesystemTree(Tree):
 	def __init__(self, rootdir, includes, excludes):
 		super(FilesystemTree, self).__init__()
 		self.__rootDir = rootdir
+		self.__includes = includes
+		self.__excludes = excludes
 
 		self.__filter = FileFilter(includes, excludes)
 
+		# directories with more entries than the maximum buffer size are
+		# not buffered; the generator sorts them externally in runs of
+		# the maximum buffer size
+		self.__maxBufferSize = 10000
+		self.__buffer = None
+
+		# checksums calculated ahead by a pipeline: full path -> job
+		self.__pipeline = None
+		self.__lookahead = None
+		self.__hashJobs = {}
+		# checksums recorded by this and by interrupted checks
+		self.__journal = None
+
 		self.__checksumToPathsMap = {}
+		self.__pathToChecksumMap = {}
+		self.__sortedChecksums = None
 
 		self.gotoRoot()
 
@@ -47,6 +68,8 @@ class FilesystemTree(Tree):
 			if self.__filter.EntryAccepted(self.__rootDir, self.getPath(), name):
 				shutil.rmtree()
 		self.__checksumToPathsMap = {}
+		self.__pathToChecksumMap = {}
+		self.__sortedChecksums = None
 		self.gotoRoot()
 
 	def getDepth(self):
@@ -114,28 +137,55 @@ class FilesystemTree(Tree):
 				# checksums are very expensive to calculate in the Filesystem
 				# implementation so we cannot do that here
 				raise MyException('Node that should be deleted has no checksum.', 3)
-			csumstr = node.info.checksum.getString()
-			self.__checksumToPathsMap[csumstr].remove(self.getPath(node))
-			if len(self.__checksumToPathsMap[csumstr]) == 0:
-				del self.__checksumToPathsMap[csumstr]
+			self.__removeChecksumPath(self.getPath(node))
 		# remove node from buffer
-		del self.__buffer[nid]
+		if self.__buffer is not None:
+			del self.__buffer[nid]
 
 	def commit(self):
 		pass
 
 	def exists(self, nid):
-		return nid in self.__buffer
+		return self.getNodeByNid(nid) is not None
 
 	def getNodeByNid(self, nid):
-		if not self.exists(nid):
+		if self.__buffer is not None:
+			return self.__buffer.get(nid)
+		name = Node.nid2Name(nid)
+		if not os.path.lexists(self.getFullPath(name)):
 			return None
-		else:
-			return self.__buffer[nid]
+		node = self.__fetch(name)
+		if node is None or not node.getNid() == nid:
+			return None
+		return node
 
 	def __iter__(self):
-		for nid in sorted(self.__buffer.keys()):
-			yield self.__buffer[nid]
+		if self.__pipeline is None:
+			for node in self.__iterCurrentDir():
+				yield node
+			return
+		# submit the files to the pipeline ahead of the caller
+		pending = collections.deque()
+		try:
+			for node in self.__iterCurrentDir():
+				if node.isFile():
+					fullpath = self.getFullPath(node.name)
+					job = self.__getJournalJob(node)
+					if job is None:
+						job = self.__pipeline.submit(fullpath)
+					self.__hashJobs[fullpath] = job
+				pending.append(node)
+				if len(pending) > self.__lookahead:
+					node = pending.popleft()
+					yield node
+					self.__forgetHashJob(node)
+			while len(pending) > 0:
+				node = pending.popleft()
+				yield node
+				self.__forgetHashJob(node)
+		finally:
+			for node in pending:
+				self.__forgetHashJob(node)
 
 	def calculate(self, node):
 		if node.isDirectory():
@@ -145,21 +195,31 @@ class FilesystemTree(Tree):
 			if self.signalNewFile is not None:
 				self.signalNewFile(self.getPath(node), node.info.size)
 			fullpath = self.getFullPath(node.name)
-			# calculate checksum
-			node.info.checksum = Checksum()
-			#print('### expensive calculation for node \'' + self.getPath(node) + '\' ...')
-			node.info.checksum.calculateForFile(fullpath, self.signalBytesDone)
+			job = self.__hashJobs.pop(fullpath, None)
+			if job is None:
+				job = self.__getJournalJob(node)
+			if job is None:
+				# calculate checksum
+				node.info.checksum = Checksum()
+				#print('### expensive calculation for node \'' + self.getPath(node) + '\' ...')
+				node.info.checksum.calculateForFile(fullpath, self.signalBytesDone)
+				stat = None
+			else:
+				node.info.checksum, stat = job.wait()
+				if self.signalBytesDone is not None:
+					self.signalBytesDone(node.info.size)
 			# buffering of checksums
-			csumstr = node.info.checksum.getString()
-			if not csumstr in self.__checksumToPathsMap:
-				self.__checksumToPathsMap[csumstr] = set()
-			self.__checksumToPathsMap[csumstr].add(self.getPath(node))
+			self.__addChecksumPath(node.info.checksum.getString(), self.getPath(node))
 			# determine file timestamps AFTER calculating the checksum, otherwise opening
 			# the file might change the access time (OS dependent)
-			stat = os.stat(fullpath)
-			node.info.ctime = datetime.datetime.fromtimestamp(stat.st_ctime)
-			node.info.atime = datetime.datetime.fromtimestamp(stat.st_atime)
-			node.info.mtime = datetime.datetime.fromtimestamp(stat.st_mtime)
+			if stat is None:
+				stat = os.stat(fullpath)
+			node.info.ctime = self.__getTimestamp(stat, 'st_ctime')
+			node.info.atime = self.__getTimestamp(stat, 'st_atime')
+			node.info.mtime = self.__getTimestamp(stat, 'st_mtime')
+			# checksums from the journal are recorded already
+			if self.__journal is not None and (job is None or not job.fromJournal):
+				self.__journal.record(self.getPath(node), node.info)
 
 	def globalChecksumExists(self, checksumString):
 		return checksumString in self.__checksumToPathsMap
@@ -170,21 +230,200 @@ class FilesystemTree(Tree):
 	def globalGetPathsByChecksum(self, checksumString):
 		if checksumString in self.__checksumToPathsMap:
 			return self.__checksumToPathsMap[checksumString]
+		elif len(checksumString) < 64:
+			# abbreviated checksum: paths of all matching checksums
+			result = set()
+			for csumstr in self.globalGetChecksumsByPrefix(checksumString):
+				result |= self.__checksumToPathsMap[csumstr]
+			return result
 		else:
 			return set()
 
+	def globalGetChecksumsByPrefix(self, prefix, limit=None):
+		# sorted list of checksums is created on demand
+		if self.__sortedChecksums is None:
+			self.__sortedChecksums = sorted(self.__checksumToPathsMap.keys())
+		return Tree.searchSortedChecksums(self.__sortedChecksums, prefix, limit)
+
+	def getFactory(self):
+		return (FilesystemTree, (self.__rootDir, self.__includes, self.__excludes))
+
+	def exportChecksumPaths(self):
+		return self.__checksumToPathsMap
+
+	def importChecksumPaths(self, checksumPaths):
+		for csumstr, paths in checksumPaths.iteritems():
+			for path in paths:
+				self.__addChecksumPath(csumstr, path)
+
 	### the following methods are not implementations of base class methods
 
+	def __addChecksumPath(self, csumstr, path):
+		# a file calculated again (e.g. by a refresh) may have changed,
+		# its previous checksum must not be found anymore
+		if path in self.__pathToChecksumMap:
+			self.__removeChecksumPath(path)
+		if not csumstr in self.__checksumToPathsMap:
+			self.__checksumToPathsMap[csumstr] = set()
+			self.__sortedChecksums = None
+		self.__checksumToPathsMap[csumstr].add(path)
+		self.__pathToChecksumMap[path] = csumstr
+
+	def __removeChecksumPath(self, path):
+		csumstr = self.__pathToChecksumMap.pop(path, None)
+		if csumstr is None:
+			return
+		self.__checksumToPathsMap[csumstr].remove(path)
+		if len(self.__checksumToPathsMap[csumstr]) == 0:
+			del self.__checksumToPathsMap[csumstr]
+			self.__sortedChecksums = None
+
+	def registerPipeline(self, pipeline, lookahead=64):
+		# checksums of the files of a directory are calculated by the
+		# pipeline while iterating it, up to lookahead nodes ahead
+		self.__pipeline = pipeline
+		self.__lookahead = lookahead
+
+	def unRegisterPipeline(self):
+		self.__pipeline = None
+		self.__lookahead = None
+		self.__hashJobs = {}
+
+	def registerJournal(self, journal):
+		# checksums calculated are recorded in the journal, checksums of
+		# unchanged files are taken from it, see CheckJournal
+		self.__journal = journal
+
+	def unRegisterJournal(self):
+		self.__journal = None
+
+	def __getJournalJob(self, node):
+		# checksum of a file recorded in the journal as a finished job,
+		# None if there is none or the file has changed since
+		if self.__journal is None:
+			return None
+		fullpath = self.getFullPath(node.name)
+		stat = os.stat(fullpath)
+		checksum = self.__journal.lookup(self.getPath(node), stat.st_size, \
+			self.__getTimestamp(stat, 'st_ctime'), self.__getTimestamp(stat, 'st_mtime'))
+		if checksum is None:
+			return None
+		job = HashJob(fullpath)
+		job.fromJournal = True
+		job.finish(checksum, stat, None)
+		return job
+
+	def __forgetHashJob(self, node):
+		# job of a node the caller did not calculate
+		if node.isFile():
+			self.__hashJobs.pop(self.getFullPath(node.name), None)
+
+	def __iterCurrentDir(self):
+		if self.__buffer is not None:
+			for nid in sorted(self.__buffer.keys()):
+				yield self.__buffer[nid]
+		else:
+			runs = self.__writeSortedRuns()
+			try:
+				for nid in heapq.merge(*[ FilesystemTree.__readSortedRun(run) for run in runs ]):
+					# entry may have vanished since writing the runs
+					node = self.getNodeByNid(nid)
+					if node is not None:
+						yield node
+			finally:
+				for run in runs:
+					run.close()
+
 	def readCurrentDir(self):
-		self.__buffer = {}
+		self.__buffer = None
+		names = os.listdir(self.getFullPath())
+		# large directories are not buffered
+		if len(names) <= self.__maxBufferSize:
+			self.__buffer = {}
+			for name in names:
+				node = self.__fetch(name)
+				if node is not None:
+					self.__buffer[node.getNid()] = node
+
+	def __writeSortedRuns(self):
+		# write the NIDs of the current directory into temporary files,
+		# each file contains a sorted run of at most the maximum buffer size
+		runs = []
+		nids = []
 		for name in os.listdir(self.getFullPath()):
 			node = self.__fetch(name)
 			if node is not None:
-				self.__buffer[node.getNid()] = node
+				nids.append(node.getNid())
+			if len(nids) == self.__maxBufferSize:
+				runs.append(FilesystemTree.__writeSortedRun(nids))
+				nids = []
+		if len(nids) > 0:
+			runs.append(FilesystemTree.__writeSortedRun(nids))
+		return runs
+
+	@staticmethod
+	def __writeSortedRun(nids):
+		# marshal instead of lines: names may contain line breaks
+		run = tempfile.TemporaryFile()
+		for nid in sorted(nids):
+			marshal.dump(nid, run)
+		run.seek(0)
+		return run
+
+	@staticmethod
+	def __readSortedRun(run):
+		while True:
+			try:
+				yield marshal.load(run)
+			except EOFError:
+				return
+
+	def getNodeInfoByPath(self, path):
+		# size and timestamps of a file without calculating its checksum,
+		# None if the path is no file of this tree
+		dirpath, name = os.path.split(path)
+		fullpath = os.path.join(self.__rootDir, path)
+		if not os.path.isfile(fullpath) or \
+			not self.__filter.EntryAccepted(self.__rootDir, dirpath, name):
+			return None
+		stat = os.stat(fullpath)
+		info = NodeInfo()
+		info.size = stat.st_size
+		info.ctime = self.__getTimestamp(stat, 'st_ctime')
+		info.atime = self.__getTimestamp(stat, 'st_atime')
+		info.mtime = self.__getTimestamp(stat, 'st_mtime')
+		return info
+
+	def calculateByPath(self, path):
+		# node info of a file including its checksum without walking to its
+		# directory (see calculate()), None if the path is no file of this tree
+		info = self.getNodeInfoByPath(path)
+		if info is None:
+			return None
+		if self.signalNewFile is not None:
+			self.signalNewFile(path, info.size)
+		fullpath = os.path.join(self.__rootDir, path)
+		info.checksum = Checksum()
+		info.checksum.calculateForFile(fullpath, self.signalBytesDone)
+		# file timestamps AFTER calculating the checksum, see calculate()
+		stat = os.stat(fullpath)
+		info.ctime = self.__getTimestamp(stat, 'st_ctime')
+		info.atime = self.__getTimestamp(stat, 'st_atime')
+		info.mtime = self.__getTimestamp(stat, 'st_mtime')
+		return info
 
 	def getFullPath(self, name=''):
 		return os.path.join(self.__rootDir, self.getPath(), name)
 
+	def __getTimestamp(self, stat, name):
+		# integer nanoseconds since the epoch; if the exact value is not
+		# available (python < 3.3), the float value is rounded to microseconds
+		# which is the best resolution it reliably provides
+		if hasattr(stat, name + '_ns'):
+			return getattr(stat, name + '_ns')
+		else:
+			return int(round(getattr(stat, name) * 10**6)) * 1000
+
 	def __fetch(self, name):
 		# filter files
 		if not self.__filter.EntryAccepted(self.__rootDir, self.getPath(), name):
@@ -1,8 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+
+from coltree import ColumnTree
 from misc import MyException
-from node import Node, NodeStatus
+from moves import MoveKind, MoveDetector
+from node import Node, NodeStatus, NodeStatistics
+from tree import WalkOrder, WalkEvent
+
+
+
+class PatchPlan(object):
+
+	def __init__(self):
+		# changes of the old tree as rows, see Tree.applyChanges()
+		self.deleted = []
+		self.updated = []
+		self.inserted = []
+		# nodes to remove from the view: (names of a directory relative to
+		# the current directory, NIDs of its children), descendants before
+		# their directories
+		self.removed = []
+
+	def getNumChanges(self):
+		return len(self.deleted) + len(self.updated) + len(self.inserted)
+
+	def remove(self, names, nid):
+		if len(self.removed) == 0 or not self.removed[-1][0] == names:
+			self.removed.append((list(names), []))
+		self.removed[-1][1].append(nid)
 
 
 
@@ -13,6 +40,8 @@ class Instance(object):
 		self.__view = view
 		self.__old = old
 		self.__new = new
+		# databases replaced by read-only snapshots, see beginReadOnly()
+		self.__writables = None
 
 	def __str__(self):
 		result = '('
@@ -27,6 +56,8 @@ class Instance(object):
 		return result + ')'
 
 	def close(self):
+		if self.__writables is not None:
+			self.endReadOnly()
 		if self.__view is not None and self.__view.isOpen:
 			self.__view.close()
 		if self.__old is not None and self.__old.isOpen:
@@ -34,6 +65,55 @@ class Instance(object):
 		if self.__new is not None and self.__new.isOpen:
 			self.__new.close()
 
+	# --------------------------------------
+	# A note about browsing while writing
+	# --------------------------------------
+	# A check or a scrub runs for hours and writes the database, but the
+	# results of the previous one can still be browsed. During that time
+	# the databases of the instance are replaced by read-only snapshots
+	# (see DatabaseTree.createReader()) at the same directories, so all
+	# reading uses connections of their own. Afterwards the databases are
+	# moved to where the snapshots have been browsed to.
+
+	def beginReadOnly(self):
+		self.__writables = [ self.__view, self.__old, self.__new ]
+		self.__view, self.__old, self.__new = \
+			[ Instance.__createReader(tree) for tree in self.__writables ]
+
+	def endReadOnly(self):
+		readers = [ self.__view, self.__old, self.__new ]
+		self.__view, self.__old, self.__new = \
+			[ Instance.__closeReader(reader, tree) for reader, tree in zip(readers, self.__writables) ]
+		self.__writables = None
+
+	@staticmethod
+	def __createReader(tree):
+		if tree is None or not hasattr(tree, 'createReader'):
+			return tree
+		reader = tree.createReader()
+		Instance.__moveTree(reader, tree.getPath())
+		return reader
+
+	@staticmethod
+	def __closeReader(reader, tree):
+		if reader is tree:
+			return tree
+		Instance.__moveTree(tree, reader.getPath())
+		reader.close()
+		return tree
+
+	@staticmethod
+	def __moveTree(tree, path):
+		# descend from the root directory as far as the directories exist
+		tree.gotoRoot()
+		if path == '':
+			return
+		for name in path.split(os.sep):
+			node = tree.getNodeByNid(Node.constructNid(name, True))
+			if node is None:
+				return
+			tree.down(node)
+
 	def isRoot(self):
 		return self.__view.isRoot()
 
@@ -46,6 +126,9 @@ class Instance(object):
 	def getNodeStatistics(self):
 		return self.__view.getNodeStatistics()
 
+	def getStatusCounts(self, recursive=False):
+		return self.__view.getStatusCounts(recursive)
+
 	def up(self):
 		# ascent in old tree
 		if self.__old is not None:
@@ -55,7 +138,11 @@ class Instance(object):
 		if self.__new is not None:
 			if self.__new.sameDepth(self.__view):
 				self.__new.up()
-		# ascent in view tree, update status of parent directory we are returning from in view tree
+		# ascent in view tree
+		self.__viewUp()
+
+	def __viewUp(self):
+		# update status of parent directory we are returning from in view tree
 		status = self.__view.getTotalNodeStatus()
 		name = self.__view.up()
 		nid = Node.constructNid(name, True)
@@ -65,6 +152,7 @@ class Instance(object):
 		if not (node.status == NodeStatus.Missing or node.status == NodeStatus.New):
 			node.status = status
 			self.__view.update(node)
+		return name
 
 	def down(self, node):
 		# descent in old tree if possible
@@ -97,16 +185,41 @@ class Instance(object):
 		else:
 			return [ None, None ]
 
+	def getChecksumsByPrefix(self, prefix, limit=None):
+		# all complete checksums in old and new tree starting with prefix
+		result = set()
+		for tree in [ self.__old, self.__new, self.__view ]:
+			if tree is not None:
+				result.update(tree.globalGetChecksumsByPrefix(prefix, limit))
+		return sorted(result)
+
+	def resolveChecksumPrefix(self, prefix):
+		# get complete checksum for an abbreviated one (like the ones displayed)
+		checksums = self.getChecksumsByPrefix(prefix, 2)
+		if len(checksums) == 0:
+			raise MyException('No checksum starting with \'' + prefix + '\'.', 1)
+		elif len(checksums) > 1:
+			raise MyException('Checksum \'' + prefix + '\' is ambiguous, ' + \
+				'please provide more digits.', 1)
+		return checksums[0]
+
 	def hasRiskOfLoss(self, node):
 		if node.isDirectory():
 			raise MyException('Cannot determine risk of loss for directories.', 3)
+		csumstr = Instance.__getLostChecksum(node)
+		if csumstr is None:
+			return False
+		return not self.__new.globalChecksumExists(csumstr)
+
+	@staticmethod
+	def __getLostChecksum(node):
+		# checksum of the old contents of a file that are lost when accepting it
 		if node.status == NodeStatus.Missing:
-			csum = node.info.checksum
+			return node.info.checksum.getString()
 		elif node.status == NodeStatus.FileWarning or node.status == NodeStatus.FileError:
-			csum = node.otherinfo.checksum
+			return node.otherinfo.checksum.getString()
 		else:
-			return False
-		return not self.__new.globalChecksumExists(csum.getString())
+			return None
 
 	def ignore(self, nids):
 		for nid in nids:
@@ -116,49 +229,276 @@ class Instance(object):
 			self.__view.deleteNode(vnode)
 		self.__view.commit()
 
-	def __patch(self, node, safeOnly):
+	# --------------------------------------
+	# A note about patching
+	# --------------------------------------
+	# Accepting the differences of many nodes node by node costs a few
+	# database statements for each of them. Instead, planPatch() walks the
+	# selected nodes of the view once and decides about all of them: the
+	# risk of loss of the non-destructive mode is determined for all files
+	# with a single query of the new tree beforehand. applyPatch() hands
+	# the changes to the old tree as rows, which DatabaseTree applies with
+	# a few statements in a single transaction, and removes the accepted
+	# nodes from the view afterwards. The node information of new and
+	# changed files is taken from the view, it is not calculated again.
+
+	def isPatchPossible(self):
+		return not (self.__old is None or self.__new is None)
+
+	def planPatch(self, nids=None, safeOnly=False):
+		# plan of accepting the nodes of the current directory with the
+		# given NIDs (or all nodes) and their descendants
+		if nids is None:
+			vnodes = list(self.__view)
+		else:
+			vnodes = []
+			for nid in nids:
+				vnode = self.__view.getNodeByNid(nid)
+				if vnode is None:
+					raise MyException('Tree inconsistency; that should never happen.', 3)
+				vnodes.append(vnode)
+		atrisk = set()
+		if safeOnly:
+			for vnode in vnodes:
+				for path, node, event in self.__view.walk(vnode):
+					if node.isFile():
+						atrisk.add(Instance.__getLostChecksum(node))
+			atrisk.discard(None)
+			atrisk.difference_update(self.__new.globalGetPathsByChecksums(atrisk).keys())
+		plan = PatchPlan()
+		for vnode in vnodes:
+			self.__planPatch(plan, vnode, safeOnly, atrisk)
+		return plan
+
+	def __planPatch(self, plan, vnode, safeOnly, atrisk):
+		# names of the directories being visited and numbers of their
+		# children still in the view afterwards
+		names = []
+		numexists = [ 0 ]
+		for path, node, event in self.__view.walk(vnode, WalkOrder.PreAndPostOrder):
+			if node.isDirectory() and event == WalkEvent.Pre:
+				# before descent: create if necessary
+				if node.status == NodeStatus.New:
+					plan.inserted.append(Instance.__toRow(path, node))
+				names.append(node.name)
+				numexists.append(0)
+				continue
+			elif node.isDirectory():
+				names.pop()
+				exists = self.__planDirectory(plan, path, node, numexists.pop(), safeOnly)
+			elif event == WalkEvent.Pre:
+				exists = self.__planFile(plan, path, node, safeOnly and \
+					Instance.__getLostChecksum(node) in atrisk)
+			else:
+				continue
+			if exists == 0:
+				plan.remove(names, node.getNid())
+			numexists[-1] += exists
+
+	def __planDirectory(self, plan, path, node, numexists, safeOnly):
+		# after descent: delete if necessary (status missing and empty)
 		exists = 1
-		if node.isDirectory():
-			# before descent: create if necessary
-			if node.status == NodeStatus.New:
-				self.__new.copyTo(self.__old, node, False)
+		if node.status == NodeStatus.New or node.status == NodeStatus.Ok:
+			exists = 0
+		elif not safeOnly or (numexists == 0):
+			if node.status == NodeStatus.Missing:
+				plan.deleted.append(Instance.__toRow(path, node))
 				exists = 0
-			# tree descend
-			self.down(node)
-			numexists = 0
-			for n in self:
-				numexists += self.__patch(n, safeOnly)
-			self.up()
-			# after descent: delete if necessary (status missing and empty)
-			if node.status == NodeStatus.Ok:
+		return exists
+
+	def __planFile(self, plan, path, node, atrisk):
+		exists = 1
+		if node.status == NodeStatus.New:
+			plan.inserted.append(Instance.__toRow(path, node))
+			exists = 0
+		elif not atrisk:
+			if node.status == NodeStatus.FileWarning or node.status == NodeStatus.FileError:
+				plan.updated.append(Instance.__toRow(path, node))
 				exists = 0
-			elif not safeOnly or (numexists == 0):
-				if node.status == NodeStatus.Missing:
-					self.__old.delete(node)
-					exists = 0
-		else:
-			if node.status == NodeStatus.New:
-				self.__new.copyTo(self.__old, node, False)
+			elif node.status == NodeStatus.Missing:
+				plan.deleted.append(Instance.__toRow(path, node))
 				exists = 0
-			elif not safeOnly or not self.hasRiskOfLoss(node):
-				if node.status == NodeStatus.FileWarning or node.status == NodeStatus.FileError:
-					self.__old.update(node)
-					exists = 0
-				elif node.status == NodeStatus.Missing:
-					self.__old.delete(node)
-					exists = 0
-		if exists == 0:
-			self.__view.delete(node)
 		return exists
 
+	@staticmethod
+	def __toRow(path, node):
+		if node.isDirectory():
+			return (path, True, None, None, None, None, None)
+		else:
+			return (path, False, node.info.size, node.info.ctime, node.info.atime, \
+				node.info.mtime, node.info.checksum.getBinary())
+
+	def applyPatch(self, plan, signalNewFile=None, signalBytesDone=None):
+		# each change of the old tree is signalled like a directory
+		self.__old.registerHandlers(signalNewFile, signalBytesDone)
+		try:
+			self.__old.applyChanges(plan.deleted, plan.updated, plan.inserted)
+		finally:
+			self.__old.unRegisterHandlers()
+		# remove the accepted nodes from the view, the status of each
+		# directory is updated when leaving it
+		position = []
+		for names, nids in plan.removed:
+			position = self.__moveView(position, names)
+			for nid in nids:
+				self.__view.delete(self.__view.getNodeByNid(nid))
+		self.__moveView(position, [])
+		self.__old.commit()
+		self.__view.commit()
+
 	def patch(self, nids, safeOnly=False):
-		for nid in nids:
-			vnode = self.__view.getNodeByNid(nid)
-			if vnode is None:
-				raise MyException('Tree inconsistency; that should never happen.', 3)
-			self.__patch(vnode, safeOnly)
+		self.applyPatch(self.planPatch(nids, safeOnly))
+
+	def __moveView(self, position, names):
+		# move the view from one directory to another, both given as lists
+		# of names relative to the same directory, without the old and the
+		# new tree
+		position = list(position)
+		while not position == names[:len(position)]:
+			self.__viewUp()
+			position.pop()
+		for name in names[len(position):]:
+			self.__view.down(self.__view.getNodeByNid(Node.constructNid(name, True)))
+			position.append(name)
+		return position
+
+	def isMoveDetectionPossible(self):
+		return not (self.__old is None or self.__new is None)
+
+	def detectMoves(self):
+		# moved, renamed and copied nodes of the whole view, see MoveDetector
+		path = self.getPath()
+		self.__gotoRoot()
+		moves = MoveDetector(self.__view, self.__old).detect()
+		self.__gotoPath(path)
+		return moves
+
+	def acceptMoves(self, moves):
+		# Apply moves and renames to the old tree without deleting and
+		# inserting the nodes; copies are new nodes for the old tree and
+		# have to be accepted as such. Returns the number of moves applied,
+		# moves the old tree cannot apply (e.g. into new directories) are
+		# left as they are.
+		path = self.getPath()
+		count = 0
+		for move in moves:
+			if move.kind == MoveKind.Copied:
+				continue
+			self.__gotoRoot()
+			if not self.__old.moveByPath(move.source, move.destination, move.isdir):
+				continue
+			for p in [ move.source, move.destination ]:
+				if self.__gotoPath(os.path.dirname(p)):
+					vnode = self.__view.getNodeByNid( \
+						Node.constructNid(os.path.basename(p), move.isdir))
+					if vnode is not None:
+						self.__view.deleteNode(vnode)
+					self.__removeEmptyDirectories()
+			count += 1
+		# ascending to the root updates the status of the directories
+		self.__gotoRoot()
 		self.__old.commit()
 		self.__view.commit()
+		self.__gotoPath(path)
+		return count
+
+	def __removeEmptyDirectories(self):
+		# remove directories left empty in the view, ascending to the root
+		while not self.isRoot() and next(iter(self.__view), None) is None:
+			name = os.path.basename(self.getPath())
+			self.up()
+			vnode = self.__view.getNodeByNid(Node.constructNid(name, True))
+			if vnode.status == NodeStatus.New or vnode.status == NodeStatus.Missing:
+				break
+			self.__view.delete(vnode)
+
+	def __gotoRoot(self):
+		while not self.isRoot():
+			self.up()
+
+	def __gotoPath(self, path):
+		# descend from the root directory as far as the directories of
+		# the path exist in the view
+		self.__gotoRoot()
+		if path == '':
+			return True
+		for name in path.split(os.sep):
+			node = self.__view.getNodeByNid(Node.constructNid(name, True))
+			if node is None:
+				return False
+			self.down(node)
+		return True
+
+	def isRefreshPossible(self):
+		# the current directory has to exist in the old and the new tree
+		return self.__old is not None and self.__new is not None and \
+			self.__old.sameDepth(self.__view) and self.__new.sameDepth(self.__view)
+
+	def getRefreshStatistics(self, nids=None):
+		# statistics of the nodes of the new tree processed by refresh()
+		if nids is None:
+			return self.__new.getNodeStatistics()
+		nids = set(nids)
+		stats = NodeStatistics()
+		for node in [ node for node in self.__new if node.getNid() in nids ]:
+			stats.add(self.__new.getNodeStatistics(node))
+		return stats
+
+	def refresh(self, nids=None, signalNewFile=None, signalBytesDone=None):
+		# diff the current directory again (or only the nodes of the
+		# current directory with the given NIDs) and replace it in the view;
+		# the diff is signalled like a check and can be cancelled by the
+		# handlers, the view is left as it is then
+		if not self.isRefreshPossible():
+			raise MyException('Directory does not exist in database and ' + \
+				'filesystem, please refresh its parent directory.', 1)
+		Instance.__reread(self.__old)
+		Instance.__reread(self.__new)
+		if nids is not None:
+			nids = set(nids)
+		result = ColumnTree()
+		result.open()
+		path = self.__new.getPath()
+		self.__new.registerHandlers(signalNewFile, signalBytesDone)
+		try:
+			self.__new.diff(self.__old, result, True, None, nids)
+		except:
+			# an interrupted diff leaves the trees somewhere below
+			Instance.__moveTree(self.__old, path)
+			Instance.__moveTree(self.__new, path)
+			raise
+		finally:
+			self.__new.unRegisterHandlers()
+		# replace nodes in view
+		for vnode in list(self.__view):
+			if nids is None or vnode.getNid() in nids:
+				self.__view.deleteNode(vnode)
+		result.gotoRoot()
+		result.copyTo(self.__view)
+		self.__view.commit()
+		self.__propagateStatus()
+
+	@staticmethod
+	def __reread(tree):
+		# contents of the current directory may have changed since descending
+		if tree.isRoot():
+			tree.gotoRoot()
+		else:
+			name = tree.up()
+			node = tree.getNodeByNid(Node.constructNid(name, True))
+			if node is None:
+				raise MyException('Directory \'' + tree.getPath(Node(name)) + \
+					'\' does not exist anymore.', 1)
+			tree.down(node)
+
+	def __propagateStatus(self):
+		# update the status of all ancestor directories in the view, the
+		# old and new trees stay where they are
+		names = []
+		while not self.__view.isRoot():
+			names.append(self.__viewUp())
+		for name in reversed(names):
+			self.__view.down(self.__view.getNodeByNid(Node.constructNid(name, True)))
 
 	def __delete(self, node):
 		# recurse
@@ -0,0 +1,597 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from misc import MyException, Checksum
+from node import NodeInfo, Node
+from tree import Tree
+
+
+
+class ManifestRecords(object):
+
+	# sequence of the NIDs of a range of records, for bisect
+	def __init__(self, tree, first, num):
+		self.__tree = tree
+		self.__first = first
+		self.__num = num
+
+	def __len__(self):
+		return self.__num
+
+	def __getitem__(self, index):
+		return self.__tree.getNidByIndex(self.__first + index)
+
+
+
+class ManifestTree(Tree):
+
+	# --------------------------------------
+	# A note about the manifest file
+	# --------------------------------------
+	# The manifest is a flat binary file for read-mostly archives: it is
+	# memory-mapped on opening and nothing is parsed before it is needed.
+	# Layout: a header, fixed size records of all nodes, an index of the
+	# checksums of all files and the UTF-8 encoded names of all nodes.
+	# Records are in breadth-first order, the root directory being the
+	# first one; the children of a directory are consecutive records
+	# sorted by NID, so they can be looked up by bisection. The checksum
+	# index is sorted by checksum. Changes are kept in memory and written
+	# by commit() into a new manifest replacing the old one.
+
+	# --------------------------------------
+	# A note about the signature of the manifest
+	# --------------------------------------
+	# Hashing a huge manifest on each opening would take as long as loading
+	# a database. The manifest is divided into blocks, the SHA-256 digests
+	# of all blocks are appended to the manifest and only these digests are
+	# signed, so checking the signature file is cheap. Like the buckets of
+	# the database signature (see DatabaseTree.isSignatureValid()), each
+	# opening verifies a part of the blocks against their digests: the
+	# first block with the header and a rotating range of the others; the
+	# next block to check is kept in a small file next to the manifest.
+
+	def __init__(self, manifestfile, sigfile, readonly=False):
+		super(ManifestTree, self).__init__()
+		self.__manifestFile = manifestfile
+		self.__signatureFile = sigfile
+		self.__checkFile = manifestfile + '.checks'
+		# read-only trees cannot be committed
+		self.__readonly = readonly
+
+		self.__magic = 'TSMANIF\0'
+		self.__version = 2
+		# magic, version
+		self.__versionStruct = struct.Struct('<8sI')
+		# magic, version, size of blocks, number of records, offset of
+		# checksum index, number of checksum index entries, offset of names,
+		# offset of block digests, number of block digests
+		self.__headerStruct = struct.Struct('<8sIIQQQQQQ')
+		self.__blockSize = 1024**2
+		self.__digestSize = hashlib.sha256().digest_size
+		self.__signatureCheckMinBlocks = 16
+		self.__signatureCheckFraction = 16
+		# isdir, length of name, offset of name, index of parent, size,
+		# ctime, atime, mtime (the smallest value for None, e.g. for
+		# imported checksums), index of first child, number of children,
+		# checksum
+		self.__recordStruct = struct.Struct('<B3xIQQqqqqQQ32s')
+		self.__noneValue = -2**63
+		# checksum, index of record
+		self.__checksumStruct = struct.Struct('<32sQ')
+
+		self.__file = None
+		self.__map = None
+		self.clearChanges()
+
+		self.open()
+		self.gotoRoot()
+
+	def __str__(self):
+		result = '('
+		result += 'ManifestTree: '
+		result += 'depth=\'' + str(self.getDepth()) + '\''
+		result += ', path=\'' + self.getPath() + '\''
+		return result + ')'
+
+	### implementation of base class methods, please keep order
+
+	def open(self):
+		if self.isOpen():
+			return
+		# if the manifest file does not exist, make a silent reset
+		if not os.path.exists(self.__manifestFile):
+			if self.__readonly:
+				raise MyException('Cannot find manifest file \'' + self.__manifestFile + '\'.', 2)
+			self.clear()
+			return
+		self.__file = open(self.__manifestFile, 'rb')
+		self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+		if len(self.__map) < self.__versionStruct.size:
+			self.close()
+			raise MyException('Manifest file \'' + self.__manifestFile + '\' is corrupted.', 3)
+		magic, version = self.__versionStruct.unpack_from(self.__map, 0)
+		if not magic == self.__magic:
+			self.close()
+			raise MyException('File \'' + self.__manifestFile + '\' is no manifest file.', 3)
+		if version > self.__version:
+			self.close()
+			raise MyException('Manifest has been created by a newer version of this program.', 3)
+		if version < self.__version:
+			self.close()
+			raise MyException('Manifest has been created by an older version of this program, please import again.', 2)
+		if len(self.__map) < self.__headerStruct.size:
+			self.close()
+			raise MyException('Manifest file \'' + self.__manifestFile + '\' is corrupted.', 3)
+		magic, version, blockSize, self.__numRecords, self.__checksumsOffset, \
+			self.__numChecksums, self.__namesOffset, self.__blocksOffset, self.__numBlocks = \
+			self.__headerStruct.unpack_from(self.__map, 0)
+		# the block digests have to cover the rest of the file exactly
+		if not blockSize == self.__blockSize or \
+			not self.__numBlocks == (self.__blocksOffset + blockSize - 1) // blockSize or \
+			not len(self.__map) == self.__blocksOffset + self.__numBlocks * self.__digestSize:
+			self.close()
+			raise MyException('Manifest file \'' + self.__manifestFile + '\' is corrupted.', 3)
+
+	def close(self):
+		# uncommitted changes are lost
+		if self.__map is not None:
+			self.__map.close()
+			self.__map = None
+		if self.__file is not None:
+			self.__file.close()
+			self.__file = None
+		self.clearChanges()
+
+	def isOpen(self):
+		return self.__map is not None
+
+	def clear(self):
+		self.__checkWritable()
+		self.close()
+		self.__writeManifest()
+		self.open()
+		self.getSignature().saveToFile(self.__signatureFile)
+		self.gotoRoot()
+
+	def getDepth(self):
+		return len(self.__parentNameStack) - 1
+
+	def getPath(self, node=None):
+		path = reduce(lambda x, y: os.path.join(x, y), self.__parentNameStack)
+		if node is None:
+			return path
+		else:
+			return os.path.join(path, node.name)
+
+	def gotoRoot(self):
+		self.__parentNameStack = [ '' ]
+		self.__parentIndexStack = [ 0 ]
+
+	def up(self):
+		if self.isRoot():
+			raise MyException('\'up\' on root node is not possible.', 3)
+		self.__parentIndexStack.pop()
+		return self.__parentNameStack.pop()
+
+	def down(self, node):
+		if node.isFile():
+			raise MyException('\'down\' on file \'' + node.name + '\' is not possible.', 3)
+		# directories inserted since the last commit have no record
+		self.__parentIndexStack.append(self.__findRecord(self.__parentIndexStack[-1], node.getNid()))
+		self.__parentNameStack.append(node.name)
+
+	def numChildren(self, node):
+		if node.isFile():
+			return 0
+		else:
+			index = self.__findRecord(self.__parentIndexStack[-1], node.getNid())
+			return self.__countChildren(index, self.getPath(node))
+
+	def insert(self, node):
+		self.__setChange(self.getPath(), node.getNid(), node)
+
+	def update(self, node):
+		self.__setChange(self.getPath(), node.getNid(), node)
+
+	def delete(self, node):
+		if not self.isChildless(node):
+			raise MyException('Deleting the non-empty directory \'' + node.name + '\'.', 1)
+		nid = node.getNid()
+		if not self.exists(nid):
+			raise MyException('Node does not exist for deletion.', 1)
+		self.__setChange(self.getPath(), nid, None)
+
+	def commit(self):
+		self.__checkWritable()
+		if len(self.__changes) == 0:
+			return
+		self.__writeManifest()
+		self.close()
+		self.open()
+		self.getSignature().saveToFile(self.__signatureFile)
+		# record indices have changed: find current directory in new manifest
+		names = self.__parentNameStack[1:]
+		self.gotoRoot()
+		for name in names:
+			self.__parentIndexStack.append(self.__findRecord( \
+				self.__parentIndexStack[-1], Node.constructNid(name, True)))
+			self.__parentNameStack.append(name)
+
+	def exists(self, nid):
+		return self.getNodeByNid(nid) is not None
+
+	def getNodeByNid(self, nid):
+		changes = self.__changes.get(self.getPath())
+		if changes is not None and nid in changes:
+			return changes[nid]
+		index = self.__findRecord(self.__parentIndexStack[-1], nid)
+		if index is None:
+			return None
+		return self.__fetch(index)
+
+	def __iter__(self):
+		for node, index in self.__getChildren(self.__parentIndexStack[-1], self.getPath()):
+			yield node
+
+	def calculate(self, node):
+		# nothing to do, just signal that the job is done if necessary
+		if node.isDirectory():
+			if self.signalNewFile is not None:
+				self.signalNewFile(self.getPath(node), 0)
+		else:
+			# sizes of imported checksums may be unknown
+			size = node.info.size
+			if size is None:
+				size = 0
+			if self.signalNewFile is not None:
+				self.signalNewFile(self.getPath(node), size)
+			if self.signalBytesDone is not None:
+				self.signalBytesDone(size)
+
+	def globalChecksumExists(self, checksumString):
+		return len(self.globalGetPathsByChecksum(checksumString)) > 0
+
+	def globalChecksumNumberOfOccurrences(self, checksumString):
+		return len(self.globalGetPathsByChecksum(checksumString))
+
+	def globalGetPathsByChecksum(self, checksumString):
+		result = set()
+		for index in self.__findChecksums(checksumString):
+			path = self.__getPathByIndex(index)
+			# ignore records replaced or deleted since the last commit
+			changes = self.__changes.get(os.path.dirname(path))
+			if changes is None or self.getNidByIndex(index) not in changes:
+				result.add(path)
+		for csumstr in self.__searchChangedChecksums(checksumString):
+			result |= self.__checksumToPathsMap[csumstr]
+		return result
+
+	def globalGetChecksumsByPrefix(self, prefix, limit=None):
+		result = set(self.__searchChangedChecksums(prefix))
+		for index in self.__findChecksums(prefix):
+			csumstr = self.__getChecksumByIndex(index).getString()
+			if csumstr not in result and self.globalChecksumExists(csumstr):
+				result.add(csumstr)
+		result = sorted(result)
+		if limit is not None:
+			result = result[:limit]
+		return result
+
+	def getFactory(self):
+		return (ManifestTree, (self.__manifestFile, self.__signatureFile, self.__readonly))
+
+	### the following methods are not implementations of base class methods
+
+	def clearChanges(self):
+		# changes since the last commit:
+		# path of directory -> (NID -> node, None for deleted nodes)
+		self.__changes = {}
+		# checksums of changed files: checksum string -> set of paths
+		self.__checksumToPathsMap = {}
+
+	@staticmethod
+	def getManifestFile(dbfile):
+		# the manifest replaces the database of a directory, see treeseal.py
+		return os.path.splitext(dbfile)[0] + '.binmanifest'
+
+	@staticmethod
+	def isManifest(dbfile):
+		return os.path.exists(ManifestTree.getManifestFile(dbfile))
+
+	@staticmethod
+	def removeManifest(dbfile):
+		manifestfile = ManifestTree.getManifestFile(dbfile)
+		for path in [ manifestfile, manifestfile + '.checks' ]:
+			if os.path.exists(path):
+				os.remove(path)
+
+	def isReadOnly(self):
+		return self.__readonly
+
+	def getSignature(self):
+		# digest over the digests of all blocks, see the note above
+		checksum = hashlib.sha256()
+		checksum.update(self.__map[self.__blocksOffset:])
+		result = Checksum()
+		result.setBinary(buffer(checksum.digest()))
+		return result
+
+	def isSignatureValid(self, full=False):
+		# the signature file only covers the block digests: some blocks
+		# (all blocks if full) are verified against their digests as well
+		if not os.path.exists(self.__signatureFile) or \
+			not self.getSignature().isValidUsingSavedFile(self.__signatureFile):
+			return False
+		if full:
+			blocks = range(self.__numBlocks)
+		else:
+			blocks = self.__getSignatureCheckBlocks()
+		if len(self.verifySignature(blocks)) > 0:
+			return False
+		if not full:
+			self.__setSignatureChecked(blocks)
+		return True
+
+	def verifySignature(self, blocks=None):
+		# recalculate the digests of the given blocks (default: all blocks)
+		# and return the list of blocks not matching their stored digests
+		if blocks is None:
+			blocks = range(self.__numBlocks)
+		result = []
+		for block in blocks:
+			start = block * self.__blockSize
+			digest = hashlib.sha256(self.__map[start:min(start + self.__blockSize, \
+				self.__blocksOffset)]).digest()
+			start = self.__blocksOffset + block * self.__digestSize
+			if not digest == self.__map[start:start + self.__digestSize]:
+				result.append(block)
+		return result
+
+	def __getSignatureCheckBlocks(self):
+		# the first block and the blocks following the ones checked last time
+		limit = max(self.__signatureCheckMinBlocks, (self.__numBlocks + \
+			self.__signatureCheckFraction - 1) // self.__signatureCheckFraction)
+		limit = min(limit, self.__numBlocks - 1)
+		start = 1
+		if os.path.exists(self.__checkFile):
+			f = open(self.__checkFile, 'r')
+			try:
+				start = int(f.read())
+			except ValueError:
+				pass
+			f.close()
+		if self.__numBlocks > 1:
+			start = 1 + (start - 1) % (self.__numBlocks - 1)
+		return [ 0 ] + [ 1 + (start - 1 + i) % (self.__numBlocks - 1) for i in range(limit) ]
+
+	def __setSignatureChecked(self, blocks):
+		# bookkeeping only, even read-only trees store it; if this fails,
+		# the same blocks are just checked again next time
+		try:
+			f = open(self.__checkFile, 'w')
+			f.write(str(blocks[-1] + 1))
+			f.close()
+		except IOError:
+			pass
+
+	def __checkWritable(self):
+		if self.__readonly:
+			raise MyException('Manifest has been opened read-only.', 3)
+
+	def getNidByIndex(self, index):
+		isdir, namelen, nameoff = struct.unpack_from('<B3xIQ', self.__map, \
+			self.__headerStruct.size + index * self.__recordStruct.size)
+		return Node.constructNid(self.__getName(nameoff, namelen), isdir)
+
+	def __getName(self, nameoff, namelen):
+		start = self.__namesOffset + nameoff
+		return self.__map[start:start+namelen].decode('utf-8')
+
+	def __unpackRecord(self, index):
+		return self.__recordStruct.unpack_from(self.__map, \
+			self.__headerStruct.size + index * self.__recordStruct.size)
+
+	def __fetch(self, index):
+		isdir, namelen, nameoff, parent, size, ctime, atime, mtime, \
+			first, num, checksum = self.__unpackRecord(index)
+		node = Node(self.__getName(nameoff, namelen))
+		if not isdir:
+			node.info = NodeInfo()
+			node.info.size, node.info.ctime, node.info.atime, node.info.mtime = \
+				[ None if v == self.__noneValue else v for v in (size, ctime, atime, mtime) ]
+			node.info.checksum = Checksum()
+			node.info.checksum.setBinary(checksum)
+		return node
+
+	def __getChecksumByIndex(self, index):
+		result = Checksum()
+		result.setBinary(self.__unpackRecord(index)[10])
+		return result
+
+	def __getPathByIndex(self, index):
+		names = []
+		while not index == 0:
+			isdir, namelen, nameoff, parent = struct.unpack_from('<B3xIQQ', self.__map, \
+				self.__headerStruct.size + index * self.__recordStruct.size)
+			names.append(self.__getName(nameoff, namelen))
+			index = parent
+		return reduce(lambda x, y: os.path.join(x, y), reversed(names), '')
+
+	def __findRecord(self, parent, nid):
+		# index of the record of a child of a directory record, None if
+		# not existing
+		if parent is None:
+			return None
+		first, num = self.__unpackRecord(parent)[8:10]
+		records = ManifestRecords(self, first, num)
+		i = bisect.bisect_left(records, nid)
+		if i < num and records[i] == nid:
+			return first + i
+		return None
+
+	def __findChecksums(self, prefix):
+		# indices of records with checksums starting with prefix
+		low, high = Checksum.prefixToBinaryRange(prefix)
+		low = str(low)
+		lo = 0
+		hi = self.__numChecksums
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.__unpackChecksum(mid)[0] < low:
+				lo = mid + 1
+			else:
+				hi = mid
+		while lo < self.__numChecksums:
+			checksum, index = self.__unpackChecksum(lo)
+			if high is not None and not checksum < str(high):
+				break
+			yield index
+			lo += 1
+
+	def __unpackChecksum(self, i):
+		return self.__checksumStruct.unpack_from(self.__map, \
+			self.__checksumsOffset + i * self.__checksumStruct.size)
+
+	def __searchChangedChecksums(self, prefix):
+		prefix = Checksum.normalizePrefix(prefix)
+		return [ csumstr for csumstr in self.__checksumToPathsMap.keys() \
+			if csumstr.startswith(prefix) ]
+
+	def __setChange(self, path, nid, node):
+		changes = self.__changes.setdefault(path, {})
+		# forget checksum of a previous change of this node
+		if nid in changes and changes[nid] is not None and changes[nid].isFile():
+			csumstr = changes[nid].info.checksum.getString()
+			self.__checksumToPathsMap[csumstr].discard(os.path.join(path, Node.nid2Name(nid)))
+			if len(self.__checksumToPathsMap[csumstr]) == 0:
+				del self.__checksumToPathsMap[csumstr]
+		changes[nid] = node
+		if node is not None and node.isFile():
+			csumstr = node.info.checksum.getString()
+			if not csumstr in self.__checksumToPathsMap:
+				self.__checksumToPathsMap[csumstr] = set()
+			self.__checksumToPathsMap[csumstr].add(os.path.join(path, node.name))
+
+	def __getChildren(self, index, path):
+		# (node, record index) of all children of a directory, sorted by
+		# NID; the record index is None for nodes not in the manifest
+		changes = self.__changes.get(path)
+		if index is None:
+			first, num = 0, 0
+		else:
+			first, num = self.__unpackRecord(index)[8:10]
+		if changes is None:
+			for i in range(first, first + num):
+				yield self.__fetch(i), i
+			return
+		# merge records with changes
+		children = {}
+		for i in range(first, first + num):
+			node = self.__fetch(i)
+			children[node.getNid()] = (node, i)
+		for nid, node in changes.iteritems():
+			if node is None:
+				if nid in children:
+					del children[nid]
+			elif nid in children:
+				children[nid] = (node, children[nid][1])
+			else:
+				children[nid] = (node, None)
+		for nid in sorted(children.keys()):
+			yield children[nid]
+
+	def __countChildren(self, index, path):
+		if index is None:
+			num = 0
+		else:
+			num = self.__unpackRecord(index)[9]
+		for nid, node in self.__changes.get(path, {}).iteritems():
+			inRecords = self.__findRecord(index, nid) is not None
+			if node is None and inRecords:
+				num -= 1
+			elif node is not None and not inRecords:
+				num += 1
+		return num
+
+	def __writeManifest(self):
+		# write new manifest from records and changes, then replace the
+		# old manifest
+		tmpfile = self.__manifestFile + '.tmp'
+		f = open(tmpfile, 'w+b')
+		names = tempfile.TemporaryFile()
+		f.write(self.__headerStruct.pack(self.__magic, self.__version, \
+			self.__blockSize, 0, 0, 0, 0, 0, 0))
+		checksums = []
+		nameoff = 0
+		# root directory
+		if self.__map is None:
+			rootIndex = None
+		else:
+			rootIndex = 0
+		numRecords = 1
+		nextFirst = 1
+		num = self.__countChildren(rootIndex, '')
+		f.write(self.__recordStruct.pack(True, 0, 0, 0, 0, 0, 0, 0, nextFirst, num, 32 * '\0'))
+		nextFirst += num
+		# breadth-first traversal: record index of a directory in the old
+		# manifest, its path, its record index in the new manifest
+		queue = [ (rootIndex, '', 0) ]
+		while len(queue) > 0:
+			oldIndex, path, newIndex = queue.pop(0)
+			for node, index in list(self.__getChildren(oldIndex, path)):
+				name = node.name.encode('utf-8')
+				names.write(name)
+				if node.isDirectory():
+					childPath = os.path.join(path, node.name)
+					num = self.__countChildren(index, childPath)
+					f.write(self.__recordStruct.pack(True, len(name), nameoff, newIndex, \
+						0, 0, 0, 0, nextFirst, num, 32 * '\0'))
+					nextFirst += num
+					queue.append((index, childPath, numRecords))
+				else:
+					checksum = str(node.info.checksum.getBinary())
+					values = [ self.__noneValue if v is None else v for v in \
+						(node.info.size, node.info.ctime, node.info.atime, node.info.mtime) ]
+					f.write(self.__recordStruct.pack(*([ False, len(name), nameoff, newIndex ] + \
+						values + [ 0, 0, checksum ])))
+					checksums.append((checksum, numRecords))
+				nameoff += len(name)
+				numRecords += 1
+		if not numRecords == nextFirst:
+			raise MyException('Inconsistent number of records in manifest.', 3)
+		checksums.sort()
+		checksumsOffset = f.tell()
+		for checksum, index in checksums:
+			f.write(self.__checksumStruct.pack(checksum, index))
+		namesOffset = f.tell()
+		names.seek(0)
+		shutil.copyfileobj(names, f)
+		names.close()
+		blocksOffset = f.tell()
+		numBlocks = (blocksOffset + self.__blockSize - 1) // self.__blockSize
+		f.seek(0)
+		f.write(self.__headerStruct.pack(self.__magic, self.__version, self.__blockSize, \
+			numRecords, checksumsOffset, len(checksums), namesOffset, blocksOffset, numBlocks))
+		# digests of the blocks, see the note about the signature
+		f.seek(0)
+		digests = []
+		for i in range(numBlocks):
+			digests.append(hashlib.sha256(f.read(self.__blockSize)).digest())
+		f.seek(blocksOffset)
+		f.write(''.join(digests))
+		f.close()
+		self.close()
+		try:
+			os.rename(tmpfile, self.__manifestFile)
+		except OSError:
+			# renaming to an existing file fails on windows
+			os.remove(self.__manifestFile)
+			os.rename(tmpfile, self.__manifestFile)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gc
+import hashlib
+import os
+import sys
+import time
+
+from coltree import ColumnTree
+from misc import Checksum, sizeToString
+from node import NodeInfo, Node, NodeStatus
+
+
+
+# Memory benchmark of nodes: builds file nodes with node infos and
+# checksums like the trees keeping them in memory do and reports the
+# memory needed per node, see NodeInfo. With 'column' the nodes are
+# inserted into a ColumnTree (like the result of a diff with all files
+# of the old and the new tree) instead of being kept as objects.
+#
+# usage: membench.py [number of nodes, default 10 million] [column]
+
+
+
+def getResidentSize():
+	# resident set size of this process in bytes, None if unknown
+	try:
+		f = open('/proc/self/statm', 'r')
+		pages = int(f.read().split()[1])
+		f.close()
+		return pages * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, OSError, ValueError):
+		pass
+	try:
+		import resource
+	except ImportError:
+		return None
+	# peak instead of current size; kilobytes on Linux, bytes on Mac OS X
+	size = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		return size
+	else:
+		return size * 1024
+
+
+
+def generateNodes(count):
+	# distinct names, timestamps and checksums for each node, just like
+	# the nodes of a real directory tree
+	for i in xrange(count):
+		node = Node(u'file{0:010d}.dat'.format(i))
+		node.dbkey = i + 1
+		node.info = NodeInfo()
+		node.info.size = 1000 + i
+		node.info.ctime = 1300000000 * 10**9 + 3 * i
+		node.info.atime = 1300000000 * 10**9 + 3 * i + 1
+		node.info.mtime = 1300000000 * 10**9 + 3 * i + 2
+		node.info.checksum = Checksum()
+		node.info.checksum.setBinary(buffer(hashlib.sha256(str(i)).digest()))
+		# trees use the NID of each node, so it is built anyway
+		node.getNid()
+		yield node
+
+
+
+def buildNodes(count):
+	return list(generateNodes(count))
+
+
+
+def buildColumnTree(count):
+	# 1000 files per directory
+	tree = ColumnTree()
+	tree.open()
+	directory = None
+	for i, node in enumerate(generateNodes(count)):
+		if i % 1000 == 0:
+			if directory is not None:
+				tree.up()
+			directory = Node(u'dir{0:07d}'.format(i // 1000))
+			tree.insert(directory)
+			tree.down(directory)
+		node.otherinfo = node.info
+		node.status = NodeStatus.Ok
+		tree.insert(node)
+	tree.gotoRoot()
+	return tree
+
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		count = int(sys.argv[1])
+	else:
+		count = 10 * 1000 * 1000
+	column = len(sys.argv) > 2 and sys.argv[2] == 'column'
+	gc.collect()
+	before = getResidentSize()
+	start = time.time()
+	if column:
+		tree = buildColumnTree(count)
+	else:
+		nodes = buildNodes(count)
+	seconds = time.time() - start
+	gc.collect()
+	after = getResidentSize()
+	print('built {0:d} nodes in {1:.1f} seconds'.format(count, seconds))
+	if column:
+		print('column tree {0:s}, {1:.1f} bytes per node'.format( \
+			sizeToString(tree.getMemoryUsage()), float(tree.getMemoryUsage()) / count))
+	if before is None or after is None:
+		print('memory usage unknown on this platform')
+	else:
+		print('memory {0:s}, {1:.1f} bytes per node'.format( \
+			sizeToString(after - before), float(after - before) / count))
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import array
 import os
 
 from misc import MyException
-from node import Node
+from node import Node, NodeStatus
 from tree import Tree
 
 
@@ -13,8 +14,14 @@ class MemoryTreeNode():
 
 	def __init__(self, node):
 		self.node = node
+		# status the node is counted with, the node itself may have been
+		# changed without updating the tree yet
+		self.status = node.status
 		if node.isDirectory():
 			self.children = {}
+			# numbers of children and of all descendants of each status
+			self.counts = array.array('l', [ 0 ] * NodeStatus.NumStatuses)
+			self.totals = array.array('l', [ 0 ] * NodeStatus.NumStatuses)
 
 
 
@@ -46,6 +53,7 @@ class MemoryTree(Tree):
 	def clear(self):
 		self.__parentMTNStack = [ MemoryTreeNode(Node('')) ]
 		self.__checksumToPathsMap = {}
+		self.__sortedChecksums = None
 
 	def getDepth(self):
 		return len(self.__parentMTNStack) - 1
@@ -82,15 +90,27 @@ class MemoryTree(Tree):
 			return len(self.__parentMTNStack[-1].children[node.getNid()].children)
 
 	def insert(self, node):
-		self.__parentMTNStack[-1].children[node.getNid()] = MemoryTreeNode(node)
+		children = self.__parentMTNStack[-1].children
+		nid = node.getNid()
+		if nid in children:
+			# replacing a node (and its descendants)
+			self.__countNode(children[nid], -1)
+		children[nid] = MemoryTreeNode(node)
+		self.__countNode(children[nid], 1)
 		if node.isFile():
 			csumstr = node.info.checksum.getString()
 			if not csumstr in self.__checksumToPathsMap:
 				self.__checksumToPathsMap[csumstr] = set()
+				self.__sortedChecksums = None
 			self.__checksumToPathsMap[csumstr].add(self.getPath(node))
 
 	def update(self, node):
-		self.__parentMTNStack[-1].children[node.getNid()].node = node
+		mtn = self.__parentMTNStack[-1].children[node.getNid()]
+		if not mtn.status == node.status:
+			self.__countStatus(mtn.status, -1)
+			self.__countStatus(node.status, 1)
+		mtn.node = node
+		mtn.status = node.status
 
 	def delete(self, node):
 		if not self.isChildless(node):
@@ -105,7 +125,9 @@ class MemoryTree(Tree):
 			self.__checksumToPathsMap[csumstr].remove(self.getPath(node))
 			if len(self.__checksumToPathsMap[csumstr]) == 0:
 				del self.__checksumToPathsMap[csumstr]
+				self.__sortedChecksums = None
 		# remove node from buffer
+		self.__countStatus(self.__parentMTNStack[-1].children[nid].status, -1)
 		del self.__parentMTNStack[-1].children[nid]
 
 	def commit(self):
@@ -144,7 +166,40 @@ class MemoryTree(Tree):
 	def globalGetPathsByChecksum(self, checksumString):
 		if checksumString in self.__checksumToPathsMap:
 			return self.__checksumToPathsMap[checksumString]
+		elif len(checksumString) < 64:
+			# abbreviated checksum: paths of all matching checksums
+			result = set()
+			for csumstr in self.globalGetChecksumsByPrefix(checksumString):
+				result |= self.__checksumToPathsMap[csumstr]
+			return result
 		else:
 			return set()
 
+	def globalGetChecksumsByPrefix(self, prefix, limit=None):
+		# sorted list of checksums is created on demand
+		if self.__sortedChecksums is None:
+			self.__sortedChecksums = sorted(self.__checksumToPathsMap.keys())
+		return Tree.searchSortedChecksums(self.__sortedChecksums, prefix, limit)
+
+	def getStatusCounts(self, recursive=False):
+		if recursive:
+			return self.__parentMTNStack[-1].totals.tolist()
+		else:
+			return self.__parentMTNStack[-1].counts.tolist()
+
 	### the following methods are not implementations of base class methods
+
+	def __countStatus(self, status, delta):
+		# count a child of the current directory, which is a descendant
+		# of all directories up to the root
+		self.__parentMTNStack[-1].counts[status] += delta
+		for mtn in self.__parentMTNStack:
+			mtn.totals[status] += delta
+
+	def __countNode(self, mtn, delta):
+		self.__countStatus(mtn.status, delta)
+		if mtn.node.isDirectory():
+			for status in range(NodeStatus.NumStatuses):
+				if not mtn.totals[status] == 0:
+					for parent in self.__parentMTNStack:
+						parent.totals[status] += delta * mtn.totals[status]
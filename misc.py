@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import binascii
+import datetime
 import hashlib
 import os
+import re
 import wx
 
 
@@ -27,6 +29,17 @@ def sizeToString(size):
 
 
 
+def timestampToString(timestamp, abbreviate=True):
+	# timestamps are integer nanoseconds since the epoch,
+	# they are converted to local time just for displaying
+	seconds = timestamp // 10**9
+	result = datetime.datetime.fromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S')
+	if not abbreviate:
+		result += '.{0:09d}'.format(timestamp - seconds * 10**9)
+	return result
+
+
+
 class MyException(Exception):
 
 	def __init__(self, message, level):
@@ -37,6 +50,10 @@ class MyException(Exception):
 	def __str__(self):
 		return self.__getPrefix() + ': ' + self.__message
 
+	def __reduce__(self):
+		# necessary for passing exceptions between processes
+		return (MyException, (self.__message, self.__level))
+
 	def __getPrefix(self):
 		if self.__level == 0:
 			return 'Info'
@@ -69,9 +86,13 @@ class MyException(Exception):
 
 class Checksum(object):
 
+	# one per file node, see NodeInfo
+	__slots__ = ('__checksum',)
+
+	__checksumbits = 256
+
 	def __init__(self):
 		self.__checksum = None # is of type 'buffer'
-		self.__checksumbits = 256
 
 	def __str__(self):
 		return self.getString()
@@ -79,8 +100,11 @@ class Checksum(object):
 	def __eq__(self, other):
 		if other is None:
 			return False
+		elif self.__checksum is None or other.__checksum is None:
+			return self.__checksum is None and other.__checksum is None
 		else:
-			return self.getString() == other.getString()
+			# the digest may be a buffer or a string
+			return str(self.__checksum) == str(other.__checksum)
 
 	def __ne__(self, other):
 		return not self.__eq__(other)
@@ -95,6 +119,18 @@ class Checksum(object):
 		result.__checksum = self.__checksum[:]
 		return result
 
+	def __getstate__(self):
+		# buffer objects cannot be pickled
+		if self.__checksum is None:
+			return { 'checksum' : None }
+		else:
+			return { 'checksum' : str(self.__checksum) }
+
+	def __setstate__(self, state):
+		self.__init__()
+		if state['checksum'] is not None:
+			self.__checksum = buffer(state['checksum'])
+
 	def setBinary(self, checksum):
 		if not len(checksum) == self.__checksumbits/8:
 			raise MyException('Wrong checksum size.', 3)
@@ -117,6 +153,24 @@ class Checksum(object):
 			else:
 				return unicode(binascii.hexlify(self.__checksum))
 
+	@staticmethod
+	def normalizePrefix(prefix):
+		# checksum prefixes are hex strings of any length up to a full checksum
+		if len(prefix) > 64 or re.match('^[0-9a-fA-F]*$', prefix) is None:
+			raise MyException('Invalid checksum string \'' + prefix + '\'.', 2)
+		return prefix.lower()
+
+	@staticmethod
+	def prefixToBinaryRange(prefix):
+		# range [low, high) of binary checksums starting with the hex string
+		# prefix, high is None if there is no upper limit
+		prefix = Checksum.normalizePrefix(prefix)
+		low = binascii.unhexlify(prefix + (len(prefix) % 2) * '0')
+		high = binascii.unhexlify(prefix + (len(prefix) % 2) * 'f').rstrip('\xff')
+		if len(high) == 0:
+			return buffer(low), None
+		return buffer(low), buffer(high[:-1] + chr(ord(high[-1]) + 1))
+
 	def calculateForFile(self, path, signalBytesDone=None):
 		checksum = hashlib.sha256()
 		buffersize = 2**24
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import struct
+
+from misc import MyException
+from node import NodeStatus
+from tree import WalkOrder
+
+
+
+class MoveKind:
+
+	Moved = 0
+	Renamed = 1
+	Copied = 2
+
+	@staticmethod
+	def toString(kind):
+		if kind == MoveKind.Moved:
+			return 'Moved'
+		elif kind == MoveKind.Renamed:
+			return 'Renamed'
+		elif kind == MoveKind.Copied:
+			return 'Copied'
+		else:
+			raise MyException('Not existing move kind {0:d}'.format(kind), 3)
+
+
+
+class Move(object):
+
+	def __init__(self, kind, source, destination, isdir):
+		self.kind = kind
+		# paths relative to the root directory
+		self.source = source
+		self.destination = destination
+		self.isdir = isdir
+
+	def __str__(self):
+		return '{0:s} \'{1:s}\' -> \'{2:s}\''.format( \
+			MoveKind.toString(self.kind), self.source, self.destination)
+
+
+
+class MoveDetector(object):
+
+	# --------------------------------------
+	# A note about move detection
+	# --------------------------------------
+	# Moving a directory shows up in the diff as a missing directory and
+	# a new one with the same contents. The detector collects all new and
+	# missing nodes of a diff result in hash tables and joins them: first
+	# whole directories by a hash over the paths and checksums of their
+	# contents, then the remaining files by checksum (and size, if known
+	# on both sides). A new file without a missing counterpart is a copy
+	# if its checksum still exists in the old tree at a path that did not
+	# change. All lookups in the old tree are done in a single batch, see
+	# Tree.globalGetPathsByChecksums().
+
+	def __init__(self, view, old):
+		self.__view = view
+		self.__old = old
+		# empty files are not considered to be moved or copied, see
+		# DuplicateFinder; their directories still are
+		self.__minSize = 1
+
+	def detect(self):
+		# list of moves found in the diff result (view), the view has to
+		# be at its root directory and is there again afterwards
+		if not self.__view.isRoot():
+			raise MyException('Move detection has to start at the root directory.', 3)
+		self.__newDirs = {}
+		self.__missingDirs = {}
+		self.__newFiles = {}
+		self.__missingFiles = {}
+		self.__changedPaths = set()
+		self.__movedDirs = {}
+		self.__collect()
+		moves = self.__joinDirectories()
+		moves.extend(self.__joinFiles())
+		return sorted(moves, key=lambda move: move.destination)
+
+	def __collect(self):
+		# new and missing directories are collected as a whole
+		descend = lambda node: not (node.status == NodeStatus.New or \
+			node.status == NodeStatus.Missing)
+		for path, node, event in self.__view.walk(None, WalkOrder.PreOrder, descend):
+			if node.status == NodeStatus.New or node.status == NodeStatus.Missing:
+				if node.status == NodeStatus.New:
+					dirs, files = self.__newDirs, self.__newFiles
+				else:
+					dirs, files = self.__missingDirs, self.__missingFiles
+					self.__changedPaths.add(path)
+				if node.isDirectory():
+					contents = self.__getContents(node)
+					if node.status == NodeStatus.Missing:
+						self.__changedPaths.update([ os.path.join(path, relpath) \
+							for relpath, isdir, csumstr, size in contents ])
+					contenthash = MoveDetector.__contentHash(contents)
+					dirs.setdefault(contenthash, []).append((path, contents))
+				elif not self.__isTooSmall(node.info.size):
+					files.setdefault(node.info.checksum.getString(), []).append( \
+						(path, node.info.size))
+			elif node.status == NodeStatus.FileWarning or node.status == NodeStatus.FileError:
+				self.__changedPaths.add(path)
+
+	def __getContents(self, node):
+		# (relative path, isdir, checksum string, size) of all descendants
+		result = []
+		self.__view.down(node)
+		prefix = self.__view.getPath()
+		for path, n, event in self.__view.walk():
+			relpath = os.path.relpath(path, prefix)
+			if n.isDirectory():
+				result.append((relpath, True, None, None))
+			else:
+				result.append((relpath, False, n.info.checksum.getString(), n.info.size))
+		self.__view.up()
+		return result
+
+	@staticmethod
+	def __contentHash(contents):
+		checksum = hashlib.sha256()
+		for relpath, isdir, csumstr, size in contents:
+			data = relpath.encode('utf-8')
+			checksum.update(struct.pack('>?q', isdir, len(data)) + data)
+			if not isdir:
+				checksum.update(csumstr)
+		return checksum.digest()
+
+	def __joinDirectories(self):
+		moves = []
+		for contenthash, destinations in self.__newDirs.iteritems():
+			sources = self.__missingDirs.get(contenthash, [])
+			# directories without files have nothing to compare
+			if all([ isdir for p, isdir, c, s in destinations[0][1] ]):
+				sources = []
+			pairs = self.__pair(destinations, sources)
+			for dst, src in pairs:
+				moves.append(MoveDetector.__createMove(src[0], dst[0], True))
+				self.__movedDirs[src[0]] = dst[0]
+			# files of directories not matched are joined one by one
+			paired = set([ dst[0] for dst, src in pairs ])
+			for path, contents in destinations:
+				if path not in paired:
+					self.__addContents(self.__newFiles, path, contents)
+		for contenthash, sources in self.__missingDirs.iteritems():
+			for path, contents in sources:
+				if path not in self.__movedDirs:
+					self.__addContents(self.__missingFiles, path, contents)
+		return moves
+
+	def __addContents(self, files, path, contents):
+		for relpath, isdir, csumstr, size in contents:
+			if not isdir and not self.__isTooSmall(size):
+				files.setdefault(csumstr, []).append((os.path.join(path, relpath), size))
+
+	def __isTooSmall(self, size):
+		# sizes of imported checksums may be unknown
+		return size is not None and size < self.__minSize
+
+	def __joinFiles(self):
+		moves = []
+		unmatched = {}
+		# new files with missing files of the same checksum: moves
+		for csumstr, destinations in self.__newFiles.iteritems():
+			sources = self.__missingFiles.get(csumstr, [])
+			pairs = self.__pair(destinations, sources, True)
+			for dst, src in pairs:
+				moves.append(MoveDetector.__createMove(src[0], dst[0], False))
+			paired = set([ dst[0] for dst, src in pairs ])
+			remaining = [ dst[0] for dst in destinations if dst[0] not in paired ]
+			if len(remaining) > 0:
+				unmatched[csumstr] = (remaining, [ dst[0] for dst, src in pairs ])
+		# remaining new files with checksums of unchanged files: copies
+		origins = self.__old.globalGetPathsByChecksums(unmatched.keys())
+		for csumstr, (destinations, moved) in unmatched.iteritems():
+			sources = set()
+			for path in origins.get(csumstr, set()):
+				if path not in self.__changedPaths:
+					sources.add(path)
+				else:
+					path = self.__getMovedPath(path)
+					if path is not None:
+						sources.add(path)
+			sources = sorted(sources) + sorted(moved)
+			if len(sources) == 0:
+				continue
+			for dstpath in destinations:
+				moves.append(Move(MoveKind.Copied, sources[0], dstpath, False))
+		return moves
+
+	def __getMovedPath(self, path):
+		# new path of a file in a moved directory, None for other files
+		dirpath, relpath = os.path.split(path)
+		while not dirpath == '':
+			if dirpath in self.__movedDirs:
+				return os.path.join(self.__movedDirs[dirpath], relpath)
+			dirpath, name = os.path.split(dirpath)
+			relpath = os.path.join(name, relpath)
+		return None
+
+	def __pair(self, destinations, sources, sized=False):
+		# pair each destination with at most one source, sources with the
+		# same name first; destinations and sources are tuples starting
+		# with their paths, all of them have the same checksum; if sized,
+		# they are files (path, size) whose sizes have to match unless
+		# unknown; the sources are joined in hash tables, so large groups
+		# of identical files are paired in linear time
+		result = []
+		if len(sources) == 0:
+			return result
+		# name -> size -> sources and size -> sources, in reversed order
+		byname = {}
+		anyname = {}
+		for src in reversed(sources):
+			if sized:
+				size = src[1]
+			else:
+				size = None
+			byname.setdefault(os.path.basename(src[0]), {}).setdefault(size, []).append(src)
+			anyname.setdefault(size, []).append(src)
+		paired = set()
+		unpaired = []
+		for dst in destinations:
+			src = MoveDetector.__popSource(byname.get(os.path.basename(dst[0]), {}), \
+				dst, sized, paired)
+			if src is None:
+				unpaired.append(dst)
+			else:
+				result.append((dst, src))
+		for dst in unpaired:
+			src = MoveDetector.__popSource(anyname, dst, sized, paired)
+			if src is not None:
+				result.append((dst, src))
+		return result
+
+	@staticmethod
+	def __popSource(bysize, dst, sized, paired):
+		# first source not paired yet of a size matching the destination
+		if not sized:
+			sizes = [ None ]
+		elif dst[1] is None:
+			sizes = sorted(bysize.keys())
+		else:
+			sizes = [ dst[1], None ]
+		for size in sizes:
+			sources = bysize.get(size, [])
+			while len(sources) > 0:
+				src = sources.pop()
+				if src[0] not in paired:
+					paired.add(src[0])
+					return src
+		return None
+
+	@staticmethod
+	def __createMove(source, destination, isdir):
+		if os.path.dirname(source) == os.path.dirname(destination):
+			return Move(MoveKind.Renamed, source, destination, isdir)
+		else:
+			return Move(MoveKind.Moved, source, destination, isdir)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import copy
-from misc import MyException, sizeToString
+from misc import MyException, sizeToString, timestampToString
 
 
 
@@ -55,10 +55,50 @@ class NodeStatus:
 		else:
 			raise MyException('Not existing node status {0:d}'.format(status), 3)
 
+	@staticmethod
+	def aggregate(counts):
+		# status of a directory from the numbers of its children of each
+		# status (list indexed by status); children of undefined status
+		# are ignored
+		if sum(counts) == 0:
+			return NodeStatus.Ok
+		result = NodeStatus.Undefined
+		for status, statuses in [ \
+			(NodeStatus.DirContainsNew, [ NodeStatus.New, NodeStatus.DirContainsNew ]), \
+			(NodeStatus.DirContainsMissing, [ NodeStatus.Missing, NodeStatus.DirContainsMissing ]), \
+			(NodeStatus.Ok, [ NodeStatus.Ok ]), \
+			(NodeStatus.DirContainsWarning, [ NodeStatus.FileWarning, NodeStatus.DirContainsWarning ]), \
+			(NodeStatus.DirContainsError, [ NodeStatus.FileError, NodeStatus.DirContainsError ]), \
+			(NodeStatus.DirContainsMulti, [ NodeStatus.DirContainsMulti ])]:
+			if sum([ counts[s] for s in statuses ]) > 0:
+				if not result == NodeStatus.Undefined:
+					return NodeStatus.DirContainsMulti
+				result = status
+		return result
+
+	@staticmethod
+	def countProblems(counts):
+		# number of nodes that are not Ok themselves (directories only
+		# containing such nodes are not counted)
+		return counts[NodeStatus.New] + counts[NodeStatus.Missing] + \
+			counts[NodeStatus.FileWarning] + counts[NodeStatus.FileError]
+
 
 
 class NodeInfo(object):
 
+	# --------------------------------------
+	# A note about the memory of nodes
+	# --------------------------------------
+	# Trees like MemoryTree and the buffers of DatabaseTree hold millions
+	# of nodes, so nodes and node infos have fixed slots instead of a
+	# dictionary of attributes each. Sizes and timestamps (nanoseconds
+	# since the epoch) are plain integers, the checksum keeps the binary
+	# digest only. See membench.py for measuring the memory per node.
+	__slots__ = ('size', 'ctime', 'atime', 'mtime', 'checksum')
+
+	NoneString = ''
+
 	def __init__(self):
 		self.size = None
 		self.ctime = None
@@ -66,8 +106,6 @@ class NodeInfo(object):
 		self.mtime = None
 		self.checksum = None
 
-		self.NoneString = ''
-
 	def __str__(self):
 		return '(' + \
 			'size="' + self.getSizeString() + '", ' + \
@@ -107,6 +145,13 @@ class NodeInfo(object):
 		result.checksum = copy.deepcopy(self.checksum, memo)
 		return result
 
+	def __getstate__(self):
+		# objects with slots cannot be pickled without this
+		return (self.size, self.ctime, self.atime, self.mtime, self.checksum)
+
+	def __setstate__(self, state):
+		self.size, self.ctime, self.atime, self.mtime, self.checksum = state
+
 	def getSizeString(self, abbreviate=True):
 		if self.size is None:
 			return self.NoneString
@@ -120,28 +165,19 @@ class NodeInfo(object):
 		if self.ctime is None:
 			return self.NoneString
 		else:
-			if abbreviate:
-				return self.ctime.strftime('%Y-%m-%d %H:%M:%S')
-			else:
-				return str(self.ctime)
+			return timestampToString(self.ctime, abbreviate)
 
 	def getATimeString(self, abbreviate=True):
 		if self.atime is None:
 			return self.NoneString
 		else:
-			if abbreviate:
-				return self.atime.strftime('%Y-%m-%d %H:%M:%S')
-			else:
-				return str(self.atime)
+			return timestampToString(self.atime, abbreviate)
 
 	def getMTimeString(self, abbreviate=True):
 		if self.mtime is None:
 			return self.NoneString
 		else:
-			if abbreviate:
-				return self.mtime.strftime('%Y-%m-%d %H:%M:%S')
-			else:
-				return str(self.mtime)
+			return timestampToString(self.mtime, abbreviate)
 
 	def getChecksumString(self, abbreviate=True):
 		if self.checksum is None:
@@ -160,6 +196,11 @@ class NodeInfo(object):
 
 class Node(object):
 
+	# no dictionary of attributes, see NodeInfo
+	__slots__ = ('dbkey', 'name', 'info', 'otherinfo', 'status', '__nid', '__nidName')
+
+	NoneString = ''
+
 	def __init__(self, name=None):
 		# unique (at least at dir level) node identifier in database and filesystem
 		self.dbkey = None
@@ -169,8 +210,9 @@ class Node(object):
 		self.otherinfo = None
 		# node status
 		self.status = NodeStatus.Undefined
-
-		self.NoneString = ''
+		# cached NID and the name it has been constructed of, see getNid()
+		self.__nid = None
+		self.__nidName = None
 
 	def __str__(self):
 		return '(' + \
@@ -186,6 +228,8 @@ class Node(object):
 		result.dbkey = self.dbkey
 		result.name = self.name
 		result.info = self.info
+		result.__nid = self.__nid
+		result.__nidName = self.__nidName
 		return result
 
 	def __deepcopy__(self, memo):
@@ -196,6 +240,15 @@ class Node(object):
 		result.info = copy.deepcopy(self.info, memo)
 		return result
 
+	def __getstate__(self):
+		# objects with slots cannot be pickled without this
+		return (self.dbkey, self.name, self.info, self.otherinfo, self.status)
+
+	def __setstate__(self, state):
+		self.dbkey, self.name, self.info, self.otherinfo, self.status = state
+		self.__nid = None
+		self.__nidName = None
+
 	def __eq__(self, other):
 		# does not check equality of node info (!), see getNid()
 		return self.getNid() == other.getNid()
@@ -220,7 +273,15 @@ class Node(object):
 		# state 'New', therefore two nodes with the same name. This is the
 		# reason to use the Nid as identifier containing a isdir flag and
 		# the name. Node comparison is based on this method, too.
-		return Node.constructNid(self.name, self.isDirectory())
+		# The NID is cached, it is constructed again when the name or the
+		# type of the node has changed.
+		nid = self.__nid
+		if nid is None or self.__nidName is not self.name or \
+			not (nid[0] == u'0') == (self.info is None):
+			nid = Node.constructNid(self.name, self.isDirectory())
+			self.__nid = nid
+			self.__nidName = self.name
+		return nid
 
 	@staticmethod
 	def constructNid(name, isdir):
@@ -340,7 +401,15 @@ class NodeStatistics:
 			self.__dircount += 1
 		else:
 			self.__filecount += 1
-			self.__filesize += node.info.size
+			# sizes of imported checksums may be unknown
+			if node.info.size is not None:
+				self.__filesize += node.info.size
+
+	def addCounts(self, dircount, filecount, filesize):
+		# numbers counted without looking at the nodes, see ColumnTree
+		self.__dircount += dircount
+		self.__filecount += filecount
+		self.__filesize += filesize
 
 	def add(self, other):
 		self.__dircount += other.__dircount
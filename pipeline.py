@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import Queue
+import threading
+
+from misc import MyException, Checksum
+
+
+
+class HashJob(object):
+
+	def __init__(self, path):
+		self.path = path
+		# checksum taken from a check journal instead of calculated
+		self.fromJournal = False
+		self.__checksum = None
+		self.__stat = None
+		self.__error = None
+		self.__done = threading.Event()
+
+	def finish(self, checksum, stat, error):
+		self.__checksum = checksum
+		self.__stat = stat
+		self.__error = error
+		self.__done.set()
+
+	def wait(self):
+		# checksum and stat of the file, stat taken after calculating the
+		# checksum; errors of the worker are raised here
+		self.__done.wait()
+		if self.__error is not None:
+			raise self.__error
+		return self.__checksum, self.__stat
+
+
+
+class HashPipeline(object):
+
+	# --------------------------------------
+	# A note about the check pipeline
+	# --------------------------------------
+	# A check has several stages: walking the directories, calculating
+	# checksums, comparing the nodes and writing the result tree. Walking,
+	# comparing and writing share the cursors of the trees, so they run
+	# in the thread of the diff. Calculating the checksums is done by a
+	# number of worker threads of this pipeline: the file system tree
+	# submits the files of a directory ahead of the diff (see
+	# FilesystemTree.registerPipeline()) and the diff waits for the job
+	# when it needs the checksum. Reading files and hashing release the
+	# interpreter lock, so disks keep busy while the diff does its
+	# bookkeeping. The job queue is bounded: submitting blocks if the
+	# workers cannot keep up, so the walk never runs far ahead.
+
+	def __init__(self, numWorkers=4, queueSize=None):
+		if numWorkers < 1:
+			raise MyException('Pipeline needs at least one worker.', 3)
+		if queueSize is None:
+			queueSize = 2 * numWorkers
+		self.__queue = Queue.Queue(queueSize)
+		self.__cancelled = False
+		self.__workers = []
+		for i in range(numWorkers):
+			worker = threading.Thread(target=self.__work)
+			worker.daemon = True
+			worker.start()
+			self.__workers.append(worker)
+
+	def submit(self, path):
+		job = HashJob(path)
+		self.__queue.put(job)
+		return job
+
+	def close(self):
+		# jobs still in the queue are not calculated anymore
+		self.__cancelled = True
+		for worker in self.__workers:
+			self.__queue.put(None)
+		for worker in self.__workers:
+			worker.join()
+		self.__workers = []
+
+	def __work(self):
+		while True:
+			job = self.__queue.get()
+			if job is None:
+				return
+			if self.__cancelled:
+				job.finish(None, None, MyException('Pipeline has been closed.', 3))
+				continue
+			try:
+				checksum = Checksum()
+				checksum.calculateForFile(job.path)
+				job.finish(checksum, os.stat(job.path), None)
+			except (MyException, IOError, OSError) as e:
+				job.finish(None, None, e)
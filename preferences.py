@@ -16,6 +16,11 @@ class Preferences:
 		return json.dumps({ \
 			'includes' : self.includes, \
 			'excludes' : self.excludes, \
+			'sharded' : self.sharded, \
+			'manifest' : self.manifest, \
+			'hashThreads' : self.hashThreads, \
+			'scrubGigabytes' : self.scrubGigabytes, \
+			'scrubMinutes' : self.scrubMinutes, \
 			}, indent='\t')
 
 	def __eq__(self, other):
@@ -23,7 +28,12 @@ class Preferences:
 			return False
 		else:
 			return self.includes == other.includes and \
-				self.excludes == other.excludes
+				self.excludes == other.excludes and \
+				self.sharded == other.sharded and \
+				self.manifest == other.manifest and \
+				self.hashThreads == other.hashThreads and \
+				self.scrubGigabytes == other.scrubGigabytes and \
+				self.scrubMinutes == other.scrubMinutes
 
 	def __ne__(self, other):
 		return not self.__eq__(other)
@@ -32,15 +42,37 @@ class Preferences:
 		result = Preferences()
 		result.includes = self.includes
 		result.excludes = self.excludes
+		result.sharded = self.sharded
+		result.manifest = self.manifest
+		result.hashThreads = self.hashThreads
+		result.scrubGigabytes = self.scrubGigabytes
+		result.scrubMinutes = self.scrubMinutes
 		return result
 
 	def __deepcopy__(self, memo):
 		result = Preferences()
 		result.includes = copy.deepcopy(self.includes, memo)
 		result.excludes = copy.deepcopy(self.excludes, memo)
+		result.sharded = self.sharded
+		result.manifest = self.manifest
+		result.hashThreads = self.hashThreads
+		result.scrubGigabytes = self.scrubGigabytes
+		result.scrubMinutes = self.scrubMinutes
 		return result
 
 	def setDefaults(self):
+		# one database per top level directory, see ShardedDatabaseTree;
+		# this is only used when importing a directory
+		self.sharded = False
+		# a flat binary manifest instead of a database for read-mostly
+		# archives, see ManifestTree; this is only used when importing
+		self.manifest = False
+		# number of threads calculating checksums during a check, see
+		# HashPipeline; zero calculates them in the thread of the check
+		self.hashThreads = 4
+		# budget of a single scrub, see Scrubber; zero means no limit
+		self.scrubGigabytes = 100
+		self.scrubMinutes = 60
 		self.includes = []
 		self.excludes = [
 			u'Thumbs.db', \
@@ -74,3 +106,13 @@ class Preferences:
 			self.includes = pdict['includes']
 		if 'excludes' in pdict:
 			self.excludes = pdict['excludes']
+		if 'sharded' in pdict:
+			self.sharded = pdict['sharded']
+		if 'manifest' in pdict:
+			self.manifest = pdict['manifest']
+		if 'hashThreads' in pdict:
+			self.hashThreads = pdict['hashThreads']
+		if 'scrubGigabytes' in pdict:
+			self.scrubGigabytes = pdict['scrubGigabytes']
+		if 'scrubMinutes' in pdict:
+			self.scrubMinutes = pdict['scrubMinutes']
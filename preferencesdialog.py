@@ -27,6 +27,31 @@ class PreferencesDialog(wx.Dialog):
 		self.excludeElb = gizmos.EditableListBox(self, -1, 'Files and Dirs')
 		excludeSizer.Add(self.excludeElb, 1, wx.EXPAND|wx.ALL, border)
 
+		databaseBox = wx.StaticBox(self, -1, 'Database (Import only)')
+		databaseSizer = wx.StaticBoxSizer(databaseBox, wx.VERTICAL)
+		self.shardedCheckBox = wx.CheckBox(self, -1, 'Separate database for each top level directory')
+		databaseSizer.Add(self.shardedCheckBox, 0, wx.EXPAND|wx.ALL, border)
+		self.manifestCheckBox = wx.CheckBox(self, -1, 'Flat manifest file for read-mostly archives')
+		databaseSizer.Add(self.manifestCheckBox, 0, wx.EXPAND|wx.ALL, border)
+
+		checkBox = wx.StaticBox(self, -1, 'Check')
+		checkSizer = wx.StaticBoxSizer(checkBox, wx.HORIZONTAL)
+		checkSizer.Add(wx.StaticText(self, -1, 'Threads for checksum calculation'), \
+			1, wx.ALIGN_CENTRE_VERTICAL|wx.ALL, border)
+		self.hashThreadsSpinCtrl = wx.SpinCtrl(self, -1, min=0, max=64)
+		checkSizer.Add(self.hashThreadsSpinCtrl, 0, wx.ALL, border)
+
+		scrubBox = wx.StaticBox(self, -1, 'Scrub (0 for no limit)')
+		scrubSizer = wx.StaticBoxSizer(scrubBox, wx.HORIZONTAL)
+		scrubSizer.Add(wx.StaticText(self, -1, 'Gigabytes'), \
+			1, wx.ALIGN_CENTRE_VERTICAL|wx.ALL, border)
+		self.scrubGigabytesSpinCtrl = wx.SpinCtrl(self, -1, min=0, max=1000000)
+		scrubSizer.Add(self.scrubGigabytesSpinCtrl, 0, wx.ALL, border)
+		scrubSizer.Add(wx.StaticText(self, -1, 'Minutes'), \
+			1, wx.ALIGN_CENTRE_VERTICAL|wx.ALL, border)
+		self.scrubMinutesSpinCtrl = wx.SpinCtrl(self, -1, min=0, max=100000)
+		scrubSizer.Add(self.scrubMinutesSpinCtrl, 0, wx.ALL, border)
+
 		# buttons
 		okButton = wx.Button(self, label='OK')
 		okButton.SetFocus()
@@ -41,6 +66,9 @@ class PreferencesDialog(wx.Dialog):
 		sizer = wx.BoxSizer(wx.VERTICAL)
 		sizer.Add(includeSizer, 1, wx.ALL | wx.EXPAND, border)
 		sizer.Add(excludeSizer, 1, wx.ALL | wx.EXPAND, border)
+		sizer.Add(databaseSizer, 0, wx.ALL | wx.EXPAND, border)
+		sizer.Add(checkSizer, 0, wx.ALL | wx.EXPAND, border)
+		sizer.Add(scrubSizer, 0, wx.ALL | wx.EXPAND, border)
 		sizer.Add(buttonsSizer, 0, wx.ALL | wx.ALIGN_CENTER, border)
 		self.SetSizer(sizer)
 		self.CenterOnScreen()
@@ -50,10 +78,20 @@ class PreferencesDialog(wx.Dialog):
 	def SetPreferences(self):
 		self.includeElb.SetStrings(self.preferences.includes)
 		self.excludeElb.SetStrings(self.preferences.excludes)
+		self.shardedCheckBox.SetValue(self.preferences.sharded)
+		self.manifestCheckBox.SetValue(self.preferences.manifest)
+		self.hashThreadsSpinCtrl.SetValue(self.preferences.hashThreads)
+		self.scrubGigabytesSpinCtrl.SetValue(self.preferences.scrubGigabytes)
+		self.scrubMinutesSpinCtrl.SetValue(self.preferences.scrubMinutes)
 
 	def GetPreferences(self):
 		self.preferences.includes = self.includeElb.GetStrings()
 		self.preferences.excludes = self.excludeElb.GetStrings()
+		self.preferences.sharded = self.shardedCheckBox.GetValue()
+		self.preferences.manifest = self.manifestCheckBox.GetValue()
+		self.preferences.hashThreads = self.hashThreadsSpinCtrl.GetValue()
+		self.preferences.scrubGigabytes = self.scrubGigabytesSpinCtrl.GetValue()
+		self.preferences.scrubMinutes = self.scrubMinutesSpinCtrl.GetValue()
 
 	def OkClick(self, event):
 		self.GetPreferences()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import time
 import wx
 
 from misc import sizeToString, MyException
@@ -28,8 +29,16 @@ class FileProcessingProgressDialog(wx.Dialog):
 		self.totalFilesAll = None
 		self.totalBytesDone = None
 		self.totalBytesAll = None
+		self.currentPath = ''
 		self.cancelRequest = False
 
+		# Repainting takes much longer than processing a small file or a
+		# database row, so the dialog is repainted at most a few times per
+		# second; processing is still interrupted that often to react on
+		# the cancel button
+		self.paintInterval = 0.1
+		self.lastPaintTime = 0.0
+
 		border = 5
 
 		self.processingText = wx.StaticText(self, label='Initializing ...')
@@ -136,22 +145,21 @@ class FileProcessingProgressDialog(wx.Dialog):
 
 		if not self.currentBytesDone == self.currentBytesAll:
 			raise MyException('Signaled a new file but the old one is not done yet.', 3)
-		if self.totalBytesDone == 0:
+		if self.totalBytesDone == 0 and self.totalFilesDone == 0:
 			self.processingText.SetLabel('Processing ...')
 		if path is None:
-			self.currentPathText.SetLabel('<No known path>')
+			self.currentPath = '<No known path>'
 		else:
-			self.currentPathText.SetLabel(path)
+			self.currentPath = path
 		self.currentBytesDone = 0
 		if size <= self.gaugeScalingFactor:
 			self.currentBytesFactor = 1
 		else:
 			self.currentBytesFactor = size / self.gaugeScalingFactor
 		self.currentBytesAll = size
-		self.currentBytesGauge.SetRange(size / self.currentBytesFactor)
 		if size == 0:
 			self.totalFilesDone += 1
-		self.OnPaint()
+		self.OnPaintIfDue()
 		if self.cancelRequest:
 			raise UserCancelledException()
 
@@ -175,7 +183,7 @@ class FileProcessingProgressDialog(wx.Dialog):
 		self.totalBytesDone += bytesDone
 		if self.totalBytesDone > self.totalBytesAll:
 			raise MyException('Signaled total files size larger than previously registered total files size.', 3)
-		self.OnPaint()
+		self.OnPaintIfDue()
 		if self.cancelRequest:
 			raise UserCancelledException()
 
@@ -187,10 +195,18 @@ class FileProcessingProgressDialog(wx.Dialog):
 			self.processingText.SetLabel('Canceled by user.')
 		else:
 			self.processingText.SetLabel('All files successfully processed.')
-		self.currentPathText.SetLabel('')
+		self.currentPath = ''
+		self.OnPaint()
 		self.ShowModal()
 
+	def OnPaintIfDue(self):
+		if time.time() - self.lastPaintTime >= self.paintInterval:
+			self.OnPaint()
+
 	def OnPaint(self):
+		self.lastPaintTime = time.time()
+		# path of current file
+		self.currentPathText.SetLabel(self.currentPath)
 		# size of current file
 		if self.currentBytesDone is not None and self.currentBytesAll is not None:
 			self.currentBytesHeader.SetLabel('Current File {0:s}/{1:s}'.format( \
@@ -200,6 +216,7 @@ class FileProcessingProgressDialog(wx.Dialog):
 				self.currentBytesGauge.SetValue(1)
 				self.currentBytesGaugeText.SetLabel('100 %')
 			else:
+				self.currentBytesGauge.SetRange(self.currentBytesAll / self.currentBytesFactor)
 				self.currentBytesGauge.SetValue(self.currentBytesDone / self.currentBytesFactor)
 				self.currentBytesGaugeText.SetLabel('{0:d} %'.format( \
 				(100 * self.currentBytesDone) / self.currentBytesAll))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import copy
+import os
+import time
+
+from misc import MyException
+from node import Node, NodeStatus
+from tree import Tree
+
+
+
+class Scrubber(object):
+
+	# --------------------------------------
+	# A note about scrubbing
+	# --------------------------------------
+	# A check of a large archive reads every file and may take days. The
+	# database keeps the time of the last verification of each file, see
+	# DatabaseTree.setVerified(), and a scrub only calculates the checksums
+	# of the files verified longest ago until a budget of bytes or seconds
+	# is used up. Running it regularly spreads the I/O of a complete check
+	# over many small runs, all files are verified once every few runs.
+	# The files are compared with the database like Tree.diff() does, the
+	# result contains the files not found Ok and their directories. Only
+	# files found Ok count as verified, all others stay at the front of the
+	# queue until they have been accepted or restored. Scrubbing does not
+	# look for new files, this is still the job of a check.
+	# The files of a scrub are selected in advance by their sizes in the
+	# database, see select(), so the progress can be shown without walking
+	# the whole database. The files may have changed since their import,
+	# so the progress reported while calculating their checksums is kept
+	# within the selected totals, a file grown meanwhile just shows a bit
+	# less progress than it takes.
+
+	def __init__(self, fstree, dbtree):
+		self.__fstree = fstree
+		self.__dbtree = dbtree
+		# number of files fetched from the database at once
+		self.__chunkSize = 1000
+		self.__numFiles = 0
+		self.__numBytes = 0
+		# number of files and bytes selected for the next scrub
+		self.__selection = None
+		# progress handlers and the bytes signalled to them so far
+		self.signalNewFile = None
+		self.signalBytesDone = None
+		self.__selectedBytes = 0
+		self.__signalledBytes = 0
+		self.__currentBytesAll = 0
+		self.__currentBytesDone = 0
+
+	def getNumFiles(self):
+		# number of files verified by the last scrub
+		return self.__numFiles
+
+	def getNumBytes(self):
+		return self.__numBytes
+
+	def registerHandlers(self, signalNewFile, signalBytesDone):
+		self.signalNewFile = signalNewFile
+		self.signalBytesDone = signalBytesDone
+
+	def unRegisterHandlers(self):
+		self.signalNewFile = None
+		self.signalBytesDone = None
+
+	def select(self, budgetBytes=None):
+		# select the files verified longest ago as long as their sizes fit
+		# into the budget (the first file always does) for the next scrub;
+		# returns the number of files and bytes selected
+		numFiles = 0
+		numBytes = 0
+		for lastVerified, path, size in \
+			self.__dbtree.getVerificationSizes(int(time.time() * 10**9)):
+			if size is None:
+				size = 0
+			if numFiles > 0 and budgetBytes is not None and numBytes + size > budgetBytes:
+				break
+			numFiles += 1
+			numBytes += size
+		self.__selection = (numFiles, numBytes)
+		return self.__selection
+
+	def scrub(self, result, budgetBytes=None, budgetSeconds=None):
+		# verify the files in the order of their last verification until
+		# one of the budgets is used up (the first file is always verified),
+		# the files selected by select() if called before; returns the total
+		# status of the result
+		if not result.isRoot():
+			raise MyException('Scrubbing has to start at the root directory.', 3)
+		if self.__selection is None:
+			self.select(budgetBytes)
+		numSelectedFiles, self.__selectedBytes = self.__selection
+		self.__selection = None
+		self.__numFiles = 0
+		self.__numBytes = 0
+		self.__signalledBytes = 0
+		self.__currentBytesAll = 0
+		self.__currentBytesDone = 0
+		self.__fstree.registerHandlers(self.__signalNewFile, self.__signalBytesDone)
+		start = time.time()
+		# files verified in this run are no candidates anymore
+		verified = int(start * 10**9)
+		findings = []
+		failedPaths = set()
+		okPaths = []
+		try:
+			done = False
+			while not done:
+				candidates = [ c for c in self.__dbtree.getVerificationCandidates(verified, \
+					len(failedPaths) + self.__chunkSize) if c[1] not in failedPaths ]
+				if len(candidates) == 0:
+					break
+				for lastVerified, path, dbnode in candidates:
+					if self.__numFiles >= numSelectedFiles or (self.__numFiles > 0 and \
+						budgetSeconds is not None and time.time() - start >= budgetSeconds):
+						done = True
+						break
+					info = self.__fstree.calculateByPath(path)
+					self.__numFiles += 1
+					if info is None:
+						status = NodeStatus.Missing
+					else:
+						self.__numBytes += info.size
+						status = Tree.compareFileInfos(info, dbnode.info)
+					if status == NodeStatus.Ok:
+						okPaths.append(path)
+					else:
+						failedPaths.add(path)
+						findings.append((Scrubber.__pathToNids(path), status, info, dbnode))
+				self.__dbtree.setVerified(okPaths, verified)
+				okPaths = []
+		finally:
+			self.__fstree.unRegisterHandlers()
+			# keep the verifications done so far, even if cancelled
+			self.__dbtree.setVerified(okPaths, verified)
+			self.__dbtree.commit()
+		self.__buildResult(result, findings)
+		return result.getTotalNodeStatus()
+
+	def __signalNewFile(self, path, size):
+		# the progress of all files stays within the selected bytes
+		self.__currentBytesAll = min(size, self.__selectedBytes - self.__signalledBytes)
+		self.__currentBytesDone = 0
+		if self.signalNewFile is not None:
+			self.signalNewFile(path, self.__currentBytesAll)
+
+	def __signalBytesDone(self, bytesDone):
+		bytesDone = min(bytesDone, self.__currentBytesAll - self.__currentBytesDone)
+		self.__currentBytesDone += bytesDone
+		self.__signalledBytes += bytesDone
+		if self.signalBytesDone is not None:
+			self.signalBytesDone(bytesDone)
+
+	def __buildResult(self, result, findings):
+		# the findings are sorted in NID order, so each directory of the
+		# result is entered only once; the database follows the result
+		self.__dbtree.gotoRoot()
+		rdirs = []
+		for nids, status, info, dbnode in sorted(findings, key=lambda x: x[0]):
+			dirnids = list(nids[:-1])
+			while not [ n.getNid() for n in rdirs ] == dirnids[:len(rdirs)]:
+				self.__leaveDirectory(result, rdirs.pop())
+			for nid in dirnids[len(rdirs):]:
+				dbdir = self.__dbtree.getNodeByNid(nid)
+				rnode = copy.copy(dbdir)
+				result.insert(rnode)
+				result.down(rnode)
+				self.__dbtree.down(dbdir)
+				rdirs.append(rnode)
+			# the result node refers to the database node
+			rnode = copy.copy(dbnode)
+			if info is not None:
+				rnode.info = info
+				rnode.otherinfo = dbnode.info
+			rnode.status = status
+			result.insert(rnode)
+		while len(rdirs) > 0:
+			self.__leaveDirectory(result, rdirs.pop())
+		self.__dbtree.gotoRoot()
+
+	def __leaveDirectory(self, result, rnode):
+		rnode.status = result.getTotalNodeStatus()
+		result.up()
+		self.__dbtree.up()
+		result.update(rnode)
+
+	@staticmethod
+	def __pathToNids(path):
+		names = path.split(os.sep)
+		return tuple([ Node.constructNid(name, True) for name in names[:-1] ] + \
+			[ Node.constructNid(names[-1], False) ])
@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import heapq
+import os
+import shutil
+import simplejson as json
+import struct
+
+from dbtree import DatabaseTree
+from misc import MyException, Checksum
+from node import Node
+from tree import Tree
+
+
+
+class ShardedDatabaseTree(Tree):
+
+	# --------------------------------------
+	# A note about shards
+	# --------------------------------------
+	# For very large directory trees a single database gets unwieldy: huge
+	# indexes, long vacuums and one single writer. This tree partitions
+	# the nodes into multiple databases (shards), all of them regular
+	# DatabaseTrees. The top level database contains the nodes directly
+	# in the root directory, each directory of the root directory gets a
+	# shard of its own containing all its descendants. A manifest file
+	# maps the names of these directories to their shards. Each shard can
+	# be diffed independently, see Tree.diff(). Each database has its own
+	# signature, the manifest signature is a digest over the manifest and
+	# the signature files of all databases, so shards cannot be dropped or
+	# swapped unnoticed.
+
+	def __init__(self, dbfile, sigfile, readonly=False):
+		super(ShardedDatabaseTree, self).__init__()
+		self.__databaseFile = dbfile
+		self.__signatureFile = sigfile
+		# shards are snapshots of their own, see DatabaseTree
+		self.__readonly = readonly
+		basename = os.path.splitext(dbfile)[0]
+		self.__manifestFile = basename + '.manifest'
+		self.__manifestSignatureFile = ShardedDatabaseTree.getManifestSignatureFile(dbfile)
+		self.__shardDir = basename + '.shards'
+
+		self.__top = None
+		self.__manifest = None
+		# open shards: name of top level directory -> DatabaseTree
+		self.__shards = {}
+		# name and shard of the top level directory we are in, None if in root
+		self.__currentName = None
+		self.__current = None
+
+		self.open()
+		self.gotoRoot()
+
+	def __str__(self):
+		result = '('
+		result += 'ShardedDatabaseTree: '
+		result += 'depth=\'' + str(self.getDepth()) + '\''
+		result += ', path=\'' + self.getPath() + '\''
+		result += ', shards=\'' + str(len(self.__manifest['shards'])) + '\''
+		return result + ')'
+
+	@staticmethod
+	def isSharded(dbfile):
+		return os.path.exists(os.path.splitext(dbfile)[0] + '.manifest')
+
+	@staticmethod
+	def getManifestSignatureFile(dbfile):
+		return os.path.splitext(dbfile)[0] + '.manifest.signature'
+
+	@staticmethod
+	def removeShards(dbfile):
+		# remove manifest and shards, but not the top level database
+		basename = os.path.splitext(dbfile)[0]
+		for path in [ basename + '.manifest', ShardedDatabaseTree.getManifestSignatureFile(dbfile) ]:
+			if os.path.exists(path):
+				os.remove(path)
+		if os.path.exists(basename + '.shards'):
+			shutil.rmtree(basename + '.shards')
+
+	### implementation of base class methods, please keep order
+
+	def open(self):
+		if self.isOpen():
+			return
+		isNew = not os.path.exists(self.__manifestFile)
+		if not isNew:
+			f = open(self.__manifestFile, 'r')
+			self.__manifest = json.load(f)
+			f.close()
+		elif self.__readonly:
+			raise MyException('Cannot find manifest file \'' + self.__manifestFile + '\'.', 2)
+		else:
+			self.__manifest = { 'shards' : {}, 'nextshard' : 0 }
+		self.__top = DatabaseTree(self.__databaseFile, self.__signatureFile, self.__readonly)
+		if not self.__readonly:
+			if not os.path.exists(self.__shardDir):
+				os.mkdir(self.__shardDir)
+			if isNew:
+				self.__saveManifest()
+			# like the signatures of the databases (see DatabaseTree.close()),
+			# the manifest signature is only renewed if something changed; a
+			# missing one is not created, the manifest may have been tampered
+			# with (see isSignatureValid()), only a new manifest gets signed
+			if isNew:
+				self.__signatureAtOpen = None
+			else:
+				self.__signatureAtOpen = self.getSignature()
+
+	def close(self):
+		if self.isOpen():
+			for shard in self.__shards.values():
+				shard.close()
+			self.__shards = {}
+			self.__currentName = None
+			self.__current = None
+			self.__top.close()
+			self.__top = None
+			if not self.__readonly:
+				signature = self.getSignature()
+				if not signature == self.__signatureAtOpen:
+					signature.saveToFile(self.__manifestSignatureFile)
+
+	def isOpen(self):
+		return self.__top is not None and self.__top.isOpen()
+
+	def clear(self):
+		for name in self.__manifest['shards'].keys():
+			self.__removeShard(name)
+		self.__manifest = { 'shards' : {}, 'nextshard' : 0 }
+		self.__saveManifest()
+		self.__top.clear()
+		self.gotoRoot()
+
+	def getDepth(self):
+		if self.__current is None:
+			return 0
+		else:
+			return self.__current.getDepth() + 1
+
+	def getPath(self, node=None):
+		if self.__current is None:
+			return self.__top.getPath(node)
+		else:
+			path = self.__current.getPath(node)
+			if path == '':
+				return self.__currentName
+			else:
+				return os.path.join(self.__currentName, path)
+
+	def gotoRoot(self):
+		self.__currentName = None
+		self.__current = None
+		self.__top.gotoRoot()
+
+	def up(self):
+		if self.isRoot():
+			raise MyException('\'up\' on root node is not possible.', 3)
+		if self.__current.isRoot():
+			name = self.__currentName
+			self.__currentName = None
+			self.__current = None
+			return name
+		else:
+			return self.__current.up()
+
+	def down(self, node):
+		if node.isFile():
+			raise MyException('\'down\' on file \'' + node.name + '\' is not possible.', 3)
+		if self.__current is None:
+			self.__current = self.__getShard(node.name)
+			self.__current.gotoRoot()
+			self.__currentName = node.name
+		else:
+			self.__current.down(node)
+
+	def numChildren(self, node):
+		if node.isFile():
+			return 0
+		elif self.__current is None:
+			shard = self.__getShard(node.name)
+			root = Node('')
+			root.dbkey = shard.getRootId()
+			return shard.numChildren(root)
+		else:
+			return self.__current.numChildren(node)
+
+	def insert(self, node):
+		if self.__current is None:
+			self.__top.insert(node)
+			if node.isDirectory():
+				self.__createShard(node.name)
+		else:
+			self.__current.insert(node)
+
+	def update(self, node):
+		self.__getCurrentTree().update(node)
+
+	def delete(self, node):
+		if self.__current is None and node.isDirectory():
+			if not self.isChildless(node):
+				raise MyException('Deleting the non-empty directory \'' + node.name + '\'.', 1)
+			self.__top.delete(node)
+			self.__removeShard(node.name)
+		else:
+			self.__getCurrentTree().delete(node)
+
+	def commit(self):
+		self.__top.commit()
+		for shard in self.__shards.values():
+			shard.commit()
+		self.__saveManifest()
+
+	def compact(self):
+		# see DatabaseTree
+		self.commit()
+		self.__top.compact()
+		for name in self.__manifest['shards'].keys():
+			self.__getShard(name).compact()
+
+	def exists(self, nid):
+		return self.__getCurrentTree().exists(nid)
+
+	def getNodeByNid(self, nid):
+		return self.__getCurrentTree().getNodeByNid(nid)
+
+	def __iter__(self):
+		return self.__getCurrentTree().__iter__()
+
+	def calculate(self, node):
+		# nothing to do, just signal that the job is done if necessary
+		if node.isDirectory():
+			if self.signalNewFile is not None:
+				self.signalNewFile(self.getPath(node), 0)
+		else:
+			if self.signalNewFile is not None:
+				self.signalNewFile(self.getPath(node), node.info.size)
+			if self.signalBytesDone is not None:
+				self.signalBytesDone(node.info.size)
+
+	def globalChecksumExists(self, checksumString):
+		return self.globalChecksumNumberOfOccurrences(checksumString) > 0
+
+	def globalChecksumNumberOfOccurrences(self, checksumString):
+		count = self.__top.globalChecksumNumberOfOccurrences(checksumString)
+		for name in self.__manifest['shards'].keys():
+			count += self.__getShard(name).globalChecksumNumberOfOccurrences(checksumString)
+		return count
+
+	def globalGetPathsByChecksum(self, checksumString):
+		result = self.__top.globalGetPathsByChecksum(checksumString)
+		for name in self.__manifest['shards'].keys():
+			for path in self.__getShard(name).globalGetPathsByChecksum(checksumString):
+				result.add(os.path.join(name, path))
+		return result
+
+	def globalGetPathsByChecksums(self, checksumStrings):
+		result = self.__top.globalGetPathsByChecksums(checksumStrings)
+		for name in self.__manifest['shards'].keys():
+			for csumstr, paths in self.__getShard(name).globalGetPathsByChecksums(checksumStrings).iteritems():
+				result.setdefault(csumstr, set()).update( \
+					[ os.path.join(name, path) for path in paths ])
+		return result
+
+	def globalGetChecksumsByPrefix(self, prefix, limit=None):
+		result = set(self.__top.globalGetChecksumsByPrefix(prefix, limit))
+		for name in self.__manifest['shards'].keys():
+			result.update(self.__getShard(name).globalGetChecksumsByPrefix(prefix, limit))
+		result = sorted(result)
+		if limit is not None:
+			result = result[:limit]
+		return result
+
+	def moveByPath(self, path, newpath, isdir):
+		# moves within the top level database or within a shard are updates
+		# of the rows, moving a directory of the root directory renames its
+		# shard; moves between databases delete and insert the rows
+		names = path.split(os.sep)
+		newnames = newpath.split(os.sep)
+		if len(names) == 1 and len(newnames) == 1:
+			if not self.__top.moveByPath(path, newpath, isdir):
+				return False
+			if isdir:
+				self.__renameShard(path, newpath)
+			return True
+		if len(names) > 1 and len(newnames) > 1 and names[0] == newnames[0]:
+			return self.__getShard(names[0]).moveByPath(os.path.join(*names[1:]), \
+				os.path.join(*newnames[1:]), isdir)
+		rows = self.__getRowsByPath(path, isdir)
+		if len(rows) == 0:
+			raise MyException('Cannot move \'' + path + '\', it does not exist.', 3)
+		if self.getNodeByPath(newpath, isdir) is not None:
+			raise MyException('Cannot move \'' + path + '\' to \'' + newpath + \
+				'\', destination already exists.', 1)
+		parentpath = os.path.dirname(newpath)
+		if not parentpath == '' and self.getNodeByPath(parentpath, True) is None:
+			return False
+		inserted = [ (newpath + row[0][len(path):],) + tuple(row[1:]) for row in rows ]
+		self.applyChanges(list(reversed(rows)), [], inserted)
+		return True
+
+	def applyChanges(self, deleted, updated, inserted):
+		# the rows of each shard are applied by the shard in one go, the
+		# nodes of the root directory one by one: deleting a directory of
+		# the root directory removes its shard, inserting one creates it
+		toprows = [ [], [], [] ]
+		shardrows = {}
+		for i, rows in enumerate([ deleted, updated, inserted ]):
+			for row in rows:
+				names = row[0].split(os.sep, 1)
+				if len(names) == 1:
+					toprows[i].append(row)
+				else:
+					shardrows.setdefault(names[0], [ [], [], [] ])[i].append( \
+						(names[1],) + tuple(row[1:]))
+		for name in shardrows.keys():
+			if name in self.__manifest['shards']:
+				self.__applyShardChanges(name, shardrows.pop(name))
+		Tree.applyChanges(self, *toprows)
+		for name, rows in shardrows.iteritems():
+			self.__applyShardChanges(name, rows)
+
+	def getTreeHash(self, node):
+		if node.isFile():
+			return None
+		elif self.__current is None:
+			shard = self.__getShard(node.name)
+			root = Node('')
+			root.dbkey = shard.getRootId()
+			return shard.getTreeHash(root)
+		else:
+			return self.__current.getTreeHash(node)
+
+	def getSubtreeFactory(self, node):
+		# each top level directory can be re-created as a tree of its own
+		if self.__current is None and node.isDirectory() and \
+			node.name in self.__manifest['shards']:
+			dbfile, sigfile = self.__getShardFiles(node.name)
+			return (DatabaseTree, (dbfile, sigfile, self.__readonly))
+		else:
+			return None
+
+	### the following methods are not implementations of base class methods
+
+	def getSignature(self):
+		# digest over the manifest and the signature files of the top level
+		# database and of all shards in the order of their directory names
+		checksum = hashlib.sha256()
+		paths = [ self.__manifestFile, self.__signatureFile ]
+		for name in sorted(self.__manifest['shards'].keys()):
+			paths.append(self.__getShardFiles(name)[1])
+		for path in paths:
+			data = ''
+			if os.path.exists(path):
+				f = open(path, 'rb')
+				data = f.read()
+				f.close()
+			checksum.update(struct.pack('>q', len(data)) + data)
+		result = Checksum()
+		result.setBinary(buffer(checksum.digest()))
+		return result
+
+	def isSignatureValid(self, full=False):
+		# a missing manifest signature is never created later, see open()
+		if not os.path.exists(self.__manifestSignatureFile) or \
+			not self.getSignature().isValidUsingSavedFile(self.__manifestSignatureFile):
+			return False
+		if not self.__top.isSignatureValid(full):
+			return False
+		for name in self.__manifest['shards'].keys():
+			if not self.__getShard(name).isSignatureValid(full):
+				return False
+		return True
+
+	def createReader(self):
+		return ShardedDatabaseTree(self.__databaseFile, self.__signatureFile, True)
+
+	def refresh(self):
+		# shards are refreshed one by one, so the snapshots of different
+		# shards may be from different commits of a running check
+		self.__top.refresh()
+		for shard in self.__shards.values():
+			shard.refresh()
+
+	def getNodeByPath(self, path, isdir=None):
+		# see DatabaseTree
+		names = path.split(os.sep, 1)
+		if len(names) == 1:
+			return self.__top.getNodeByPath(path, isdir)
+		elif names[0] in self.__manifest['shards']:
+			return self.__getShard(names[0]).getNodeByPath(names[1], isdir)
+		else:
+			return None
+
+	def getShardNames(self):
+		return sorted(self.__manifest['shards'].keys())
+
+	def getVerificationCandidates(self, before, limit):
+		# the oldest files of all databases, see DatabaseTree
+		result = self.__top.getVerificationCandidates(before, limit)
+		for name in self.__manifest['shards'].keys():
+			for verified, path, node in self.__getShard(name).getVerificationCandidates(before, limit):
+				result.append((verified, os.path.join(name, path), node))
+		result.sort(key=lambda x: x[0])
+		return result[:limit]
+
+	def getVerificationSizes(self, before):
+		# the files of all databases merged in the order of
+		# getVerificationCandidates(): by time, then top level database first
+		sources = [ ShardedDatabaseTree.__tagSizes(0, '', self.__top.getVerificationSizes(before)) ]
+		for name in self.__manifest['shards'].keys():
+			sources.append(ShardedDatabaseTree.__tagSizes(len(sources), name, \
+				self.__getShard(name).getVerificationSizes(before)))
+		for verified, index, path, size in heapq.merge(*sources):
+			yield (verified, path, size)
+
+	@staticmethod
+	def __tagSizes(index, name, sizes):
+		for verified, path, size in sizes:
+			yield (verified, index, os.path.join(name, path), size)
+
+	def setVerified(self, paths, verified):
+		toppaths = []
+		shardpaths = {}
+		for path in paths:
+			names = path.split(os.sep, 1)
+			if len(names) == 1:
+				toppaths.append(path)
+			else:
+				shardpaths.setdefault(names[0], []).append(names[1])
+		self.__top.setVerified(toppaths, verified)
+		for name, paths in shardpaths.iteritems():
+			self.__getShard(name).setVerified(paths, verified)
+
+	def __getCurrentTree(self):
+		if self.__current is None:
+			return self.__top
+		else:
+			return self.__current
+
+	def __getRowsByPath(self, path, isdir):
+		# see DatabaseTree.getRowsByPath()
+		names = path.split(os.sep, 1)
+		if len(names) > 1:
+			if names[0] not in self.__manifest['shards']:
+				return []
+			return [ (os.path.join(names[0], row[0]),) + tuple(row[1:]) \
+				for row in self.__getShard(names[0]).getRowsByPath(names[1], isdir) ]
+		result = self.__top.getRowsByPath(path, isdir)
+		if isdir and len(result) > 0:
+			result.extend([ (os.path.join(path, row[0]),) + tuple(row[1:]) \
+				for row in self.__getShard(path).getRowsByPath('', True) ])
+		return result
+
+	def __applyShardChanges(self, name, rows):
+		shard = self.__getShard(name)
+		shard.registerHandlers(self.signalNewFile, self.signalBytesDone)
+		try:
+			shard.applyChanges(*rows)
+		finally:
+			shard.unRegisterHandlers()
+
+	def __getShardFiles(self, name):
+		basename = os.path.join(self.__shardDir, \
+			'shard{0:06d}'.format(self.__manifest['shards'][name]))
+		return basename + '.sqlite3', basename + '.signature'
+
+	def __getShard(self, name):
+		if name not in self.__shards:
+			if name not in self.__manifest['shards']:
+				raise MyException('No shard for directory \'' + name + '\'.', 3)
+			dbfile, sigfile = self.__getShardFiles(name)
+			self.__shards[name] = DatabaseTree(dbfile, sigfile, self.__readonly)
+		return self.__shards[name]
+
+	def __createShard(self, name):
+		if name in self.__manifest['shards']:
+			raise MyException('Shard for directory \'' + name + '\' already exists.', 3)
+		self.__manifest['shards'][name] = self.__manifest['nextshard']
+		self.__manifest['nextshard'] += 1
+		# start with an empty database, even if files of an old shard are still there
+		dbfile, sigfile = self.__getShardFiles(name)
+		for path in [ dbfile, sigfile ]:
+			if os.path.exists(path):
+				os.remove(path)
+		self.__getShard(name)
+
+	def __renameShard(self, name, newname):
+		# the shard keeps its files, only the manifest maps it to the new name
+		self.__manifest['shards'][newname] = self.__manifest['shards'].pop(name)
+		if name in self.__shards:
+			self.__shards[newname] = self.__shards.pop(name)
+		if self.__currentName == name:
+			self.__currentName = newname
+
+	def __removeShard(self, name):
+		if name in self.__shards:
+			self.__shards[name].close()
+			del self.__shards[name]
+		dbfile, sigfile = self.__getShardFiles(name)
+		for path in [ dbfile, dbfile + '-wal', dbfile + '-shm', sigfile ]:
+			if os.path.exists(path):
+				os.remove(path)
+		del self.__manifest['shards'][name]
+
+	def __saveManifest(self):
+		f = open(self.__manifestFile, 'w')
+		# sorted keys: the signature covers the bytes of the manifest file
+		f.write(json.dumps(self.__manifest, indent='\t', sort_keys=True))
+		f.close()
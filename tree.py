@@ -1,12 +1,53 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import bisect
+import collections
+import copy
+import multiprocessing
 import os
 import shlex
 import subprocess
 
-from misc import MyException
-from node import NodeStatistics, NodeStatus
+from misc import MyException, Checksum
+from node import Node, NodeInfo, NodeStatistics, NodeStatus
+
+
+
+def diffSubtreeWorker(newFactory, path, oldFactory, removeOkNodes):
+	# diff of a single directory in a separate process, see Tree.diff()
+	from coltree import ColumnTree
+	new = newFactory[0](*newFactory[1])
+	for name in path.split(os.path.sep):
+		new.down(new.getNodeByNid(Node.constructNid(name, True)))
+	old = oldFactory[0](*oldFactory[1])
+	result = ColumnTree()
+	result.open()
+	status = new.diff(old, result, removeOkNodes)
+	result.gotoRoot()
+	checksumPaths = new.exportChecksumPaths()
+	old.close()
+	new.close()
+	return status, result, checksumPaths
+
+
+
+class WalkOrder:
+
+	PreOrder = 0
+	PostOrder = 1
+	# each directory is yielded twice, before and after its descendants
+	PreAndPostOrder = 2
+	BreadthFirst = 3
+
+
+
+class WalkEvent:
+
+	# node is yielded before its descendants
+	Pre = 0
+	# node is yielded after its descendants
+	Post = 1
 
 
 
@@ -81,11 +122,109 @@ class Tree(object):
 	def globalGetPathsByChecksum(self, checksumString):
 		raise MyException('Not implemented.', 3)
 
+	def globalGetChecksumsByPrefix(self, prefix, limit=None):
+		raise MyException('Not implemented.', 3)
+
 	### generic methods using basic methods
 
 	def isRoot(self):
 		return self.getDepth() == 0
 
+	def getFactory(self):
+		# (callable, arguments) to re-create this tree in a different
+		# process, None if this is not possible
+		return None
+
+	def getSubtreeFactory(self, node):
+		# (callable, arguments) to create a tree whose root is the directory
+		# node in the current directory, None if this is not possible
+		return None
+
+	def globalGetPathsByChecksums(self, checksumStrings):
+		# paths of many checksums at once: checksum string -> set of paths,
+		# trees with an index should do this in a single pass
+		result = {}
+		for checksumString in checksumStrings:
+			paths = self.globalGetPathsByChecksum(checksumString)
+			if len(paths) > 0:
+				result[checksumString] = paths
+		return result
+
+	def moveByPath(self, path, newpath, isdir):
+		# move a node (and all its descendants) to another path relative to
+		# the root directory without deleting and inserting it; returns
+		# False if the tree cannot do that, see DatabaseTree
+		return False
+
+	def applyChanges(self, deleted, updated, inserted):
+		# Apply many changes at once, given as rows (path, isdir, size, ctime,
+		# atime, mtime, binary checksum) with paths relative to the root
+		# directory: deleted nodes (descendants before their directories),
+		# updated files and inserted nodes (directories before their
+		# descendants). Each change is signalled like a directory. The tree
+		# stays in its current directory; trees able to apply the rows with
+		# a few statements (see DatabaseTree) should do so.
+		start = Tree.__splitPath(self.getPath())
+		position = start
+		for rows, action in [ (deleted, 'delete'), (updated, 'update'), (inserted, 'insert') ]:
+			for row in rows:
+				names = Tree.__splitPath(row[0])
+				position = self.__moveTo(position, names[:-1])
+				if not position == names[:-1]:
+					raise MyException('Directory of \'' + row[0] + '\' does not exist.', 3)
+				if action == 'insert':
+					node = Node(names[-1])
+				else:
+					node = self.getNodeByNid(Node.constructNid(names[-1], row[1]))
+					if node is None:
+						raise MyException('Node \'' + row[0] + '\' does not exist.', 3)
+				if not (row[1] or action == 'delete'):
+					node.info = NodeInfo()
+					node.info.size, node.info.ctime, node.info.atime, node.info.mtime = row[2:6]
+					node.info.checksum = Checksum()
+					node.info.checksum.setBinary(row[6])
+				if action == 'delete':
+					self.delete(node)
+				elif action == 'update':
+					self.update(node)
+				else:
+					self.insert(node)
+				if self.signalNewFile is not None:
+					self.signalNewFile(row[0], 0)
+		self.__moveTo(position, start)
+
+	@staticmethod
+	def __splitPath(path):
+		if path == '':
+			return []
+		return path.split(os.sep)
+
+	def getTreeHash(self, node):
+		# hash over the whole subtree of a directory node in the current
+		# directory (see DatabaseTree), None if the tree does not know it
+		return None
+
+	def exportChecksumPaths(self):
+		# mapping of checksums to paths a tree keeps in memory
+		return {}
+
+	def importChecksumPaths(self, checksumPaths):
+		pass
+
+	@staticmethod
+	def searchSortedChecksums(checksums, prefix, limit=None):
+		# binary search for all entries of a sorted list of checksum
+		# strings starting with prefix
+		prefix = Checksum.normalizePrefix(prefix)
+		result = []
+		index = bisect.bisect_left(checksums, prefix)
+		while index < len(checksums) and checksums[index].startswith(prefix):
+			if limit is not None and len(result) >= limit:
+				break
+			result.append(checksums[index])
+			index += 1
+		return result
+
 	def sameDepth(self, other):
 		return self.getDepth() == other.getDepth()
 
@@ -100,41 +239,121 @@ class Tree(object):
 		self.signalNewFile = None
 		self.signalBytesDone = None
 
-	def __preOrderApply(self, func, param=None, ret=None, recurse=True):
-		for node in self:
-			nret = func(self, node, param, ret)
-			if recurse and node.isDirectory():
-				self.down(node)
-				self.__preOrderApply(func, param, nret, recurse)
-				self.up()
+	# --------------------------------------
+	# A note about walking trees
+	# --------------------------------------
+	# walk() visits the nodes below the current directory without
+	# recursion: the iterators of the directories being visited are kept
+	# on an explicit stack, so the depth of a tree is not limited by the
+	# recursion limit. While a node is yielded, the tree is in the node's
+	# parent directory. Callers may modify the node (or other trees), but
+	# have to leave this tree in that directory; directories must not be
+	# deleted before their descendants have been visited.
+
+	def walk(self, node=None, order=WalkOrder.PreOrder, recurse=True):
+		# Generator of (path, node, event) of all children of the current
+		# directory (or of the node in the current directory) and their
+		# descendants; recurse may be a function deciding for each directory
+		# node if its descendants are visited, too
+		if order == WalkOrder.BreadthFirst:
+			return self.__walkBreadthFirst(node, recurse)
+		else:
+			return self.__walkDepthFirst(node, order, recurse)
 
-	def preOrderApply(self, func, node=None, param=None, recurse=True):
+	def __walkDepthFirst(self, node, order, recurse):
+		pre = not order == WalkOrder.PostOrder
+		post = not order == WalkOrder.PreOrder
 		if node is None:
-			nret = self.__preOrderApply(func, param, None, recurse)
+			children = iter(self)
 		else:
-			nret = func(self, node, param, None)
-			if recurse and node.isDirectory():
-				self.down(node)
-				self.__preOrderApply(func, param, nret, recurse)
-				self.up()
-
-	def __postOrderApply(self, func, param=None, recurse=True):
-		for node in self:
-			if recurse and node.isDirectory():
-				self.down(node)
-				self.__postOrderApply(func, param, recurse)
+			children = iter([ node ])
+		# stack of (directory node or None for the start, its path, iterator of its children)
+		stack = [ (None, self.getPath(), children) ]
+		try:
+			while len(stack) > 0:
+				parent, parentpath, children = stack[-1]
+				child = next(children, None)
+				if child is None:
+					stack.pop()
+					if parent is not None:
+						self.up()
+						if post:
+							yield parentpath, parent, WalkEvent.Post
+					continue
+				path = os.path.join(parentpath, child.name)
+				if pre:
+					yield path, child, WalkEvent.Pre
+				if child.isDirectory() and Tree.__descend(recurse, child):
+					self.down(child)
+					stack.append((child, path, iter(self)))
+				elif post:
+					yield path, child, WalkEvent.Post
+		finally:
+			# walk has been left early: back to the start directory
+			for parent, parentpath, children in stack[1:]:
 				self.up()
-			func(self, node, param)
 
-	def postOrderApply(self, func, node=None, param=None, recurse=True):
+	def __walkBreadthFirst(self, node, recurse):
+		# directories are visited level by level, the tree moves from one
+		# to the next via their common ancestor
+		queue = collections.deque()
 		if node is None:
-			self.__postOrderApply(func, param, recurse)
+			queue.append([])
 		else:
-			if recurse and node.isDirectory():
-				self.down(node)
-				self.__postOrderApply(func, param, recurse)
-				self.up()
-			func(self, node, param)
+			yield self.getPath(node), node, WalkEvent.Pre
+			if node.isDirectory() and Tree.__descend(recurse, node):
+				queue.append([ node.name ])
+		startpath = self.getPath()
+		position = []
+		try:
+			while len(queue) > 0:
+				names = queue.popleft()
+				position = self.__moveTo(position, names)
+				if not position == names:
+					continue
+				dirpath = os.path.join(startpath, *names)
+				for child in self:
+					yield os.path.join(dirpath, child.name), child, WalkEvent.Pre
+					if child.isDirectory() and Tree.__descend(recurse, child):
+						queue.append(names + [ child.name ])
+		finally:
+			self.__moveTo(position, [])
+
+	def __moveTo(self, position, names):
+		# move from one directory to another, both given as lists of names
+		# relative to the same directory; returns the new position, which
+		# is a prefix of names if a directory does not exist (anymore)
+		position = list(position)
+		while not position == names[:len(position)]:
+			self.up()
+			position.pop()
+		for name in names[len(position):]:
+			node = self.getNodeByNid(Node.constructNid(name, True))
+			if node is None:
+				break
+			self.down(node)
+			position.append(name)
+		return position
+
+	@staticmethod
+	def __descend(recurse, node):
+		if callable(recurse):
+			return recurse(node)
+		return recurse
+
+	def preOrderApply(self, func, node=None, param=None, recurse=True):
+		# the return value of func for a directory is passed to func for
+		# each of its children
+		rets = {}
+		for path, n, event in self.walk(node, WalkOrder.PreOrder, recurse):
+			depth = self.getDepth()
+			nret = func(self, n, param, rets.get(depth))
+			if n.isDirectory():
+				rets[depth + 1] = nret
+
+	def postOrderApply(self, func, node=None, param=None, recurse=True):
+		for path, n, event in self.walk(node, WalkOrder.PostOrder, recurse):
+			func(self, n, param)
 
 	def __prettyPrintFunc(self, node, param, ret):
 		depth = self.getDepth() - param[0]
@@ -184,49 +403,24 @@ class Tree(object):
 	def setNodeStatus(self, status, node=None, recurse=True):
 		self.preOrderApply(Tree.__setNodeStatusFunc, node, status, recurse)
 
+	def getStatusCounts(self, recursive=False):
+		# numbers of children of the current directory of each status (list
+		# indexed by status), if recursive of all its descendants; trees
+		# keeping counters of statuses do not need to visit the nodes
+		counts = [ 0 ] * NodeStatus.NumStatuses
+		for path, node, event in self.walk(None, WalkOrder.PreOrder, recursive):
+			counts[node.status] += 1
+		return counts
+
 	def getTotalNodeStatus(self):
-		totalstatus = NodeStatus.Undefined
-		isempty = True
-		for node in self:
-			isempty = False
-			if totalstatus == NodeStatus.Undefined:
-				if node.status == NodeStatus.Undefined:
-					pass
-				elif node.status == NodeStatus.New or node.status == NodeStatus.DirContainsNew:
-					totalstatus = NodeStatus.DirContainsNew
-				elif node.status == NodeStatus.Missing or node.status == NodeStatus.DirContainsMissing:
-					totalstatus = NodeStatus.DirContainsMissing
-				elif node.status == NodeStatus.Ok:
-					totalstatus = NodeStatus.Ok
-				elif node.status == NodeStatus.FileWarning or node.status == NodeStatus.DirContainsWarning:
-					totalstatus = NodeStatus.DirContainsWarning
-				elif node.status == NodeStatus.FileError or node.status == NodeStatus.DirContainsError:
-					totalstatus = NodeStatus.DirContainsError
-				elif node.status == NodeStatus.DirContainsMulti:
-					return NodeStatus.DirContainsMulti
-				else:
-					raise MyException('Error in state machine.', 3)
-			elif totalstatus == NodeStatus.DirContainsNew:
-				if not (node.status == NodeStatus.New or node.status == NodeStatus.DirContainsNew):
-					return NodeStatus.DirContainsMulti
-			elif totalstatus == NodeStatus.DirContainsMissing:
-				if not (node.status == NodeStatus.Missing or node.status == NodeStatus.DirContainsMissing):
-					return NodeStatus.DirContainsMulti
-			elif totalstatus == NodeStatus.Ok:
-				if not node.status == NodeStatus.Ok:
-					return NodeStatus.DirContainsMulti
-			elif totalstatus == NodeStatus.DirContainsWarning:
-				if not (node.status == NodeStatus.FileWarning or node.status == NodeStatus.DirContainsWarning):
-					return NodeStatus.DirContainsMulti
-			elif totalstatus == NodeStatus.DirContainsError:
-				if not (node.status == NodeStatus.FileError or node.status == NodeStatus.DirContainsError):
-					return NodeStatus.DirContainsMulti
-			else:
-				raise MyException('Error in state machine.', 3)
-		if isempty:
-			return NodeStatus.Ok
-		else:
-			return totalstatus
+		return NodeStatus.aggregate(self.getStatusCounts())
+
+	def getPathsByStatus(self, statuses):
+		# paths of all descendants of the current directory having one of
+		# the statuses, in the order of walk(); trees keeping counters of
+		# statuses do not need to visit all the nodes
+		statuses = set(statuses)
+		return [ path for path, node, event in self.walk() if node.status in statuses ]
 
 	def __deleteNodeFunc(self, node, param):
 		self.delete(node)
@@ -234,116 +428,201 @@ class Tree(object):
 	def deleteNode(self, node=None, recurse=True):
 		self.postOrderApply(Tree.__deleteNodeFunc, node, None, recurse)
 
-	def __copyTo(self, dest, node, recurse=True):
-		self.calculate(node)
-		dest.insert(node)
-		if recurse and node.isDirectory():
-			self.down(node)
-			dest.down(dest.getNodeByNid(node.getNid()))
-			for snode in self:
-				self.__copyTo(dest, snode, recurse)
-			dest.up()
-			self.up()
-
 	def copyTo(self, dest, node=None, recurse=True):
-		if node is None:
-			for snode in self:
-				self.__copyTo(dest, snode, recurse)
+		for path, n, event in self.walk(node, WalkOrder.PreAndPostOrder, recurse):
+			if event == WalkEvent.Pre:
+				self.calculate(n)
+				dest.insert(n)
+				if recurse and n.isDirectory():
+					dest.down(dest.getNodeByNid(n.getNid()))
+			elif recurse and n.isDirectory():
+				dest.up()
+
+	def diff(self, old, result, removeOkNodes=True, processes=None, nids=None):
+		# If NIDs are given, only these nodes of the current directory are
+		# diffed, including all their descendants.
+		# Directories the old tree can provide as separate trees (like
+		# the shards of a ShardedDatabaseTree) are diffed in parallel by
+		# a pool of the given number of processes if self can be re-created
+		# in another process, too
+		pool = None
+		if processes is not None and self.getFactory() is not None:
+			for onode in old:
+				if old.getSubtreeFactory(onode) is not None:
+					pool = multiprocessing.Pool(processes)
+					break
+		if pool is None:
+			self.__diff(old, result, removeOkNodes, None, None, nids)
+			return result.getTotalNodeStatus()
+		pending = []
+		try:
+			self.__diff(old, result, removeOkNodes, pool, pending, nids)
+			pool.close()
+			for rnode, asyncresult in pending:
+				status, subresult, checksumPaths = asyncresult.get()
+				self.importChecksumPaths(checksumPaths)
+				# graft result of the subtree into the result
+				result.down(rnode)
+				subresult.copyTo(result)
+				result.up()
+				rnode.status = status
+				self.__updateDiffResult(result, rnode, removeOkNodes)
+			pool.join()
+		except:
+			pool.terminate()
+			raise
+		return result.getTotalNodeStatus()
+
+	@staticmethod
+	def compareFileInfos(info, oldinfo):
+		# status of a file with the node info of the new and the old tree
+		if info.checksum == oldinfo.checksum:
+			# this program is about checksums, if the checksum is valid, the status is OK
+			return NodeStatus.Ok
+		# otherwise we check if someone has willingly (?) changed the file,
+		# if that is not the case, we have a serious error
+		if info.mtime == oldinfo.mtime:
+			return NodeStatus.FileError
 		else:
-			self.__copyTo(dest, node, recurse)
+			return NodeStatus.FileWarning
 
-	def diff(self, old, result, removeOkNodes=True):
-		for snode in self:
-			onode = old.getNodeByNid(snode.getNid())
-			if onode is not None:
-				self.calculate(snode)
-				# nodes existing in self (new) and old: already known nodes
-				old.calculate(onode)
-				rnode = snode
-				rnode.dbkey = onode.dbkey
-				result.insert(rnode)
-				if snode.isDirectory():
-					# tree descent
-					self.down(snode)
-					old.down(onode)
-					result.down(rnode)
-					# recurse
-					rnode.status = self.diff(old, result, removeOkNodes)
+	def __updateDiffResult(self, result, rnode, removeOkNodes):
+		# process status of child node
+		if removeOkNodes and rnode.status == NodeStatus.Ok:
+			result.delete(rnode)
+		else:
+			result.update(rnode)
+
+	def __diff(self, old, result, removeOkNodes, pool, pending, nids):
+		# both trees yield the children of a directory in NID order, so
+		# they are merged in a single pass without any lookups; instead of
+		# recursing, the merges of all directories being descended into are
+		# kept on a stack of [ result node, iterators, current nodes ]
+		snodes = Tree.__checkedOrder(self, nids)
+		onodes = Tree.__checkedOrder(old, nids)
+		stack = [ [ None, snodes, onodes, next(snodes, None), next(onodes, None) ] ]
+		while len(stack) > 0:
+			frame = stack[-1]
+			rparent, snodes, onodes, snode, onode = frame
+			if snode is None and onode is None:
+				# merge of directory finished
+				stack.pop()
+				if rparent is not None:
+					rparent.status = result.getTotalNodeStatus()
 					# tree ascent
 					result.up()
 					old.up()
 					self.up()
-				else:
-					# compare snode and onode and set status
-					if snode.info.checksum == onode.info.checksum:
-						# this program is about checksums, if the checksum is valid, the status is OK
-						rnode.status = NodeStatus.Ok
-					else:
-						# otherwise we check if someone has willingly (?) changed the file,
-						# if that is not the case, we have a serious error
-						if snode.info.mtime == onode.info.mtime:
-							rnode.status = NodeStatus.FileError
-						else:
-							rnode.status = NodeStatus.FileWarning
-					# always keep the old node info (even for OK nodes)
-					rnode.otherinfo = onode.info
-				# process status of child node
-				if removeOkNodes and rnode.status == NodeStatus.Ok:
-					result.delete(rnode)
-				else:
-					result.update(rnode)
-			else:
+					self.__updateDiffResult(result, rparent, removeOkNodes)
+				continue
+			if onode is None or (snode is not None and snode.getNid() < onode.getNid()):
 				# nodes existing in self (new) but not in old: new nodes
 				self.copyTo(result, snode)
 				result.setNodeStatus(NodeStatus.New, snode)
-		for onode in old:
-			if self.exists(onode.getNid()):
-				# existing in both: we already took care of this in the first loop
+				frame[3] = next(snodes, None)
 				continue
-			else:
+			if snode is None or onode.getNid() < snode.getNid():
 				# nodes existing in old but not in self (new): missing nodes
 				old.calculate(onode)
 				old.copyTo(result, onode)
 				result.setNodeStatus(NodeStatus.Missing, onode)
-		return result.getTotalNodeStatus()
-
-	def __patch(self, old, node, recurse=True):
-		# loop over the nodes in the patch tree
-		onode = old.getNodeByNid(node.getNid())
-		# dir and file
-		if node.status == NodeStatus.Ok:
-			return
-		elif node.status == NodeStatus.New:
-			self.copyTo(old, node, recurse)
-		elif node.status == NodeStatus.Missing:
-			old.deleteNode(onode, recurse)
-		# file only
-		elif node.status == NodeStatus.FileWarning or \
-			node.status == NodeStatus.FileError:
-			old.update(node)
-		# dir only
-		elif recurse and ( \
-			node.status == NodeStatus.DirContainsNew or \
+				frame[4] = next(onodes, None)
+				continue
+			# nodes existing in self (new) and old: already known nodes
+			self.calculate(snode)
+			old.calculate(onode)
+			# the result node refers to the old node, but the new tree
+			# needs its own key for descending
+			rnode = copy.copy(snode)
+			rnode.dbkey = onode.dbkey
+			result.insert(rnode)
+			if snode.isDirectory() and removeOkNodes and \
+				Tree.__haveSameTreeHash(self, snode, old, onode):
+				# the subtrees are equal, no need to descend
+				rnode.status = NodeStatus.Ok
+				self.__updateDiffResult(result, rnode, removeOkNodes)
+			elif snode.isDirectory() and pool is not None and len(stack) == 1 and \
+				old.getSubtreeFactory(onode) is not None:
+				pending.append((rnode, pool.apply_async(diffSubtreeWorker, \
+					(self.getFactory(), self.getPath(snode), \
+					old.getSubtreeFactory(onode), removeOkNodes))))
+				# status is set when the result arrives
+			elif snode.isDirectory():
+				# the merge of this directory continues after the descent
+				frame[3] = next(snodes, None)
+				frame[4] = next(onodes, None)
+				# tree descent
+				self.down(snode)
+				old.down(onode)
+				result.down(rnode)
+				snodes = Tree.__checkedOrder(self)
+				onodes = Tree.__checkedOrder(old)
+				stack.append([ rnode, snodes, onodes, next(snodes, None), next(onodes, None) ])
+				continue
+			else:
+				# compare snode and onode and set status
+				rnode.status = Tree.compareFileInfos(snode.info, onode.info)
+				# always keep the old node info (even for OK nodes)
+				rnode.otherinfo = onode.info
+				self.__updateDiffResult(result, rnode, removeOkNodes)
+			frame[3] = next(snodes, None)
+			frame[4] = next(onodes, None)
+
+	@staticmethod
+	def __haveSameTreeHash(tree, node, other, othernode):
+		treehash = tree.getTreeHash(node)
+		if treehash is None:
+			return False
+		return treehash == other.getTreeHash(othernode)
+
+	@staticmethod
+	def __checkedOrder(tree, nids=None):
+		# the merge in __diff silently produces wrong results if a tree
+		# does not yield its nodes in NID order
+		previous = None
+		for node in tree:
+			nid = node.getNid()
+			if previous is not None and not previous < nid:
+				raise MyException('Nodes of \'' + tree.getPath() + \
+					'\' are not in NID order.', 3)
+			previous = nid
+			if nids is None or nid in nids:
+				yield node
+
+	@staticmethod
+	def __containsChanges(node):
+		return node.status == NodeStatus.DirContainsNew or \
 			node.status == NodeStatus.DirContainsMissing or \
 			node.status == NodeStatus.DirContainsWarning or \
 			node.status == NodeStatus.DirContainsError or \
-			node.status == NodeStatus.DirContainsMulti):
-			# tree descent
-			self.down(node)
-			old.down(onode)
-			# recurse
-			for snode in self:
-				self.__patch(old, snode, recurse)
-			# tree ascent
-			old.up()
-			self.up()
-		else:
-			raise MyException('Cannot apply diff node of status {0:d}'.format(node.status), 3)
+			node.status == NodeStatus.DirContainsMulti
 
 	def patch(self, old, node=None, recurse=True):
-		if node is None:
-			for snode in self:
-				self.__patch(old, snode, recurse)
-		else:
-			self.__patch(old, node, recurse)
-
+		# only directories containing changes are descended into, the old
+		# tree follows the patch tree (self)
+		descend = recurse and Tree.__containsChanges
+		for path, snode, event in self.walk(node, WalkOrder.PreAndPostOrder, descend):
+			descended = recurse and Tree.__containsChanges(snode)
+			if event == WalkEvent.Post:
+				if descended:
+					# tree ascent
+					old.up()
+				continue
+			onode = old.getNodeByNid(snode.getNid())
+			# dir and file
+			if snode.status == NodeStatus.Ok:
+				pass
+			elif snode.status == NodeStatus.New:
+				self.copyTo(old, snode, recurse)
+			elif snode.status == NodeStatus.Missing:
+				old.deleteNode(onode, recurse)
+			# file only
+			elif snode.status == NodeStatus.FileWarning or \
+				snode.status == NodeStatus.FileError:
+				old.update(snode)
+			# dir only
+			elif descended:
+				# tree descent
+				old.down(onode)
+			else:
+				raise MyException('Cannot apply diff node of status {0:d}'.format(snode.status), 3)
@@ -6,15 +6,22 @@ import platform
 import sys
 import wx
 
+from checkjournal import CheckJournal
 from comparisondialog import NodeComparisonDialog
+from coltree import ColumnTree
 from dbtree import DatabaseTree
+from duplicates import DuplicateFinder
 from fstree import FilesystemTree
 import icons as Icons
 from instance import Instance
-from memtree import MemoryTree
-from misc import Checksum, MyException
+from manifesttree import ManifestTree
+from misc import MyException, sizeToString, timestampToString
+from moves import MoveKind
 from node import Node, NodeStatus
+from pipeline import HashPipeline
 from progressdialog import UserCancelledException, FileProcessingProgressDialog
+from scrub import Scrubber
+from shardtree import ShardedDatabaseTree
 from simplelistctrl import SimpleListControl
 from preferences import Preferences
 from preferencesdialog import PreferencesDialog
@@ -239,6 +246,12 @@ class ListControlPanel(wx.Panel):
 				self.Bind(wx.EVT_MENU, self.OnPopupDelete, id=self.popupIdDelete)
 				menu.Append(self.popupIdDelete, "Delete")
 
+				if self.instance.isRefreshPossible():
+					menu.AppendSeparator()
+					self.popupIdRefresh = wx.NewId()
+					self.Bind(wx.EVT_MENU, self.OnPopupRefresh, id=self.popupIdRefresh)
+					menu.Append(self.popupIdRefresh, "Refresh")
+
 			# Popup the menu.  If an item is selected then its handler
 			# will be called before PopupMenu returns.
 			self.PopupMenu(menu)
@@ -270,16 +283,35 @@ class ListControlPanel(wx.Panel):
 
 	def OnPopupAccept(self, event):
 		nids = self.getSelectedNodeNids()
-		self.instance.patch(nids, safeOnly=False)
+		self.Accept(nids, safeOnly=False)
 		self.RefreshTree()
 		self.GetParent().SetStatusBarText('Accepted {0:d} entries'.format(len(nids)))
 
 	def OnPopupAcceptNonDestructive(self, event):
 		nids = self.getSelectedNodeNids()
-		self.instance.patch(nids, safeOnly=True)
+		self.Accept(nids, safeOnly=True)
 		self.RefreshTree()
 		self.GetParent().SetStatusBarText('Accepted {0:d} entries'.format(len(nids)))
 
+	def Accept(self, nids, safeOnly):
+		# accept nodes of the current directory (all if nids is None); the
+		# progress is only shown for many changes, they are applied in a
+		# single transaction that cannot be cancelled
+		plan = self.instance.planPatch(nids, safeOnly)
+		if plan.getNumChanges() < 1000:
+			self.instance.applyPatch(plan)
+			return plan.getNumChanges()
+		progressDialog = FileProcessingProgressDialog(self, 'Accepting changes')
+		progressDialog.button.Disable()
+		progressDialog.Show()
+		try:
+			progressDialog.Init(plan.getNumChanges(), 0)
+			self.instance.applyPatch(plan, progressDialog.SignalNewFile, \
+				progressDialog.SignalBytesDone)
+		finally:
+			progressDialog.Destroy()
+		return plan.getNumChanges()
+
 	def OnPopupDelete(self, event):
 		nids = self.getSelectedNodeNids()
 		dial = wx.MessageBox('You are about to recursively delete {0:d} entries from this directory.\n\nDo you still want to continue?'.format(len(nids)), \
@@ -290,6 +322,34 @@ class ListControlPanel(wx.Panel):
 		self.RefreshTree()
 		self.GetParent().SetStatusBarText('Deleted {0:d} entries'.format(len(nids)))
 
+	def OnPopupRefresh(self, event):
+		nids = self.getSelectedNodeNids()
+		self.RefreshInstance(nids)
+
+	def RefreshInstance(self, nids=None):
+		# check the current directory (or some of its entries) again
+		path = self.instance.getPath()
+		try:
+			progressDialog = FileProcessingProgressDialog(self, 'Refreshing ' + path)
+			progressDialog.Show()
+			stats = self.instance.getRefreshStatistics(nids)
+			progressDialog.Init(stats.getNodeCount(), stats.getNodeSize())
+			self.instance.refresh(nids, progressDialog.SignalNewFile, \
+				progressDialog.SignalBytesDone)
+		except UserCancelledException:
+			progressDialog.SignalFinished()
+			return
+		except MyException as e:
+			progressDialog.Destroy()
+			e.showDialog('Refreshing ' + path)
+			return
+		progressDialog.Destroy()
+		self.RefreshTree()
+		if nids is None:
+			self.GetParent().SetStatusBarText('Refreshed directory')
+		else:
+			self.GetParent().SetStatusBarText('Refreshed {0:d} entries'.format(len(nids)))
+
 
 
 class MainFrame(wx.Frame):
@@ -302,6 +362,8 @@ class MainFrame(wx.Frame):
 		self.Bind(wx.EVT_MENU, self.OnNew, menuNew)
 		menuOpen = fileMenu.Append(wx.ID_OPEN, '&Open', 'Open directory under checksum control')
 		self.Bind(wx.EVT_MENU, self.OnOpen, menuOpen)
+		menuExport = fileMenu.Append(wx.ID_SAVEAS, '&Export', 'Export checksums to SHA256SUMS or XML file')
+		self.Bind(wx.EVT_MENU, self.OnExport, menuExport)
 		fileMenu.AppendSeparator()
 		menuPreferences = fileMenu.Append(wx.ID_PREFERENCES, '&Preferences\tCtrl+P', 'Show program\'s preferences')
 		self.Bind(wx.EVT_MENU, self.OnPreferences, menuPreferences)
@@ -311,6 +373,21 @@ class MainFrame(wx.Frame):
 		actionMenu = wx.Menu()
 		menuCheck = actionMenu.Append(wx.ID_FILE, '&Check\tCtrl+K', 'Check')
 		self.Bind(wx.EVT_MENU, self.OnCheck, menuCheck)
+		menuRefresh = actionMenu.Append(wx.ID_REFRESH, '&Refresh Directory\tF5', 'Check current directory again')
+		self.Bind(wx.EVT_MENU, self.OnRefresh, menuRefresh)
+		menuScrub = actionMenu.Append(wx.NewId(), '&Scrub', 'Verify the files verified longest ago')
+		self.Bind(wx.EVT_MENU, self.OnScrub, menuScrub)
+		menuVerifyDatabase = actionMenu.Append(wx.NewId(), '&Verify Database', 'Verify all rows of the database against its signature')
+		self.Bind(wx.EVT_MENU, self.OnVerifyDatabase, menuVerifyDatabase)
+		menuCompactDatabase = actionMenu.Append(wx.NewId(), 'C&ompact Database', 'Shrink the database files after many deletions')
+		self.Bind(wx.EVT_MENU, self.OnCompactDatabase, menuCompactDatabase)
+		actionMenu.AppendSeparator()
+		menuAcceptAll = actionMenu.Append(wx.NewId(), 'Accept &All', 'Accept all entries of the current directory')
+		self.Bind(wx.EVT_MENU, self.OnAcceptAll, menuAcceptAll)
+		menuAcceptMoves = actionMenu.Append(wx.NewId(), 'Accept &Moves', 'Accept moved and renamed entries')
+		self.Bind(wx.EVT_MENU, self.OnAcceptMoves, menuAcceptMoves)
+		menuFindDuplicates = actionMenu.Append(wx.NewId(), 'Find &Duplicates', 'Find files with equal contents')
+		self.Bind(wx.EVT_MENU, self.OnFindDuplicates, menuFindDuplicates)
 		helpMenu = wx.Menu()
 		menuAbout = helpMenu.Append(wx.ID_ABOUT, '&About', 'Information about this program')
 		self.Bind(wx.EVT_MENU, self.OnAbout, menuAbout)
@@ -352,6 +429,7 @@ class MainFrame(wx.Frame):
 			self.dbFile = None
 			self.sigFile = None
 			self.preferencesFile = None
+			self.journalFile = None
 			self.Title = ProgramName + ' ' + ProgramVersion
 		else:
 			self.rootDir = rootDir
@@ -360,6 +438,7 @@ class MainFrame(wx.Frame):
 			self.dbFile = os.path.join(self.metaDir, u'base.sqlite3')
 			self.sigFile = os.path.join(self.metaDir, u'base.signature')
 			self.preferencesFile = os.path.join(self.metaDir, u'preferences.json')
+			self.journalFile = os.path.join(self.metaDir, u'check.sqlite3')
 			self.Title = ProgramName + ' ' + ProgramVersion + \
 				' - ' + self.rootDir
 
@@ -412,7 +491,7 @@ class MainFrame(wx.Frame):
 				'Error', wx.OK | wx.ICON_ERROR)
 			self.UpdateRootDir(None)
 			return
-		if not os.path.exists(self.dbFile):
+		if not self.DatabaseExists():
 			wx.MessageBox('Cannot find database file "' + self.dbFile + '".', \
 				'Error', wx.OK | wx.ICON_ERROR)
 			self.UpdateRootDir(None)
@@ -423,10 +502,28 @@ class MainFrame(wx.Frame):
 			if not dial == wx.YES:
 				self.UpdateRootDir(None)
 				return
+		elif ShardedDatabaseTree.isSharded(self.dbFile) and \
+			not os.path.exists(ShardedDatabaseTree.getManifestSignatureFile(self.dbFile)):
+			dial = wx.MessageBox('Cannot find manifest signature file "' + \
+				ShardedDatabaseTree.getManifestSignatureFile(self.dbFile) + \
+				'".\n\nUse database without verification?', \
+				'Warning', wx.YES_NO | wx.ICON_WARNING | wx.NO_DEFAULT)
+			if not dial == wx.YES:
+				self.UpdateRootDir(None)
+				return
 		else:
-			cs = Checksum()
-			cs.calculateForFile(self.dbFile)
-			if not cs.isValidUsingSavedFile(self.sigFile):
+			try:
+				# databases of older versions are upgraded first, the
+				# signature is checked read-only: nothing is signed before
+				self.CreateDatabaseTree().close()
+				dbtree = self.CreateDatabaseTree(readonly=True)
+				signatureValid = dbtree.isSignatureValid()
+				dbtree.close()
+			except MyException as e:
+				e.showDialog('Opening ' + self.rootDir)
+				self.UpdateRootDir(None)
+				return
+			if not signatureValid:
 				dial = wx.MessageBox('Database or database signature file have been corrupted.\n\nUse database without verification?', \
 					'Warning', wx.YES_NO | wx.ICON_WARNING | wx.NO_DEFAULT)
 				if not dial == wx.YES:
@@ -445,6 +542,38 @@ class MainFrame(wx.Frame):
 			self.preferences.save(self.preferencesFile)
 
 
+	def OnExport(self, event):
+		if self.rootDir is None or not self.DatabaseExists():
+			wx.MessageBox('Import or Open directory before you can export its checksums.', \
+				'Error', wx.OK | wx.ICON_ERROR)
+			return
+		if ShardedDatabaseTree.isSharded(self.dbFile) or ManifestTree.isManifest(self.dbFile):
+			wx.MessageBox('Export of sharded databases and manifests is not supported.', \
+				'Error', wx.OK | wx.ICON_ERROR)
+			return
+		fileDialog = wx.FileDialog(self, 'Export checksums to file', \
+			defaultFile='SHA256SUMS', \
+			wildcard='SHA256SUMS file (*)|*|XML file (*.xml)|*.xml', \
+			style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+		if not fileDialog.ShowModal() == wx.ID_OK:
+			return
+		try:
+			# a read-only snapshot does not interfere with other instances
+			dbtree = DatabaseTree(self.dbFile, self.sigFile, True)
+			if fileDialog.GetFilterIndex() == 0:
+				lines = dbtree.exportSha256Sums()
+			else:
+				lines = dbtree.exportXml()
+			f = open(fileDialog.GetPath(), 'wb')
+			for line in lines:
+				f.write(line)
+			f.close()
+			dbtree.close()
+		except MyException as e:
+			e.showDialog('Exporting ' + self.rootDir)
+			return
+		self.SetStatusBarText('Exported checksums to ' + fileDialog.GetPath())
+
 	def OnPreferences(self, event):
 		if self.preferences is None:
 			wx.MessageBox('Import or Open directory before you can access its preferences.', \
@@ -457,9 +586,22 @@ class MainFrame(wx.Frame):
 	def OnExit(self, event):
 		self.Close(True)
 
+	def DatabaseExists(self):
+		return os.path.exists(self.dbFile) or ManifestTree.isManifest(self.dbFile)
+
+	def CreateDatabaseTree(self, sharded=False, readonly=False, manifest=False):
+		if manifest or ManifestTree.isManifest(self.dbFile):
+			return ManifestTree(ManifestTree.getManifestFile(self.dbFile), self.sigFile, readonly)
+		elif sharded or ShardedDatabaseTree.isSharded(self.dbFile):
+			return ShardedDatabaseTree(self.dbFile, self.sigFile, readonly)
+		else:
+			return DatabaseTree(self.dbFile, self.sigFile, readonly)
+
 	def Import(self):
 		# do not care about previous content: reset meta directory and database files
 		if os.path.exists(self.metaDir):
+			ShardedDatabaseTree.removeShards(self.dbFile)
+			ManifestTree.removeManifest(self.dbFile)
 			if os.path.exists(self.dbFile):
 				os.remove(self.dbFile)
 			if os.path.exists(self.sigFile):
@@ -481,7 +623,8 @@ class MainFrame(wx.Frame):
 			fstree = FilesystemTree(self.rootDir, self.preferences.includes, \
 				[ os.path.sep + self.metaName ] + self.preferences.excludes)
 			fstree.open()
-			dbtree = DatabaseTree(self.dbFile, self.sigFile)
+			dbtree = self.CreateDatabaseTree(self.preferences.sharded, \
+				manifest=self.preferences.manifest)
 			dbtree.open()
 		except MyException as e:
 			e.showDialog('Importing ' + self.rootDir)
@@ -520,8 +663,11 @@ class MainFrame(wx.Frame):
 		self.SetStatusBarText('Imported ' + str(stats))
 
 	def OnCheck(self, event):
-		# close eventually existing previous instance
-		self.list.ClearInstance()
+		# the previous instance stays open for browsing during the check;
+		# databases are in WAL mode, so it reads snapshots of them without
+		# interfering with the check, but it must not be modified anymore
+		previousReadonly = self.list.readonly
+		self.BeginBrowsing()
 		self.SetStatusBarText()
 
 		try:
@@ -529,14 +675,17 @@ class MainFrame(wx.Frame):
 			fstree = FilesystemTree(self.rootDir, self.preferences.includes, \
 				[ os.path.sep + self.metaName ] + self.preferences.excludes)
 			fstree.open()
-			dbtree = DatabaseTree(self.dbFile, self.sigFile)
+			dbtree = self.CreateDatabaseTree()
 			dbtree.open()
-			memtree = MemoryTree()
-			memtree.open()
+			coltree = ColumnTree()
+			coltree.open()
+			journal = self.OpenCheckJournal()
 		except MyException as e:
+			self.EndBrowsing(previousReadonly)
 			e.showDialog('Checking ' + self.rootDir)
 			return
 
+		pipeline = None
 		try:
 			# create progress dialog
 			progressDialog = FileProcessingProgressDialog(self, 'Checking ' + self.rootDir)
@@ -544,29 +693,323 @@ class MainFrame(wx.Frame):
 			stats = fstree.getNodeStatistics()
 			progressDialog.Init(stats.getNodeCount(), stats.getNodeSize())
 
+			# calculate checksums in separate threads
+			if self.preferences.hashThreads > 0:
+				pipeline = HashPipeline(self.preferences.hashThreads)
+				fstree.registerPipeline(pipeline)
+
 			# execute task
 			fstree.registerHandlers(progressDialog.SignalNewFile, \
 				progressDialog.SignalBytesDone)
-			fstree.diff(dbtree, memtree)
-			memtree.commit()
+			fstree.registerJournal(journal)
+			fstree.diff(dbtree, coltree)
+			coltree.commit()
 			fstree.unRegisterHandlers()
 		except UserCancelledException:
+			self.EndBrowsing(previousReadonly)
 			progressDialog.SignalFinished()
 			return
 		except MyException as e:
+			self.EndBrowsing(previousReadonly)
 			progressDialog.Destroy()
 			e.showDialog('Checking ' + self.rootDir)
 			return
+		finally:
+			if pipeline is not None:
+				fstree.unRegisterPipeline()
+				pipeline.close()
+			# the journal of an incomplete check is kept for resuming it
+			fstree.unRegisterJournal()
+			journal.close()
+		journal.remove()
 
 		# signal that we have returned from calculation, either
 		# after it is done or after progressDialog signalled that the
 		# user stopped the calcuation using the cancel button
 		progressDialog.SignalFinished()
 
-		self.list.SetInstance(Instance(self.preferences, memtree, dbtree, fstree))
+		# replace previous instance
+		self.list.ClearInstance()
+		self.list.SetInstance(Instance(self.preferences, coltree, dbtree, fstree))
+		self.list.readonly = False
+
+		numProblems = NodeStatus.countProblems(self.list.instance.getStatusCounts(True))
+		self.SetStatusBarText('Checked ' + str(stats) + \
+			', {0:d} differences found'.format(numProblems))
+
+	def BeginBrowsing(self):
+		# the instance can be browsed, but not modified, see Instance.beginReadOnly()
+		self.list.readonly = True
+		if self.list.instance is not None:
+			self.list.instance.beginReadOnly()
+
+	def EndBrowsing(self, readonly):
+		if self.list.instance is not None:
+			self.list.instance.endReadOnly()
+		self.list.readonly = readonly
+
+	def OpenCheckJournal(self):
+		# the checksums of an interrupted check can be used again
+		journal = CheckJournal(self.journalFile)
+		if CheckJournal.exists(self.journalFile):
+			journal.open()
+			# the checksums of an old journal cannot be trusted anymore
+			if not journal.isExpired():
+				dial = wx.MessageBox((u'A previous check started at {0:s} has been ' + \
+					u'interrupted after calculating the checksums of {1:d} files, ' + \
+					u'the last one was\n\n{2:s}\n\nDo you want to resume this check?').format( \
+					timestampToString(journal.getCreationTime()), journal.getNumChecksums(), \
+					journal.getCursorString()), \
+					'Resume Check', wx.YES_NO | wx.ICON_QUESTION | wx.YES_DEFAULT)
+				if dial == wx.YES:
+					return journal
+			journal.remove()
+		journal.open()
+		return journal
+
+	def OnScrub(self, event):
+		# like a check, but only for the files verified longest ago, see Scrubber
+		if ManifestTree.isManifest(self.dbFile):
+			wx.MessageBox('Scrubbing of manifests is not supported, please check instead.', \
+				'Error', wx.OK | wx.ICON_ERROR)
+			return
+		previousReadonly = self.list.readonly
+		self.BeginBrowsing()
+		self.SetStatusBarText()
+
+		try:
+			# create trees
+			fstree = FilesystemTree(self.rootDir, self.preferences.includes, \
+				[ os.path.sep + self.metaName ] + self.preferences.excludes)
+			fstree.open()
+			dbtree = self.CreateDatabaseTree()
+			dbtree.open()
+			coltree = ColumnTree()
+			coltree.open()
+		except MyException as e:
+			self.EndBrowsing(previousReadonly)
+			e.showDialog('Scrubbing ' + self.rootDir)
+			return
+
+		budgetBytes = None
+		if self.preferences.scrubGigabytes > 0:
+			budgetBytes = self.preferences.scrubGigabytes * 1024**3
+		budgetSeconds = None
+		if self.preferences.scrubMinutes > 0:
+			budgetSeconds = self.preferences.scrubMinutes * 60
+		scrubber = Scrubber(fstree, dbtree)
+		try:
+			# create progress dialog for the files selected by the byte budget
+			progressDialog = FileProcessingProgressDialog(self, 'Scrubbing ' + self.rootDir)
+			progressDialog.Show()
+			numFiles, numBytes = scrubber.select(budgetBytes)
+			progressDialog.Init(numFiles, numBytes)
+
+			# execute task
+			scrubber.registerHandlers(progressDialog.SignalNewFile, \
+				progressDialog.SignalBytesDone)
+			scrubber.scrub(coltree, budgetBytes, budgetSeconds)
+			coltree.commit()
+			scrubber.unRegisterHandlers()
+		except UserCancelledException:
+			self.EndBrowsing(previousReadonly)
+			progressDialog.SignalFinished()
+			return
+		except MyException as e:
+			self.EndBrowsing(previousReadonly)
+			progressDialog.Destroy()
+			e.showDialog('Scrubbing ' + self.rootDir)
+			return
+
+		progressDialog.SignalFinished()
+
+		# replace previous instance
+		self.list.ClearInstance()
+		self.list.SetInstance(Instance(self.preferences, coltree, dbtree, fstree))
 		self.list.readonly = False
 
-		self.SetStatusBarText('Checked ' + str(stats))
+		numProblems = NodeStatus.countProblems(self.list.instance.getStatusCounts(True))
+		self.SetStatusBarText(('Scrubbed {0:d} files ({1:s}), ' + \
+			'{2:d} differences found').format(scrubber.getNumFiles(), \
+			sizeToString(scrubber.getNumBytes()), numProblems))
+
+	def OnVerifyDatabase(self, event):
+		# opening a database only checks a part of its rows against the
+		# signature, this checks all of them
+		if self.rootDir is None or not self.DatabaseExists():
+			wx.MessageBox('Import or Open directory before you can verify its database.', \
+				'Error', wx.OK | wx.ICON_ERROR)
+			return
+		try:
+			wx.BeginBusyCursor()
+			try:
+				# a read-only snapshot does not interfere with other instances
+				dbtree = self.CreateDatabaseTree(readonly=True)
+				signatureValid = dbtree.isSignatureValid(True)
+				dbtree.close()
+			finally:
+				wx.EndBusyCursor()
+		except MyException as e:
+			e.showDialog('Verifying ' + self.dbFile)
+			return
+		if signatureValid:
+			self.SetStatusBarText('Database matches its signature')
+		else:
+			wx.MessageBox('Database or database signature file have been corrupted.', \
+				'Error', wx.OK | wx.ICON_ERROR)
+			self.SetStatusBarText('Database does not match its signature')
+
+	def OnCompactDatabase(self, event):
+		# rebuilding the database files is expensive, so commits do not do it
+		if self.rootDir is None or not self.DatabaseExists():
+			wx.MessageBox('Import or Open directory before you can compact its database.', \
+				'Error', wx.OK | wx.ICON_ERROR)
+			return
+		if ManifestTree.isManifest(self.dbFile):
+			wx.MessageBox('Compacting of manifests is not supported.', \
+				'Error', wx.OK | wx.ICON_ERROR)
+			return
+		try:
+			wx.BeginBusyCursor()
+			try:
+				dbtree = self.CreateDatabaseTree()
+				dbtree.open()
+				try:
+					dbtree.compact()
+				finally:
+					dbtree.close()
+			finally:
+				wx.EndBusyCursor()
+		except MyException as e:
+			e.showDialog('Compacting ' + self.dbFile)
+			return
+		self.SetStatusBarText('Database compacted')
+
+	def OnRefresh(self, event):
+		if self.list.instance is None or self.list.readonly or \
+			not self.list.instance.isRefreshPossible():
+			self.SetStatusBarText('Refresh not possible, please check first')
+			return
+		self.list.RefreshInstance()
+
+	def OnAcceptAll(self, event):
+		if self.list.instance is None or self.list.readonly or \
+			not self.list.instance.isPatchPossible():
+			self.SetStatusBarText('Accepting not possible, please check first')
+			return
+		numProblems = NodeStatus.countProblems(self.list.instance.getStatusCounts(True))
+		dial = wx.MessageBox(('You are about to accept all {0:d} differences in this directory.\n\n' + \
+			'Do you still want to continue?').format(numProblems), \
+			'Accept All', wx.YES_NO | wx.ICON_WARNING | wx.NO_DEFAULT)
+		if not dial == wx.YES:
+			return
+		try:
+			count = self.list.Accept(None, safeOnly=False)
+		except MyException as e:
+			e.showDialog('Accepting all entries')
+			self.list.RefreshTree()
+			return
+		self.list.RefreshTree()
+		self.SetStatusBarText('Accepted {0:d} changes'.format(count))
+
+	def OnAcceptMoves(self, event):
+		if self.list.instance is None or self.list.readonly or \
+			not self.list.instance.isMoveDetectionPossible():
+			self.SetStatusBarText('Accepting moves not possible, please check first')
+			return
+		moves = self.list.instance.detectMoves()
+		counts = [ len([ m for m in moves if m.kind == kind ]) \
+			for kind in [ MoveKind.Moved, MoveKind.Renamed, MoveKind.Copied ] ]
+		if counts[0] + counts[1] == 0:
+			self.list.RefreshTree()
+			self.SetStatusBarText('No moved or renamed entries found')
+			return
+		dial = wx.MessageBox(('Found {0:d} moved, {1:d} renamed and {2:d} copied entries.\n\n' + \
+			'Do you want to accept the moved and renamed entries?').format(*counts), \
+			'Accept Moves', wx.YES_NO | wx.ICON_QUESTION | wx.YES_DEFAULT)
+		if not dial == wx.YES:
+			return
+		try:
+			count = self.list.instance.acceptMoves(moves)
+		except MyException as e:
+			e.showDialog('Accepting moves')
+			self.list.RefreshTree()
+			return
+		self.list.RefreshTree()
+		self.SetStatusBarText('Accepted {0:d} moves'.format(count))
+
+	def OnFindDuplicates(self, event):
+		# in a directory under checksum control the checksums of the
+		# database are used, any other directory can be chosen as well
+		dbtree = None
+		if self.rootDir is None:
+			dirDialog = wx.DirDialog(self, "Choose a directory to search for duplicates:", \
+				style=wx.DD_DEFAULT_STYLE)
+			if not dirDialog.ShowModal() == wx.ID_OK:
+				return
+			rootDir = dirDialog.GetPath()
+			includes = []
+			excludes = []
+		else:
+			rootDir = self.rootDir
+			includes = self.preferences.includes
+			excludes = [ os.path.sep + self.metaName ] + self.preferences.excludes
+		fileDialog = wx.FileDialog(self, 'Save list of duplicates to file', \
+			defaultFile='duplicates.txt', wildcard='Text file (*.txt)|*.txt', \
+			style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+		if not fileDialog.ShowModal() == wx.ID_OK:
+			return
+		try:
+			if self.rootDir is not None and os.path.exists(self.dbFile) and \
+				not ShardedDatabaseTree.isSharded(self.dbFile):
+				dbtree = DatabaseTree(self.dbFile, self.sigFile, True)
+			finder = DuplicateFinder(rootDir, includes, excludes, dbtree)
+		except MyException as e:
+			if dbtree is not None:
+				dbtree.close()
+			e.showDialog('Finding duplicates in ' + rootDir)
+			return
+
+		numGroups = 0
+		wastedBytes = 0
+		f = None
+		try:
+			# create progress dialog
+			progressDialog = FileProcessingProgressDialog(self, 'Finding duplicates in ' + rootDir)
+			progressDialog.Show()
+			stats = finder.getNodeStatistics()
+			progressDialog.Init(stats.getNodeCount(), stats.getNodeSize())
+
+			# execute task; groups are written as they are found, there may
+			# be lots of them
+			finder.registerHandlers(progressDialog.SignalNewFile, \
+				progressDialog.SignalBytesDone)
+			f = open(fileDialog.GetPath(), 'wb')
+			for group in finder.find():
+				f.write('# ' + str(group) + ', checksum ' + group.checksum + '\n')
+				for path in group.paths:
+					f.write(path.encode('utf-8') + '\n')
+				f.write('\n')
+				numGroups += 1
+				wastedBytes += group.getWastedBytes()
+			finder.unRegisterHandlers()
+		except UserCancelledException:
+			progressDialog.SignalFinished()
+			self.SetStatusBarText('Cancelled after {0:d} groups of duplicates'.format(numGroups))
+			return
+		except MyException as e:
+			progressDialog.Destroy()
+			e.showDialog('Finding duplicates in ' + rootDir)
+			return
+		finally:
+			if f is not None:
+				f.close()
+			if dbtree is not None:
+				dbtree.close()
+
+		progressDialog.SignalFinished()
+		self.SetStatusBarText('Found {0:d} groups of duplicates wasting {1:s}'.format( \
+			numGroups, sizeToString(wastedBytes)))
 
 	def OnAbout(self, event):
 		info = wx.AboutDialogInfo()